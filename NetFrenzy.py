@@ -5,64 +5,223 @@ import argparse
 
 import lib.pcap as pcap
 import lib.neo4j as neo4j
+import lib.bolt as bolt
 import lib.connection as connection
+import lib.aggregate as aggregate
+import lib.oui as oui
+import lib.multicast as multicast
+import lib.export as export
+import lib.metrics as metrics
+import lib.analytics as analytics
+import lib.history as history
+import lib.rollup as rollup
+import lib.flows as flows
+import lib.filters as filters
+import lib.profiles as profiles
+import lib.records as records
 
 def parse_args():
   parser = argparse.ArgumentParser(description='Import a pcap into Neo4j')
   parser.add_argument('-c', '--config', type=str, help='Config json file', default='config.json')
   parser.add_argument('-p', '--pcap', type=str, help='Path to pcap file')
+  parser.add_argument('-D', '--pcap-dir', type=str, help='Directory or glob of pcap files to import, like rotated tcpdump -G/-C files')
+  parser.add_argument('--watch', type=float, help='With --pcap-dir, keep checking for new files every N seconds')
+  parser.add_argument('--settle', type=float, help='With --watch, seconds a file must go unmodified before it is imported', default=10)
   parser.add_argument('-l', '--live', type=str, help='Capture live on specified interface')
+  parser.add_argument('--bpf', type=str, help='Live capture: BPF capture filter, like "not port 5353"')
+  parser.add_argument('--display-filter', type=str, help='Wireshark display filter applied by tshark, like "not mdns" (turns off --fast for files)')
   parser.add_argument('-i', '--ignore', type=str, help='MAC address to ignore (like the GW which would correspond to all other IPs)')
   parser.add_argument('-d', '--debug', action='store_true', help='Use pdb to debug Neo4j responses')
   parser.add_argument('-da', '--debug-at', type=int, help='Use pdb to debug Neo4j responses at a specific iteration')
-  parser.add_argument('--debug-time', action='store_true', help='Enable Neo4j time performance tracking')
+  parser.add_argument('--debug-time', action='store_true', help='Print time spent in Neo4j and in each processing stage')
+  parser.add_argument('--metrics-file', type=str, help='Periodically write per-stage timings to this file')
+  parser.add_argument('--metrics-format', choices=metrics.FORMATS, help='Format of --metrics-file (default: prometheus for .prom files, json otherwise)')
+  parser.add_argument('--metrics-interval', type=float, help='Seconds between --metrics-file updates', default=10)
   parser.add_argument('--debug-cache', action='store_true', help='Print cache stats after execution')
+  parser.add_argument('--debug-batch', action='store_true', help='Print the latency of every batch written to Neo4j')
   parser.add_argument('-nc', '--no-count', action='store_true', help='Disable count for progress bar')
-  parser.add_argument('--cache-max', type=int, help='Max cache size for each of the cache types', default=50)
+  parser.add_argument('--cache-max', type=int, help='Max cache size for each of the cache types', default=100000)
+  parser.add_argument('--cache-size', type=str, action='append', help='Max cache size for one cache type, like IP=1000000 (repeatable)', default=[])
   parser.add_argument('--count', type=int, help='Number of packets in the pcap (optional)')
+  parser.add_argument('--progress', choices=['packets', 'bytes'], help='Show progress by packet count or by position in the file', default='packets')
   parser.add_argument('-r', '--reduce', action='store_true', help='Reduce information stored about connections')
+  parser.add_argument('-w', '--workers', type=int, help='Split the pcap across this many processes, or with --pcap-dir import this many files at once', default=1)
+  parser.add_argument('--async-writes', type=int, help='Write to Neo4j with up to N requests in flight while packets keep being processed', default=1)
+  parser.add_argument('--profile', choices=profiles.PROFILES, help='tshark dissection profile: full for every layer, minimal for only what NetFrenzy reads (default: minimal with --reduce, otherwise full)')
+  parser.add_argument('-f', '--fast', action='store_true', help='Parse Ethernet/IP/TCP/UDP and 802.11 management headers natively, using tshark only for other frames')
+  parser.add_argument('--queue-size', type=int, help='Live capture: max packets waiting to be processed', default=10000)
+  parser.add_argument('--backpressure', choices=['block', 'drop-oldest', 'sample'], help='Live capture: what to do with new packets when the queue is full', default='block')
+  parser.add_argument('--live-detail', choices=['adaptive', 'full', 'reduce'], help='Live capture: record everything and sample repeat packets only when falling behind (adaptive), always record everything (full) or enable --reduce (reduce)', default='adaptive')
+  parser.add_argument('--live-workers', type=int, help='Live capture: number of dissection threads', default=1)
+  parser.add_argument('--pipeline-stats', type=float, help='Live capture: print queue and write counters every N seconds')
+  parser.add_argument('--oui-file', type=str, help='Manufacturer table to use: OuiLookup JSON, IEEE oui.txt/CSV or Wireshark manuf (default: OuiLookup data file)')
+  parser.add_argument('--oui-snapshot', type=str, help='Precompiled copy of the manufacturer table to load from, rebuilt when the table is newer')
+  parser.add_argument('--no-schema', action='store_true', help='Skip creating the Neo4j constraints and indexes at startup')
+  parser.add_argument('--resume', action='store_true', help='Continue importing the pcap from the last checkpoint written to Neo4j')
+  parser.add_argument('--flows', action='store_true', help='Track TCP/UDP flows so both directions update one CONNECTED relationship from client to server')
+  parser.add_argument('--flow-timeout', type=float, help='With --flows, seconds of capture time a flow can be idle before it is forgotten', default=flows.DEFAULT_TIMEOUT)
+  parser.add_argument('--analytics', action='store_true', help='Compute PageRank, weighted degree and communities over every stored connection at the end of the import and write them to the nodes')
+  parser.add_argument('--history', type=str, nargs='?', const=history.DEFAULT_TIERS, help=f'Keep per-connection packet and byte counts in time buckets, as width:buckets tiers (default {history.DEFAULT_TIERS})')
+  parser.add_argument('--subnet-prefix', type=int, help='Prefix length of the IPv4 Subnet nodes in the rollup', default=rollup.DEFAULT_PREFIX_V4)
+  parser.add_argument('--subnet-prefix-v6', type=int, help='Prefix length of the IPv6 Subnet nodes in the rollup', default=rollup.DEFAULT_PREFIX_V6)
+  parser.add_argument('--no-rollup', action='store_true', help='Skip the Subnet and Vendor summary nodes written with every flush')
+  parser.add_argument('--export-dir', type=str, help='Write neo4j-admin import CSV files to this directory instead of writing to Neo4j')
+  parser.add_argument('--no-aggregate', action='store_true', help='Write every packet to Neo4j as it is processed instead of buffering')
+  parser.add_argument('--flush-packets', type=int, help='Flush buffered packets to Neo4j after this many packets', default=1000)
+  parser.add_argument('--flush-memory', type=int, help='Flush buffered packets to Neo4j once the buffer reaches this many MB', default=64)
+  parser.add_argument('--flush-seconds', type=float, help='Flush buffered packets to Neo4j after this many seconds', default=5.0)
+  parser.add_argument('--batch-size', type=int, help='Extract this many packets before folding them into the buffer together', default=records.DEFAULT_BATCH_SIZE)
   if len(sys.argv) == 1:
     parser.print_help()
     sys.exit(1)
   args = parser.parse_args()
+  if args.resume and args.async_writes > 1:
+    parser.error('--resume can\'t be used with --async-writes, whose imports write no checkpoint to resume from')
   return args
 
 def main():
     args = parse_args()
 
-    if not args.pcap and not args.live:
+    if not args.pcap and not args.live and not args.pcap_dir:
         print(f'try --help')
         return
     if args.pcap:
         print(f'Filename: {args.pcap}')
+    if args.pcap_dir:
+        print(f'Files: {args.pcap_dir}')
     if args.live:
         print(f'Interface: {args.live}')
     print(f'Config: {args.config}')
 
-    pc = pcap.Pcap(args.pcap, args.live)
-    n4j = neo4j.Neo4j()
+    oui.configure(args.oui_file, args.oui_snapshot)
+    oui.get_index()
+
+    profile = args.profile
+    if profile is None:
+        # The service, the only thing minimal leaves out, isn't kept when reduced
+        profile = 'minimal' if args.reduce else 'full'
+    pc = pcap.Pcap(args.pcap, args.live, fast=args.fast, bpf_filter=args.bpf, display_filter=args.display_filter,
+                   profile=profile)
     conn = connection.Connection(config=args.config)
     conn.init_config()
-    n4j.set_connection(conn)
+    if args.export_dir:
+        n4j = export.Export(args.export_dir)
+    else:
+        if conn.transport == 'bolt':
+            n4j = bolt.Bolt()
+        else:
+            n4j = neo4j.Neo4j()
+        n4j.set_connection(conn)
+        if not args.no_schema:
+            n4j.create_schema()
+    multicast.set_sites(conn.sites)
+    if conn.drop:
+        rules = filters.from_config(conn.drop)
+        if rules:
+            filters.enable(rules)
+        unmatched = filters.unmatched_protocols(rules, pc.profile, pc.fast)
+        if unmatched:
+            print(f'Drop rules for {", ".join(unmatched)} only match packets tshark dissects, which '
+                  f'--profile minimal never does and --fast only does for some. Drop them by port instead')
     if args.debug:
         n4j.debug = True
+    if args.debug_batch:
+        n4j.report_latency = True
     if 'ignore' in args:
         pc.ignore.append(args.ignore)
     if args.no_count:
         pc.do_count = False
     if args.count:
         pc.count = args.count
+    pc.progress = args.progress
     if args.debug_at:
         pc.debug_at = args.debug_at
     if args.debug_time:
         pc.debug_time = args.debug_time
+    if args.debug_time or args.metrics_file:
+        metrics.enable()
+    if args.metrics_file:
+        metrics_format = args.metrics_format
+        if metrics_format is None:
+            metrics_format = 'prometheus' if args.metrics_file.endswith('.prom') else 'json'
+        metrics.active.start_writer(args.metrics_file, metrics_format, args.metrics_interval)
 
     if args.debug_cache:
         pc.debug_cache = args.debug_cache
     pc.cache_max = args.cache_max
+    for size in args.cache_size:
+        _type, _, n = size.partition('=')
+        pc.cache_sizes[_type.upper()] = int(n)
+    pc.cache_init()
     pc.reduce = args.reduce
+    pc.workers = args.workers
+    pc.batch_size = args.batch_size
+    pc.write_concurrency = args.async_writes
+    if args.async_writes > 1 and not args.export_dir:
+        n4j.set_pool_size(args.async_writes)
+    pc.resume = args.resume
+    pc.directory = args.pcap_dir
+    pc.watch = args.watch
+    pc.settle = args.settle
+    pc.live_detail = args.live_detail
+    pc.pipeline_options = {
+        'queue_size': args.queue_size,
+        'policy': args.backpressure,
+        'workers': args.live_workers,
+        'stats_interval': args.pipeline_stats,
+    }
+    if args.export_dir and args.no_aggregate:
+        print('--export-dir writes aggregated data, ignoring --no-aggregate')
+        args.no_aggregate = False
+    if args.analytics:
+        if args.no_aggregate:
+            print('--analytics counts the connections of aggregated writes, ignoring --no-aggregate')
+            args.no_aggregate = False
+        analytics.enable()
+    if args.flows and args.no_aggregate:
+        print('--flows writes flows with aggregated writes, ignoring --no-aggregate')
+        args.no_aggregate = False
+    if args.history:
+        if args.export_dir:
+            print('--export-dir does not write connection history, ignoring --history')
+        else:
+            if args.no_aggregate:
+                print('--history is written with aggregated writes, ignoring --no-aggregate')
+                args.no_aggregate = False
+            history.enable(history.parse_tiers(args.history))
+    # Written from the aggregated flushes, so nothing to do without them
+    if not args.no_rollup and not args.no_aggregate and not args.export_dir:
+        rollup.enable(args.subnet_prefix, args.subnet_prefix_v6)
+    if not args.no_aggregate:
+        pc.aggregator = aggregate.Aggregator(reduce=pc.reduce,
+                                             max_packets=args.flush_packets,
+                                             max_memory=args.flush_memory*1024*1024,
+                                             max_seconds=args.flush_seconds)
+        if args.flows:
+            pc.flows = flows.FlowTable(args.flow_timeout)
+            pc.aggregator.flows = pc.flows
+
+    try:
+        try:
+            pc.start_process(n4j)
+        except KeyboardInterrupt:
+            # Ctrl-C is how a live capture ends, so it still gets scored
+            if args.live and analytics.active is not None:
+                analytics.write_scores(n4j, analytics.active)
+            raise
+        if analytics.active is not None:
+            analytics.write_scores(n4j, analytics.active)
+    finally:
+        if filters.active is not None and filters.active.checked:
+            print_drop_stats(filters.active)
+        n4j.close()
+        # Writes the metrics file one last time
+        metrics.disable()
 
-    pc.start_process(n4j)
+def print_drop_stats(rules):
+    dropped = sum(rules.dropped.values())
+    by_rule = ', '.join(f'{k} {v}' for k, v in sorted(rules.dropped.items()))
+    print(f'Drop rules: dropped {dropped} of {rules.checked} packets' + (f' ({by_rule})' if by_rule else ''))
 
 if __name__=='__main__':
     try:
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import synth
+import stub
+
+'''
+Runs synthetic captures through Pcap.start_process against the stub
+endpoint and reports, for each shape and mode:
+
+ - pkts/s:  packets processed per second of wall time
+ - q/pkt:   statements sent to Neo4j per packet
+ - p50/p99: write request latency seen by the client, in ms
+ - rss:     peak resident memory of the ingest process, in MB
+
+Every case runs in its own process so peak RSS isn't shared between them,
+and the stub runs in another so it doesn't compete for the GIL.
+'''
+
+MODES = ('full', 'reduce')
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Benchmark NetFrenzy ingest against a stub Neo4j')
+  parser.add_argument('-n', '--packets', type=int, help='Packets per capture', default=10000)
+  parser.add_argument('-s', '--shape', choices=synth.SHAPES, action='append', help='Capture shape to run (repeatable, default all)')
+  parser.add_argument('-m', '--mode', choices=MODES, action='append', help='Mode to run (repeatable, default both)')
+  parser.add_argument('--hosts', type=int, help='Hosts in the synthetic captures', default=1000)
+  parser.add_argument('--flows', type=int, help='Flows in the flows capture', default=1000)
+  parser.add_argument('--latency', type=float, help='Stub latency per request in ms', default=1.0)
+  parser.add_argument('--row-latency', type=float, help='Stub latency per UNWIND row in microseconds', default=0)
+  parser.add_argument('-f', '--fast', action='store_true', help='Use the native pcap parser')
+  parser.add_argument('--no-payload', action='store_true', help='Generate captures without TCP/UDP payloads, so --fast never needs tshark')
+  parser.add_argument('--no-aggregate', action='store_true', help='Write every packet as it is processed')
+  parser.add_argument('--dir', type=str, help='Where to keep the generated captures', default=os.path.join(BENCH_DIR, 'captures'))
+  parser.add_argument('--json', type=str, help='Also write the results to this file')
+  # Internal: run a single case in this process
+  parser.add_argument('--case', type=str, nargs=3, metavar=('PCAP', 'MODE', 'PORT'), help=argparse.SUPPRESS)
+  return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.case:
+        print(json.dumps(run_case(args, *args.case)))
+        return
+
+    os.makedirs(args.dir, exist_ok=True)
+    port, server = start_stub(args.latency / 1000, args.row_latency / 1000000)
+    results = []
+    try:
+        for shape in args.shape or synth.SHAPES:
+            pcap_path = capture(args, shape)
+            for mode in args.mode or MODES:
+                post(port, '/reset')
+                result = run_child(args, pcap_path, mode, port)
+                stats = get(port, '/stats')
+                result.update(shape=shape, mode=mode, **stats)
+                result['queries_per_packet'] = stats['statements'] / max(result['packets'], 1)
+                results.append(result)
+                print_result(result)
+    finally:
+        server.terminate()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def capture(args, shape):
+    payload = 'nopayload' if args.no_payload else 'payload'
+    path = os.path.join(args.dir, f'{shape}-{args.packets}-{args.hosts}-{args.flows}-{payload}.pcap')
+    if not os.path.exists(path):
+        synth.write_pcap(path, shape, args.packets, args.hosts, args.flows, not args.no_payload)
+    return path
+
+def run_child(args, pcap_path, mode, port):
+    cmd = [sys.executable, os.path.abspath(__file__), '--case', pcap_path, mode, str(port)]
+    if args.fast:
+        cmd.append('--fast')
+    if args.no_aggregate:
+        cmd.append('--no-aggregate')
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:], file=sys.stderr)
+        raise RuntimeError(f'Benchmark case {pcap_path} {mode} failed')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def run_case(args, pcap_path, mode, port):
+    import lib.aggregate as aggregate
+    import lib.neo4j as neo4j
+    import lib.pcap as pcap
+    import lib.pcapfile as pcapfile
+
+    n4j = neo4j.Neo4j()
+    n4j.commit = f'http://127.0.0.1:{port}/db/data/transaction/commit'
+    pc = pcap.Pcap(pcap_path, None, fast=args.fast)
+    pc.reduce = mode == 'reduce'
+    if not args.no_aggregate:
+        pc.aggregator = aggregate.Aggregator(reduce=pc.reduce)
+    packets = pcapfile.count_packets(pcap_path)
+    start = time.time()
+    pc.start_process(n4j)
+    seconds = time.time() - start
+    latencies = sorted(n4j.latencies)
+    return {
+        'packets': packets,
+        'seconds': seconds,
+        'packets_per_second': packets / seconds,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def start_stub(latency, row_latency):
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_stub, args=(ports, latency, row_latency), daemon=True)
+    server.start()
+    return ports.get(), server
+
+def serve_stub(ports, latency, row_latency):
+    server = stub.serve(0, latency, row_latency)
+    ports.put(server.server_port)
+    while True:
+        time.sleep(1)
+
+def get(port, path):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}') as resp:
+        return json.load(resp)
+
+def post(port, path):
+    req = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=b'{}', headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req) as resp:
+        return json.load(resp)
+
+def print_result(r):
+    print(f"{r['shape']:6} {r['mode']:6} {r['packets']:8d} pkts {r['packets_per_second']:10.1f} pkts/s "
+          f"{r['queries_per_packet']:7.3f} q/pkt p50 {r['latency_p50_ms']:7.2f}ms p99 {r['latency_p99_ms']:7.2f}ms "
+          f"rss {r['peak_rss_mb']:7.1f}MB")
+
+if __name__ == '__main__':
+    main()
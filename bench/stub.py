@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Stand-in for Neo4j's HTTP transactional endpoint, and optionally for its
+Bolt port. It accepts every statement without running it, answers after
+a configurable delay, and counts what it received. Checkpoints are the
+one thing it stores, so imports can be resumed against it. GET /stats
+returns the counters and POST /reset clears them along with the
+checkpoints.
+
+The Bolt side speaks just enough of Bolt 5.0 for lib/bolt.py: HELLO,
+BEGIN, RUN, PULL/DISCARD, COMMIT/ROLLBACK, RESET and GOODBYE, with
+PackStream's null, bool, int, float, string, bytes, list and map values.
+'''
+
+class Stats:
+    # keep holds on to every statement received, for tests to look at
+    def __init__(self, keep=False):
+        self.lock = threading.Lock()
+        self.keep = keep
+        # Bolt connections open now
+        self.connections = 0
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.statements = 0
+        self.rows = 0
+        self.received = []
+        # {name: [packet, size]} from the Checkpoint MERGEs
+        self.checkpoints = {}
+        # Most Bolt connections open at once
+        self.peak_connections = self.connections
+
+    def record(self, statements):
+        with self.lock:
+            self.requests += 1
+            self.statements += len(statements)
+            if self.keep:
+                self.received += statements
+            for s in statements:
+                if s['statement'].startswith('MERGE (c:Checkpoint'):
+                    parameters = s['parameters']
+                    self.checkpoints[parameters['name']] = [parameters['packet'], parameters['size']]
+                rows = s.get('parameters', {}).get('rows')
+                self.rows += len(rows) if rows is not None else 1
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.peak_connections = max(self.peak_connections, self.connections)
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'statements': self.statements, 'rows': self.rows,
+                    'peak_connections': self.peak_connections}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Otherwise small replies wait on delayed ACKs and every request
+    # looks 40ms slower than it is
+    disable_nagle_algorithm = True
+    # Set by serve()
+    stats = None
+    latency = 0.0
+    row_latency = 0.0
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(self.stats.to_dict())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/reset':
+            self.stats.reset()
+            self.reply({})
+            return
+        statements = body.get('statements', [])
+        self.stats.record(statements)
+        rows = sum(len(s.get('parameters', {}).get('rows', ())) for s in statements)
+        delay = self.latency + rows * self.row_latency
+        if delay:
+            time.sleep(delay)
+        self.reply({'results': [result(s, self.stats) for s in statements], 'errors': []})
+
+    def reply(self, body):
+        out = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+def result(statement, stats):
+    # Enough for the callers that read results: execute_query() takes the
+    # first row, a checkpoint never written reads back as nulls, and nothing
+    # is stored to read back for analytics
+    if 'Checkpoint' in statement['statement'] and 'RETURN' in statement['statement']:
+        with stats.lock:
+            row = stats.checkpoints.get(statement['parameters']['name'], [None, None])
+        return {'columns': [], 'data': [{'row': list(row)}]}
+    if 'CONNECTED' in statement['statement'] and 'RETURN' in statement['statement']:
+        return {'columns': [], 'data': []}
+    return {'columns': [], 'data': [{'row': [1]}]}
+
+# Bolt message signatures
+HELLO = 0x01
+GOODBYE = 0x02
+RESET = 0x0F
+RUN = 0x10
+BEGIN = 0x11
+COMMIT = 0x12
+ROLLBACK = 0x13
+DISCARD = 0x2F
+PULL = 0x3F
+SUCCESS = 0x70
+RECORD = 0x71
+
+BOLT_MAGIC = b'\x60\x60\xb0\x17'
+
+class BoltHandler(socketserver.StreamRequestHandler):
+    # Set by serve_bolt()
+    stats = None
+    latency = 0.0
+    row_latency = 0.0
+
+    def handle(self):
+        if self.rfile.read(4) != BOLT_MAGIC:
+            return
+        self.rfile.read(16)
+        # Always 5.0, which every driver that speaks Bolt 5 offers
+        self.wfile.write(b'\x00\x00\x00\x05')
+        self.wfile.flush()
+        self.stats.connection_opened()
+        try:
+            self.serve_messages()
+        finally:
+            self.stats.connection_closed()
+
+    def serve_messages(self):
+        # Results of the last RUN, sent on PULL
+        rows = []
+        while True:
+            message = self.read_message()
+            if message is None:
+                return
+            signature, fields = message
+            if signature == GOODBYE:
+                return
+            if signature == HELLO:
+                self.send(SUCCESS, {'server': 'Neo4j/5.0.0', 'connection_id': 'bolt-stub'})
+            elif signature == RUN:
+                query, parameters = fields[0], fields[1]
+                statement = {'statement': query, 'parameters': parameters}
+                self.stats.record([statement])
+                delay = self.latency + len(parameters.get('rows', ())) * self.row_latency
+                if delay:
+                    time.sleep(delay)
+                rows = [row['row'] for row in result(statement, self.stats)['data']]
+                columns = len(rows[0]) if rows else 0
+                self.send(SUCCESS, {'fields': [f'_{i}' for i in range(columns)], 't_first': 0, 'qid': 0})
+            elif signature == PULL:
+                for row in rows:
+                    self.send(RECORD, row)
+                rows = []
+                self.send(SUCCESS, {'has_more': False, 't_last': 0, 'type': 'w', 'db': 'neo4j'})
+            elif signature == DISCARD:
+                rows = []
+                self.send(SUCCESS, {'has_more': False})
+            elif signature == COMMIT:
+                self.send(SUCCESS, {'bookmark': 'stub:1'})
+            else:
+                # BEGIN, ROLLBACK and RESET
+                self.send(SUCCESS, {})
+
+    def read_message(self):
+        data = b''
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return None
+            size, = struct.unpack('>H', header)
+            if size == 0:
+                # A zero chunk between messages is a keep-alive
+                if data:
+                    break
+                continue
+            data += self.rfile.read(size)
+        value, _ = unpack(data, 0)
+        return value
+
+    def send(self, signature, *fields):
+        data = bytes([0xB0 + len(fields), signature]) + b''.join(pack(field) for field in fields)
+        for i in range(0, len(data), 0xFFFF):
+            chunk = data[i:i+0xFFFF]
+            self.wfile.write(struct.pack('>H', len(chunk)) + chunk)
+        self.wfile.write(b'\x00\x00')
+        self.wfile.flush()
+
+# PackStream values, unpack() returns structures as (signature, fields)
+def unpack(data, i):
+    marker = data[i]
+    i += 1
+    if marker < 0x80:
+        return marker, i
+    if marker >= 0xF0:
+        return marker - 0x100, i
+    high = marker & 0xF0
+    if high == 0x80:
+        return data[i:i+(marker & 0x0F)].decode(), i + (marker & 0x0F)
+    if high == 0x90:
+        return unpack_list(data, i, marker & 0x0F)
+    if high == 0xA0:
+        return unpack_map(data, i, marker & 0x0F)
+    if high == 0xB0:
+        signature = data[i]
+        fields, i = unpack_list(data, i + 1, marker & 0x0F)
+        return (signature, fields), i
+    if marker == 0xC0:
+        return None, i
+    if marker == 0xC1:
+        return struct.unpack_from('>d', data, i)[0], i + 8
+    if marker in (0xC2, 0xC3):
+        return marker == 0xC3, i
+    for code, fmt in ((0xC8, '>b'), (0xC9, '>h'), (0xCA, '>i'), (0xCB, '>q')):
+        if marker == code:
+            return struct.unpack_from(fmt, data, i)[0], i + struct.calcsize(fmt)
+    for codes, fmt in (((0xCC, 0xD0, 0xD4, 0xD8), '>B'), ((0xCD, 0xD1, 0xD5, 0xD9), '>H'), ((0xCE, 0xD2, 0xD6, 0xDA), '>I')):
+        if marker in codes:
+            size = struct.unpack_from(fmt, data, i)[0]
+            i += struct.calcsize(fmt)
+            kind = codes.index(marker)
+            if kind == 0:
+                return bytes(data[i:i+size]), i + size
+            if kind == 1:
+                return data[i:i+size].decode(), i + size
+            if kind == 2:
+                return unpack_list(data, i, size)
+            return unpack_map(data, i, size)
+    raise ValueError(f'Unknown PackStream marker 0x{marker:02X}')
+
+def unpack_list(data, i, size):
+    values = []
+    for _ in range(size):
+        value, i = unpack(data, i)
+        values.append(value)
+    return values, i
+
+def unpack_map(data, i, size):
+    values = {}
+    for _ in range(size):
+        key, i = unpack(data, i)
+        values[key], i = unpack(data, i)
+    return values, i
+
+def pack(value):
+    if value is None:
+        return b'\xC0'
+    if value is True or value is False:
+        return b'\xC3' if value else b'\xC2'
+    if isinstance(value, int):
+        if -16 <= value < 128:
+            return struct.pack('>b', value) if value < 0 else bytes([value])
+        return b'\xCB' + struct.pack('>q', value)
+    if isinstance(value, float):
+        return b'\xC1' + struct.pack('>d', value)
+    if isinstance(value, str):
+        data = value.encode()
+        return size_marker(len(data), 0x80, 0xD0) + data
+    if isinstance(value, (list, tuple)):
+        return size_marker(len(value), 0x90, 0xD4) + b''.join(pack(v) for v in value)
+    if isinstance(value, dict):
+        return size_marker(len(value), 0xA0, 0xD8) + b''.join(pack(k) + pack(v) for k, v in value.items())
+    raise TypeError(f'Can\'t pack {type(value)}')
+
+def size_marker(size, tiny, sized):
+    if size < 16:
+        return bytes([tiny + size])
+    if size < 0x100:
+        return bytes([sized]) + struct.pack('>B', size)
+    if size < 0x10000:
+        return bytes([sized + 1]) + struct.pack('>H', size)
+    return bytes([sized + 2]) + struct.pack('>I', size)
+
+def serve(port=0, latency=0.0, row_latency=0.0, keep=False):
+    # Returns the server, already serving on a background thread
+    Handler.stats = Stats(keep)
+    Handler.latency = latency
+    Handler.row_latency = row_latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve_bolt(port=0, latency=0.0, row_latency=0.0, stats=None, keep=False):
+    # Like serve(), pass stats=server.RequestHandlerClass.stats to count
+    # both in one place
+    BoltHandler.stats = stats or Stats(keep)
+    BoltHandler.latency = latency
+    BoltHandler.row_latency = row_latency
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), BoltHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Stub Neo4j HTTP endpoint for benchmarks')
+  parser.add_argument('-p', '--port', type=int, help='Port to listen on', default=7474)
+  parser.add_argument('--latency', type=float, help='Milliseconds to wait before answering each request', default=0)
+  parser.add_argument('--row-latency', type=float, help='Additional microseconds per UNWIND row', default=0)
+  parser.add_argument('--bolt-port', type=int, help='Also answer Bolt on this port')
+  return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = serve(args.port, args.latency / 1000, args.row_latency / 1000000)
+    print(f'Listening on 127.0.0.1:{server.server_port}')
+    if args.bolt_port is not None:
+        bolt_server = serve_bolt(args.bolt_port, args.latency / 1000, args.row_latency / 1000000, stats=server.RequestHandlerClass.stats)
+        print(f'Bolt on 127.0.0.1:{bolt_server.server_address[1]}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import socket
+import struct
+
+'''
+Synthetic captures for the benchmarks. Each shape stresses a different
+part of the ingest path:
+
+ - hosts: many hosts with one or two flows each, so most packets create
+   new IP/MAC nodes
+ - flows: a handful of hosts with many port pairs, so most packets create
+   or update CONNECTED relationships
+ - wlan:  802.11 beacons, probe requests and probe responses over
+   radiotap, for the SSID path
+'''
+
+SHAPES = ('hosts', 'flows', 'wlan')
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RADIOTAP = 127
+
+HTTP_REQUEST = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+
+def mac_bytes(mac):
+    return bytes.fromhex(mac.replace(':', ''))
+
+def host_mac(i):
+    # Locally administered unicast
+    return '02:00:%02x:%02x:%02x:%02x' % ((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+def host_ip(i):
+    return socket.inet_ntoa(struct.pack('>I', (10 << 24) | (i + 1)))
+
+def ethernet(src, dst, ethertype, payload):
+    return mac_bytes(dst) + mac_bytes(src) + struct.pack('>H', ethertype) + payload
+
+def ipv4(src, dst, proto, payload):
+    return struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64, proto, 0,
+                       socket.inet_aton(src), socket.inet_aton(dst)) + payload
+
+def tcp(sport, dport, payload=b''):
+    flags = 0x18 if payload else 0x10
+    return struct.pack('>HHIIHHHH', sport, dport, 0, 0, (5 << 12) | flags, 65535, 0, 0) + payload
+
+def udp(sport, dport, payload=b''):
+    return struct.pack('>HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+def wlan_management(subtype, addr1, addr2, addr3, ssid):
+    # Beacons and probe responses carry timestamp, interval and capabilities
+    fixed = b'\x00' * 12 if subtype in (5, 8) else b''
+    ssid = ssid.encode()
+    return (bytes([subtype << 4, 0]) + b'\x00\x00' + mac_bytes(addr1) + mac_bytes(addr2) + mac_bytes(addr3) +
+            b'\x00\x00' + fixed + bytes([0, len(ssid)]) + ssid)
+
+def radiotap(frame):
+    # Header with only the flags field present
+    return struct.pack('<BBHIB', 0, 0, 9, 0x2, 0) + frame
+
+def ip_packet(rng, src, dst, sport, dport, payloads):
+    if rng.random() < 0.2:
+        inner = udp(sport, 53, b'\x00' * 12 if payloads else b'')
+        proto = 17
+    else:
+        inner = tcp(sport, dport, HTTP_REQUEST if payloads and dport == 80 else b'')
+        proto = 6
+    return ethernet(host_mac(src), host_mac(dst), 0x0800, ipv4(host_ip(src), host_ip(dst), proto, inner))
+
+def hosts_packets(rng, count, hosts, flows, payloads):
+    # Every host talks to one of a few servers, on one or two ports
+    servers = max(1, hosts // 100)
+    for _ in range(count):
+        src = servers + rng.randrange(hosts)
+        dst = rng.randrange(servers)
+        port = (80, 443)[src % 2]
+        yield ip_packet(rng, src, dst, 40000 + src % 20000, port, payloads)
+
+def flows_packets(rng, count, hosts, flows, payloads):
+    hosts = min(hosts, 16)
+    pairs = [(rng.randrange(hosts), rng.randrange(hosts), rng.randrange(1024, 65535), rng.choice((22, 80, 443, rng.randrange(1, 65535))))
+             for _ in range(flows)]
+    for _ in range(count):
+        src, dst, sport, dport = rng.choice(pairs)
+        if src == dst:
+            dst = (dst + 1) % hosts
+        yield ip_packet(rng, src, dst, sport, dport, payloads)
+
+def wlan_packets(rng, count, hosts, flows, payloads):
+    aps = max(1, hosts // 10)
+    ssids = [f'bench-{i}' for i in range(max(1, aps // 2))]
+    broadcast = 'ff:ff:ff:ff:ff:ff'
+    for _ in range(count):
+        index = rng.randrange(aps)
+        ap = host_mac(index)
+        station = host_mac(aps + rng.randrange(hosts))
+        ssid = ssids[index % len(ssids)]
+        kind = rng.random()
+        if kind < 0.6:
+            frame = wlan_management(8, broadcast, ap, ap, ssid)
+        elif kind < 0.8:
+            frame = wlan_management(4, broadcast, station, broadcast, rng.choice(ssids))
+        else:
+            frame = wlan_management(5, station, ap, ap, ssid)
+        yield radiotap(frame)
+
+GENERATORS = {
+    'hosts': (hosts_packets, LINKTYPE_ETHERNET),
+    'flows': (flows_packets, LINKTYPE_ETHERNET),
+    'wlan': (wlan_packets, LINKTYPE_RADIOTAP),
+}
+
+def write_pcap(path, shape, count, hosts=1000, flows=1000, payloads=True, seed=0):
+    generate, linktype = GENERATORS[shape]
+    rng = random.Random(seed)
+    start = 1600000000
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype))
+        for i, data in enumerate(generate(rng, count, hosts, flows, payloads)):
+            # One packet per millisecond
+            sec, usec = divmod(i * 1000, 1000000)
+            f.write(struct.pack('<IIII', start + sec, usec, len(data), len(data)))
+            f.write(data)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Write a synthetic pcap for benchmarking')
+  parser.add_argument('output', type=str, help='Path of the pcap to write')
+  parser.add_argument('-s', '--shape', choices=SHAPES, help='Traffic shape', default='hosts')
+  parser.add_argument('-n', '--packets', type=int, help='Number of packets', default=10000)
+  parser.add_argument('--hosts', type=int, help='Number of hosts (stations for wlan)', default=1000)
+  parser.add_argument('--flows', type=int, help='Number of distinct flows for the flows shape', default=1000)
+  parser.add_argument('--no-payload', action='store_true', help='Leave TCP/UDP payloads out, so --fast never falls back to tshark')
+  parser.add_argument('--seed', type=int, help='Random seed', default=0)
+  return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    write_pcap(args.output, args.shape, args.packets, args.hosts, args.flows, not args.no_payload, args.seed)
@@ -0,0 +1,303 @@
+import time
+
+from . import analytics
+from . import history
+from . import metrics
+from . import multicast
+from . import rollup
+
+# Rough per-entry memory cost in bytes, used for the memory flush threshold.
+# These are estimates of the dict slot, key tuple and value objects, not exact
+# measurements, but they are close enough to keep the buffer bounded.
+NODE_SIZE = 250
+RELATIONSHIP_SIZE = 300
+CONNECTION_SIZE = 600
+
+class Accumulator:
+    __slots__ = ('first_seen', 'last_seen', 'count', 'data_size', 'service', 'service_layer', 'history')
+
+    def __init__(self):
+        self.first_seen = None
+        self.last_seen = None
+        self.count = 0
+        self.data_size = 0
+        self.service = None
+        self.service_layer = None
+        # One history.Series per tier while history is on
+        self.history = None
+
+    # weight is how many packets this one stands for when sampling
+    def update(self, time, length, service, service_layer, weight=1):
+        if time is not None:
+            if self.first_seen is None or time < self.first_seen:
+                self.first_seen = time
+            if self.last_seen is None or time > self.last_seen:
+                self.last_seen = time
+            if history.active is not None:
+                history.active.record(self, time, length, weight)
+        self.count += weight
+        if length is not None:
+            self.data_size += length * weight
+        # Same rule as the per-packet query: the first service seen wins
+        # unless a later packet reports it from a higher layer
+        if self.service_layer is None or (service_layer is not None and service_layer > self.service_layer):
+            self.service = service
+            self.service_layer = service_layer
+
+    def merge(self, other):
+        if other.first_seen is not None:
+            if self.first_seen is None or other.first_seen < self.first_seen:
+                self.first_seen = other.first_seen
+        if other.last_seen is not None:
+            if self.last_seen is None or other.last_seen > self.last_seen:
+                self.last_seen = other.last_seen
+        self.count += other.count
+        self.data_size += other.data_size
+        if self.service_layer is None or (other.service_layer is not None and other.service_layer > self.service_layer):
+            self.service = other.service
+            self.service_layer = other.service_layer
+        if history.active is not None:
+            history.active.merge(self, other)
+
+class Aggregate:
+    '''
+    Everything extracted from a run of packets, folded by graph key.
+    Nodes keep their properties, relationships without properties are
+    sets of keys, and CONNECTED relationships keep an Accumulator.
+    '''
+    def __init__(self):
+        self.nodes = {'IP': {}, 'MAC': {}, 'SSID': {}}
+        # (reltype, name_a, name_b)
+        self.relationships = set()
+        # ('IP', ip_src, ip_dst, port_dst, proto) or ('MAC', mac_src, mac_dst, None, proto)
+        self.connections = {}
+        self.packets = 0
+        # Number of the last packet folded in, for checkpoints
+        self.last_packet = None
+
+    def __len__(self):
+        return sum(len(v) for v in self.nodes.values()) + len(self.relationships) + len(self.connections)
+
+    def size(self):
+        nodes = sum(len(v) for v in self.nodes.values())
+        return nodes * NODE_SIZE + len(self.relationships) * RELATIONSHIP_SIZE + len(self.connections) * CONNECTION_SIZE
+
+    def add_node(self, label, name, properties=None):
+        if name is None:
+            return
+        if name not in self.nodes[label]:
+            self.nodes[label][name] = properties or {}
+
+    def add_relationship(self, reltype, name_a, name_b):
+        if None in (name_a, name_b):
+            return
+        self.relationships.add((reltype, name_a, name_b))
+
+    def add_connection(self, label, src, dst, port, proto, time, length, service, service_layer, weight=1):
+        key = (label, src, dst, port, proto)
+        conn = self.connections.get(key)
+        if conn is None:
+            conn = Accumulator()
+            self.connections[key] = conn
+        conn.update(time, length, service, service_layer, weight)
+
+    def merge(self, other):
+        for label in other.nodes:
+            for name, properties in other.nodes[label].items():
+                self.add_node(label, name, properties)
+        self.relationships |= other.relationships
+        for key, other_conn in other.connections.items():
+            self.merge_connection(key, other_conn)
+        self.packets += other.packets
+        if other.last_packet is not None and (self.last_packet is None or other.last_packet > self.last_packet):
+            self.last_packet = other.last_packet
+
+    def merge_connection(self, key, other):
+        conn = self.connections.get(key)
+        if conn is None:
+            conn = Accumulator()
+            self.connections[key] = conn
+        conn.merge(other)
+
+    def partition(self, n):
+        '''
+        Splits the aggregate into n by key, nodes by name and relationships
+        by their first node, so the same key always lands in the same part.
+        '''
+        parts = [Aggregate() for _ in range(n)]
+        for label, nodes in self.nodes.items():
+            for name, properties in nodes.items():
+                parts[hash(name) % n].nodes[label][name] = properties
+        for key in self.relationships:
+            parts[hash(key[1]) % n].relationships.add(key)
+        for key, conn in self.connections.items():
+            parts[hash(key[1]) % n].connections[key] = conn
+        return parts
+
+class Aggregator:
+    '''
+    Buffers packets in an Aggregate and writes it to Neo4j once any of the
+    packet count, memory or time thresholds is reached. A threshold of
+    None disables it. If checkpoint is set ({'name': ..., 'size': ...}),
+    every flush also records the last packet it contains.
+    '''
+    def __init__(self, reduce=False, max_packets=1000, max_memory=64*1024*1024, max_seconds=5.0):
+        self.reduce = reduce
+        self.checkpoint = None
+        self.max_packets = max_packets
+        self.max_memory = max_memory
+        self.max_seconds = max_seconds
+        self.aggregate = Aggregate()
+        self.last_flush = time.time()
+        self.flushes = 0
+        # flows.FlowTable to drain into every aggregate taken
+        self.flows = None
+
+    # Passing neo4j=None leaves flushing to the caller. count is the
+    # number of packets folded since the last call
+    def packet(self, neo4j, count=1):
+        self.aggregate.packets += count
+        if neo4j is not None and self.should_flush():
+            self.flush(neo4j)
+
+    def should_flush(self):
+        agg = self.aggregate
+        if self.max_packets is not None and agg.packets >= self.max_packets:
+            return True
+        if self.max_memory is not None and agg.size() >= self.max_memory:
+            return True
+        if self.max_seconds is not None and time.time() - self.last_flush >= self.max_seconds:
+            return True
+        return False
+
+    def take(self):
+        if self.flows is not None:
+            self.flows.drain(self.aggregate)
+        agg = self.aggregate
+        self.aggregate = Aggregate()
+        self.last_flush = time.time()
+        return agg
+
+    def flush(self, neo4j):
+        agg = self.take()
+        if len(agg) == 0:
+            return
+        write_aggregate(neo4j, agg, reduce=self.reduce, checkpoint=self.checkpoint)
+        self.flushes += 1
+
+def write_aggregate(neo4j, agg, reduce=False, statements_per_transaction=None, checkpoint=None):
+    # Sinks other than Neo4j (see export.Export) write aggregates themselves
+    writer = getattr(neo4j, 'write_aggregate', None)
+    if writer is not None:
+        start = metrics.clock()
+        writer(agg, reduce=reduce)
+        if metrics.active is not None:
+            metrics.active.observe('export', metrics.clock() - start)
+    else:
+        write_statements(neo4j, agg, reduce, statements_per_transaction, checkpoint)
+    # Only once written, so a failed flush that is retried counts once
+    if analytics.active is not None:
+        analytics.active.add_aggregate(agg)
+
+def write_statements(neo4j, agg, reduce, statements_per_transaction, checkpoint):
+    start = metrics.clock()
+    statements = aggregate_statements(neo4j, agg, reduce=reduce)
+    if checkpoint is not None and agg.last_packet is not None:
+        # Last, so it only commits together with everything before it
+        statements += neo4j.merge_checkpoint(dict(checkpoint, packet=agg.last_packet))
+    if metrics.active is not None:
+        metrics.active.observe('query_build', metrics.clock() - start)
+    if statements_per_transaction is None:
+        neo4j.execute_batch(statements)
+        return
+    for i in range(0, len(statements), statements_per_transaction):
+        neo4j.execute_batch(statements[i:i+statements_per_transaction])
+
+# All statements for one flush, in write order. They are sent as a single
+# transaction, nodes first so the relationship MATCHes can find them.
+def aggregate_statements(neo4j, agg, reduce=False):
+    return node_statements(neo4j, agg) + relationship_statements(neo4j, agg, reduce=reduce) + rollup_statements(neo4j, agg)
+
+# The subnet and vendor summary, see rollup.py. It sums over the whole
+# flush, so it isn't split up with Aggregate.partition()
+def rollup_statements(neo4j, agg):
+    if rollup.active is None:
+        return []
+    return rollup.active.statements(neo4j, agg)
+
+def node_statements(neo4j, agg):
+    statements = []
+    for label in ('IP', 'MAC', 'SSID'):
+        statements += neo4j.merge_nodes(label, node_rows(label, agg.nodes[label]))
+    return statements
+
+def relationship_statements(neo4j, agg, reduce=False):
+    statements = []
+    relationships = {}
+    for reltype, name_a, name_b in agg.relationships:
+        relationships.setdefault(reltype, []).append({'a': name_a, 'b': name_b})
+    for reltype, rows in relationships.items():
+        label_a, label_b = RELATIONSHIP_LABELS[reltype]
+        statements += neo4j.merge_relationships(reltype, label_a, label_b, rows)
+
+    connections = {'IP': [], 'MAC': []}
+    histories = {'IP': [], 'MAC': []}
+    for key, conn in agg.connections.items():
+        row = connection_row(key, conn)
+        connections[key[0]].append(row)
+        if conn.history is not None:
+            histories[key[0]].append((row, conn.history))
+    for label, rows in connections.items():
+        statements += neo4j.merge_connections(label, rows, reduce=reduce)
+    # After the connections, so the relationships they MATCH exist
+    if history.active is not None:
+        for label, items in histories.items():
+            statements += history.active.statements(neo4j, label, items)
+    return statements
+
+def node_rows(label, nodes, names=None):
+    # nodes maps name -> stored properties, enriched with the address classes
+    if names is None:
+        names = list(nodes)
+    if label == 'IP':
+        classes = [multicast.classify_ip(name) for name in names]
+    elif label == 'MAC':
+        classes = [multicast.classify_mac(name) for name in names]
+    else:
+        classes = [{}] * len(names)
+    rows = []
+    for name, extra in zip(names, classes):
+        properties = dict(extra)
+        properties.update(nodes[name])
+        # Cannot set a null property, so leave it out
+        properties = {k: v for k, v in properties.items() if v is not None}
+        rows.append({'name': name, 'properties': properties})
+    return rows
+
+RELATIONSHIP_LABELS = {
+    'ASSIGNED': ('IP', 'MAC'),
+    'ADVERTISES': ('MAC', 'SSID'),
+    'PROBES': ('MAC', 'SSID'),
+    'PROBE_RESPONSE': ('MAC', 'MAC'),
+}
+
+def connection_row(key, conn):
+    label, src, dst, port, proto = key
+    row = {
+        'src': src,
+        'dst': dst,
+        'protocol': proto,
+        'first_seen': conn.first_seen,
+        'last_seen': conn.last_seen,
+        'data_size': conn.data_size,
+        'count': conn.count,
+        'service': str(conn.service),
+        'service_layer': conn.service_layer,
+    }
+    if label == 'IP':
+        port = -1 if port is None else int(port)
+        row['name'] = f'{port}/{proto}'
+        row['port'] = port
+    else:
+        row['name'] = proto
+    return row
@@ -0,0 +1,175 @@
+'''
+PageRank, weighted degree and label propagation communities computed in
+NetFrenzy instead of with the Graph Data Science plugin. While analytics
+are active, every aggregate written counts its CONNECTED relationships.
+If the import wrote any, the CONNECTED totals of the whole database are
+read back into an adjacency of IP and MAC nodes at the end, so nodes
+written by earlier imports are scored on everything they are connected
+to, not just this import's part. The scores are computed on
+sparse matrices and written back to the nodes' pagerank, community and
+weighted_degree properties, the properties the web UI sizes and colors
+nodes by.
+
+Needs numpy and scipy, which are only imported when scores are computed.
+'''
+
+# The Written counter, None when analytics are off
+active = None
+
+DAMPING = 0.85
+PAGERANK_ITERATIONS = 20
+PAGERANK_TOLERANCE = 1e-7
+PROPAGATION_ITERATIONS = 10
+
+class Written:
+    '''
+    Counts the CONNECTED relationships written by this import, which only
+    decides whether there is anything new to score.
+    '''
+    def __init__(self):
+        self.connections = 0
+
+    def add_aggregate(self, agg):
+        self.connections += len(agg.connections)
+
+class Graph:
+    '''
+    Adjacency of the nodes joined by CONNECTED relationships. Edges are
+    kept per (label, src, dst) and weighted by packets, summed over every
+    port and protocol like the COMMUNICATES relationships.
+    '''
+    def __init__(self):
+        self.ids = {'IP': {}, 'MAC': {}}
+        # (label, src id, dst id) -> packets
+        self.edges = {}
+
+    def node_id(self, label, name):
+        ids = self.ids[label]
+        i = ids.get(name)
+        if i is None:
+            i = len(ids)
+            ids[name] = i
+        return i
+
+    def add_edge(self, label, src, dst, packets):
+        edge = (label, self.node_id(label, src), self.node_id(label, dst))
+        self.edges[edge] = self.edges.get(edge, 0) + packets
+
+    def scores(self):
+        '''
+        Returns {label: [{'name', 'pagerank', 'community', 'weighted_degree'}]}.
+        IPs and MACs are separate graphs, since CONNECTED never joins them.
+        '''
+        results = {}
+        for label, ids in self.ids.items():
+            if not ids:
+                continue
+            src, dst, weight = [], [], []
+            for (edge_label, a, b), packets in self.edges.items():
+                if edge_label == label:
+                    src.append(a)
+                    dst.append(b)
+                    weight.append(packets)
+            n = len(ids)
+            pagerank_scores = pagerank(n, src, dst)
+            degrees = weighted_degree(n, src, dst, weight)
+            communities = label_propagation(n, src, dst, weight)
+            rows = []
+            for name, i in ids.items():
+                rows.append({
+                    'name': name,
+                    'pagerank': float(pagerank_scores[i]),
+                    'community': int(communities[i]),
+                    'weighted_degree': int(degrees[i]),
+                })
+            results[label] = rows
+        return results
+
+def adjacency(n, src, dst, weight):
+    from scipy import sparse
+    return sparse.csr_matrix((weight, (src, dst)), shape=(n, n), dtype=float)
+
+def pagerank(n, src, dst, damping=DAMPING, iterations=PAGERANK_ITERATIONS, tolerance=PAGERANK_TOLERANCE):
+    '''
+    Unweighted PageRank with the same scaling as GDS, so every node starts
+    at 1 and a node nothing points to scores 1 - damping.
+    '''
+    import numpy as np
+    from scipy import sparse
+    a = adjacency(n, src, dst, np.ones(len(src)))
+    # Parallel relationships count once
+    a.data[:] = 1
+    out_degree = np.asarray(a.sum(axis=1)).ravel()
+    inverse = np.divide(1.0, out_degree, out=np.zeros(n), where=out_degree > 0)
+    transition = (sparse.diags(inverse) @ a).T.tocsr()
+    scores = np.ones(n)
+    for _ in range(iterations):
+        updated = (1 - damping) + damping * (transition @ scores)
+        converged = np.abs(updated - scores).max() < tolerance
+        scores = updated
+        if converged:
+            break
+    return scores
+
+def weighted_degree(n, src, dst, weight):
+    # Packets sent plus packets received
+    import numpy as np
+    a = adjacency(n, src, dst, weight)
+    return np.asarray(a.sum(axis=0)).ravel() + np.asarray(a.sum(axis=1)).ravel()
+
+def label_propagation(n, src, dst, weight, iterations=PROPAGATION_ITERATIONS):
+    '''
+    Every node repeatedly takes the label with the most packet weight among
+    its neighbours, ignoring direction. Ties go to the node's current label,
+    then to the lowest. Communities are numbered from 0 in node order.
+    '''
+    import numpy as np
+    from scipy import sparse
+    a = adjacency(n, src, dst, weight)
+    undirected = (a + a.T).tocsr()
+    nodes = np.arange(n)
+    labels = nodes.copy()
+    for _ in range(iterations):
+        current = sparse.csr_matrix((np.ones(n), (nodes, labels)), shape=(n, n))
+        # The small weight on the current label keeps isolated nodes where
+        # they are and breaks ties in its favour
+        votes = undirected @ current + current * 1e-9
+        updated = np.asarray(votes.argmax(axis=1)).ravel()
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    _, communities = np.unique(labels, return_inverse=True)
+    return communities
+
+def enable():
+    global active
+    active = Written()
+    return active
+
+def disable():
+    global active
+    active = None
+
+# The Graph of every CONNECTED relationship stored in Neo4j
+def stored_graph(neo4j):
+    graph = Graph()
+    for label in graph.ids:
+        for src, dst, packets in neo4j.read_connection_totals(label):
+            graph.add_edge(label, src, dst, packets)
+    return graph
+
+# written is the import's Written counter. Nothing is scored if it wrote
+# no connections, otherwise the stored graph is
+def write_scores(neo4j, written):
+    if not hasattr(neo4j, 'set_node_scores'):
+        print('Analytics are only written to Neo4j, skipping')
+        return
+    if written.connections == 0:
+        return
+    graph = stored_graph(neo4j)
+    print(f'Computing PageRank and communities for {sum(len(ids) for ids in graph.ids.values())} nodes')
+    statements = []
+    for label, rows in graph.scores().items():
+        statements += neo4j.set_node_scores(label, rows)
+    statements += neo4j.merge_communicates()
+    neo4j.execute_batch(statements)
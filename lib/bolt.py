@@ -0,0 +1,117 @@
+import time
+
+from .neo4j import Neo4j
+
+class Bolt(Neo4j):
+    '''
+    Same interface as Neo4j, but talks to the server over the Bolt protocol
+    with the official neo4j driver instead of the HTTP transactional endpoint.
+    Requires Neo4j 4+ and the neo4j Python package.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.uri = 'bolt://localhost:7687'
+        self.database = None
+        self.pool_size = 10
+        self.driver = None
+
+    def set_connection(self, connection):
+        self.connection = connection
+        self.uri = connection.bolt_address()
+        self.database = connection.database
+        self.pool_size = connection.pool_size
+        self.connect()
+
+    def connect(self):
+        # Imported here so the neo4j package is only needed for Bolt
+        from neo4j import GraphDatabase
+        self.driver = GraphDatabase.driver(self.uri, auth=self.connection.bolt_auth(),
+                                           max_connection_pool_size=self.pool_size)
+
+    # Enough pooled connections for this many transactions at once. The
+    # driver's pool size is fixed when it is created, so it is created again
+    def set_pool_size(self, size):
+        if size <= self.pool_size:
+            return
+        self.pool_size = size
+        if self.driver is not None:
+            self.driver.close()
+            self.connect()
+
+    def transaction(self):
+        session = self.driver.session(database=self.database)
+        return BoltTransaction(session)
+
+    def execute_query(self, query, parameters=None):
+        start = time.time()
+        with self.transaction() as tx:
+            records = list(tx.run(query, parameters))
+        self.record_latency(time.time() - start)
+        if self.debug:
+            import pdb; pdb.set_trace()
+        try:
+            return list(records[0].values())
+        except Exception as e:
+            print(f'Exception:\t{type(e)}: {e}')
+            print(f'Query:\t{query}')
+            print(f'Response:\t{records}')
+            raise
+
+    def query_rows(self, query, parameters=None):
+        start = time.time()
+        with self.transaction() as tx:
+            rows = [list(record.values()) for record in tx.run(query, parameters)]
+        self.record_latency(time.time() - start)
+        return rows
+
+    # Runs a list of (query, parameters) statements in a single transaction.
+    # Results are consumed as each statement finishes rather than buffered.
+    # Errors are raised without printing anything, so quiet has no effect
+    def execute_batch(self, statements, quiet=False):
+        if not statements:
+            return []
+        results = []
+        start = time.time()
+        with self.transaction() as tx:
+            for q, p in statements:
+                summary = tx.run(q, p).consume()
+                results.append(summary.counters)
+        latency = time.time() - start
+        self.record_latency(latency)
+        if self.report_latency:
+            rows = sum(len(p.get('rows', [])) for q, p in statements)
+            print(f'Batch: {len(statements)} statements, {rows} rows in {latency*1000:.1f}ms')
+        if self.debug:
+            import pdb; pdb.set_trace()
+        return results
+
+    def close(self):
+        if self.driver is not None:
+            self.driver.close()
+
+class BoltTransaction:
+    '''
+    Explicit transaction on a pooled session. Commits on a clean exit from
+    the with block and rolls back on an exception.
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.tx = None
+
+    def __enter__(self):
+        self.tx = self.session.begin_transaction()
+        return self
+
+    def run(self, query, parameters=None):
+        return self.tx.run(query, parameters or {})
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.tx.commit()
+            else:
+                self.tx.rollback()
+        finally:
+            self.tx.close()
+            self.session.close()
+        return False
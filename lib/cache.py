@@ -0,0 +1,48 @@
+from collections import OrderedDict
+
+class LRUCache:
+    '''
+    Bounded set of hashable keys with least recently used eviction.
+    Lookups, inserts and evictions are all O(1).
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    # Membership test that doesn't touch the stats or the LRU order
+    def __contains__(self, key):
+        return key in self.data
+
+    # Returns True if key was cached, otherwise adds it
+    def check(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        self.data[key] = None
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+        return False
+
+    # Like check(), but doesn't add key
+    def lookup(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
@@ -8,6 +8,15 @@ class Connection:
         self.password = password
         self.config = config
         self.ip = 'localhost'
+        # http or bolt
+        self.transport = 'http'
+        self.bolt_uri = None
+        self.database = None
+        self.pool_size = 10
+        # Named site subnets, see multicast.set_sites()
+        self.sites = {}
+        # Packet drop rules, see filters.from_config()
+        self.drop = {}
         if self.config is not None:
             self.init_config()
 
@@ -21,9 +30,29 @@ class Connection:
             self.password = data['password']
         if 'ip' in data:
             self.ip = data['ip']
+        if 'transport' in data:
+            self.transport = data['transport']
+        if 'bolt_uri' in data:
+            self.bolt_uri = data['bolt_uri']
+        if 'database' in data:
+            self.database = data['database']
+        if 'pool_size' in data:
+            self.pool_size = data['pool_size']
+        if 'sites' in data:
+            self.sites = data['sites']
+        if 'drop' in data:
+            self.drop = data['drop']
 
     def basic_auth(self):
         return str(base64.b64encode(bytes(f'{self.username}:{self.password}')))
 
     def requests_auth(self):
         return requests.auth.HTTPBasicAuth(self.username, self.password)
+
+    def bolt_auth(self):
+        return (self.username, self.password)
+
+    def bolt_address(self):
+        if self.bolt_uri is not None:
+            return self.bolt_uri
+        return f'bolt://{self.ip}:7687'
@@ -0,0 +1,195 @@
+import csv
+import heapq
+import json
+import os
+import tempfile
+
+from . import aggregate
+
+'''
+Writes the graph as CSV files for neo4j-admin's bulk importer instead of
+sending it to a running Neo4j:
+
+    neo4j-admin database import full --nodes=ip.csv --nodes=mac.csv ...
+
+Nodes and property-less relationships are appended to their files as
+each aggregate is flushed, skipping keys already written. CONNECTED
+relationships have to be summed across the whole capture first, so they
+are kept in memory up to max_connections and spilled to sorted temporary
+runs beyond that. close() merges the runs into the final files.
+'''
+
+NODE_FILES = {
+    'IP': ('ip.csv', ['name:ID(IP)', 'multicast:boolean', 'broadcast:boolean', 'private:boolean',
+                      'link_local:boolean', 'loopback:boolean', 'site', ':LABEL']),
+    'MAC': ('mac.csv', ['name:ID(MAC)', 'manufacturer', 'multicast:boolean', 'broadcast:boolean',
+                        'local:boolean', ':LABEL']),
+    'SSID': ('ssid.csv', ['name:ID(SSID)', ':LABEL']),
+}
+
+RELATIONSHIP_FILES = {
+    'ASSIGNED': 'assigned.csv',
+    'ADVERTISES': 'advertises.csv',
+    'PROBES': 'probes.csv',
+    'PROBE_RESPONSE': 'probe_response.csv',
+}
+
+CONNECTION_FILES = {
+    'IP': 'connected_ip.csv',
+    'MAC': 'connected_mac.csv',
+}
+
+STATS_COLUMNS = ['first_seen:double', 'last_seen:double', 'data_size:long', 'count:long', 'service', 'service_layer:int']
+
+class Export:
+    def __init__(self, directory, max_connections=1000000):
+        self.directory = directory
+        self.max_connections = max_connections
+        self.debug = False
+        self.reduce = False
+        os.makedirs(directory, exist_ok=True)
+        self.files = {}
+        self.writers = {}
+        self.written = {}
+        for label, (filename, header) in NODE_FILES.items():
+            self.open(label, filename, header)
+        for reltype, filename in RELATIONSHIP_FILES.items():
+            label_a, label_b = aggregate.RELATIONSHIP_LABELS[reltype]
+            self.open(reltype, filename, [f':START_ID({label_a})', f':END_ID({label_b})', ':TYPE'])
+        self.connections = aggregate.Aggregate()
+        self.runs = []
+
+    def open(self, key, filename, header):
+        f = open(os.path.join(self.directory, filename), 'w', newline='')
+        self.files[key] = f
+        self.writers[key] = csv.writer(f)
+        self.writers[key].writerow(header)
+        self.written[key] = set()
+
+    def write_aggregate(self, agg, reduce=False):
+        self.reduce = reduce
+        for label in ('IP', 'MAC', 'SSID'):
+            self.write_nodes(label, agg.nodes[label])
+        for reltype, name_a, name_b in agg.relationships:
+            key = (name_a, name_b)
+            if key in self.written[reltype]:
+                continue
+            self.written[reltype].add(key)
+            self.writers[reltype].writerow([name_a, name_b, reltype])
+        for key, conn in agg.connections.items():
+            self.connections.merge_connection(connection_key(key), conn)
+        if len(self.connections.connections) >= self.max_connections:
+            self.spill()
+
+    def write_nodes(self, label, nodes):
+        names = [name for name in nodes if name not in self.written[label]]
+        writer = self.writers[label]
+        for row in aggregate.node_rows(label, nodes, names):
+            name, properties = row['name'], row['properties']
+            self.written[label].add(name)
+            if label == 'IP':
+                writer.writerow([name, csv_bool(properties.get('multicast')), csv_bool(properties.get('broadcast')),
+                                 csv_bool(properties.get('private')), csv_bool(properties.get('link_local')),
+                                 csv_bool(properties.get('loopback')), properties.get('site', ''), 'IP'])
+            elif label == 'MAC':
+                writer.writerow([name, properties.get('manufacturer', ''), csv_bool(properties.get('multicast')),
+                                 csv_bool(properties.get('broadcast')), csv_bool(properties.get('local')), 'MAC'])
+            else:
+                writer.writerow([name, 'SSID'])
+
+    def spill(self):
+        # Sorted run of connection accumulators, one JSON list per line
+        fd, path = tempfile.mkstemp(prefix='connected-', suffix='.run', dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            for key in sorted(self.connections.connections):
+                conn = self.connections.connections[key]
+                f.write(json.dumps([list(key), conn.first_seen, conn.last_seen, conn.count,
+                                    conn.data_size, conn.service, conn.service_layer]) + '\n')
+        self.runs.append(path)
+        self.connections = aggregate.Aggregate()
+
+    def close(self):
+        if self.runs:
+            self.spill()
+        for f in self.files.values():
+            f.close()
+        self.write_connections()
+        for path in self.runs:
+            os.remove(path)
+        print(f'Wrote neo4j-admin import files to {self.directory}')
+
+    def write_connections(self):
+        if self.runs:
+            # heapq.merge is stable, so equal keys come out in run order and
+            # service ties go to the earliest run like they do in Neo4j
+            files = [open(path, 'r') for path in self.runs]
+            rows = heapq.merge(*[(run_row(line) for line in f) for f in files], key=lambda r: r[0])
+        else:
+            files = []
+            rows = sorted(self.connections.connections.items())
+        outputs = {}
+        try:
+            for label, filename in CONNECTION_FILES.items():
+                f = open(os.path.join(self.directory, filename), 'w', newline='')
+                header = [f':START_ID({label})', f':END_ID({label})', 'name']
+                if label == 'IP':
+                    header.append('port:int')
+                header.append('protocol')
+                if not self.reduce:
+                    header += STATS_COLUMNS
+                header.append(':TYPE')
+                writer = csv.writer(f)
+                writer.writerow(header)
+                outputs[label] = (f, writer)
+            current_key, current = None, None
+            for key, conn in rows:
+                if key == current_key:
+                    current.merge(conn)
+                    continue
+                if current is not None:
+                    self.write_connection(outputs, current_key, current)
+                current_key, current = key, aggregate.Accumulator()
+                current.merge(conn)
+            if current is not None:
+                self.write_connection(outputs, current_key, current)
+        finally:
+            for f, writer in outputs.values():
+                f.close()
+            for f in files:
+                f.close()
+
+    def write_connection(self, outputs, key, conn):
+        label, src, dst, port, proto = key
+        row = aggregate.connection_row(key, conn)
+        line = [src, dst, row['name']]
+        if label == 'IP':
+            line.append(row['port'])
+        line.append(proto)
+        if not self.reduce:
+            line += [csv_value(conn.first_seen), csv_value(conn.last_seen), conn.data_size, conn.count,
+                     row['service'], csv_value(conn.service_layer)]
+        line.append('CONNECTED')
+        outputs[label][1].writerow(line)
+
+def connection_key(key):
+    # Sortable form of an aggregate connection key, ports as ints
+    label, src, dst, port, proto = key
+    port = -1 if port is None else int(port)
+    return (label, src, dst, port, str(proto))
+
+def run_row(line):
+    key, first_seen, last_seen, count, data_size, service, service_layer = json.loads(line)
+    conn = aggregate.Accumulator()
+    conn.first_seen = first_seen
+    conn.last_seen = last_seen
+    conn.count = count
+    conn.data_size = data_size
+    conn.service = service
+    conn.service_layer = service_layer
+    return tuple(key), conn
+
+def csv_bool(value):
+    return 'true' if value else 'false'
+
+def csv_value(value):
+    return '' if value is None else value
@@ -0,0 +1,188 @@
+from . import multicast
+from . import pcapfile
+from . import profiles
+
+'''
+Drop rules applied to each packet before anything else is done with it:
+before get_service() and get_ssid(), before the flow table and sampler,
+and before any Neo4j I/O. With --fast, packets decoded natively are
+dropped before tshark is ever asked to dissect them.
+
+The rules come from the "drop" section of config.json and only look at
+header fields that are already decoded:
+
+    "drop": {
+        "subnets": ["10.9.0.0/16", "fe80::/10"],
+        "macs": ["00:11:22:33:44:55"],
+        "protocols": ["arp", "mdns"],
+        "ports": [1900, 5353],
+        "multicast": true,
+        "broadcast": true
+    }
+
+A packet is dropped if its source or destination is in one of subnets,
+macs or ports, if any of its layers is one of protocols, or if its
+destination is a multicast or broadcast IP or MAC address.
+
+Application protocols only show up as layers when tshark dissects them,
+which the minimal profile never does and --fast only does for some
+packets. The ones in PROTOCOL_PORTS are also matched by their well-known
+ports, so a protocols rule for them drops the same packets either way.
+See unmatched_protocols() for the rest.
+
+Capture filters (--bpf) and display filters (--display-filter) are
+handed to tshark instead, see Pcap.__init__().
+'''
+
+BROADCAST_MAC = 'ff:ff:ff:ff:ff:ff'
+
+# TCP/UDP ports that stand for a protocol rule when the packet wasn't
+# dissected up to that layer
+PROTOCOL_PORTS = {
+    'dns': (53,), 'mdns': (5353,), 'llmnr': (5355,),
+    'nbns': (137,), 'nbdgm': (138,), 'nbss': (139,),
+    'dhcp': (67, 68), 'bootp': (67, 68), 'dhcpv6': (546, 547),
+    'ssdp': (1900,), 'ntp': (123,), 'snmp': (161, 162), 'syslog': (514,),
+    'kerberos': (88,), 'ldap': (389,), 'cldap': (389,),
+    'ssh': (22,), 'ftp': (21,), 'ftp-data': (20,), 'smtp': (25,),
+    'imap': (143,), 'pop': (110,), 'rdp': (3389,), 'vnc': (5900,),
+    'sip': (5060,), 'mqtt': (1883,),
+}
+
+# The RuleSet in use, None when off
+active = None
+
+class RuleSet:
+    def __init__(self, subnets=(), macs=(), protocols=(), ports=(), multicast=False, broadcast=False):
+        self.subnets = subnet_ranges(subnets)
+        self.macs = {normalize_mac(mac) for mac in macs}
+        self.protocols = {protocol.lower() for protocol in protocols}
+        self.ports = {str(int(port)) for port in ports}
+        self.protocol_ports = {str(port) for protocol in self.protocols
+                               for port in PROTOCOL_PORTS.get(protocol, ())}
+        self.multicast = multicast
+        self.broadcast = broadcast
+        self.checked = 0
+        # Packets dropped, by rule
+        self.dropped = {}
+
+    def __bool__(self):
+        return bool(self.subnets[4] or self.subnets[6] or self.macs or self.protocols or self.ports
+                    or self.multicast or self.broadcast)
+
+    def drop(self, packet):
+        '''
+        Returns True if packet should be dropped.
+        '''
+        self.checked += 1
+        rule = self.match(packet)
+        if rule is None:
+            return False
+        self.dropped[rule] = self.dropped.get(rule, 0) + 1
+        return True
+
+    # The name of the first rule packet matches, or None
+    def match(self, packet):
+        layers = packet.layers
+        ip = None
+        mac = None
+        ports = None
+        for layer in layers:
+            name = layer.layer_name
+            if name in self.protocols:
+                return 'protocols'
+            if name in ('ip', 'ipv6') and ip is None:
+                ip = layer
+            elif name in ('eth', 'wlan') and mac is None:
+                mac = layer
+            elif name in ('tcp', 'udp') and ports is None:
+                ports = layer
+
+        if ip is not None:
+            if self.subnets[4] or self.subnets[6]:
+                if self.in_subnets(ip.src) or self.in_subnets(ip.dst):
+                    return 'subnets'
+            if self.multicast or self.broadcast:
+                classes = multicast.classify_ip(ip.dst)
+                if self.multicast and classes['multicast']:
+                    return 'multicast'
+                if self.broadcast and classes['broadcast']:
+                    return 'broadcast'
+
+        if mac is not None:
+            if mac.layer_name == 'wlan':
+                src, dst = pcapfile.get_field(mac, 'sa'), pcapfile.get_field(mac, 'da')
+            else:
+                src, dst = pcapfile.get_field(mac, 'src'), pcapfile.get_field(mac, 'dst')
+            if self.macs and (normalize_mac(src) in self.macs or normalize_mac(dst) in self.macs):
+                return 'macs'
+            if dst is not None:
+                dst = normalize_mac(dst)
+                if self.broadcast and dst == BROADCAST_MAC:
+                    return 'broadcast'
+                if self.multicast and dst != BROADCAST_MAC and multicast.mac_multicast(dst):
+                    return 'multicast'
+
+        if self.ports and ports is not None:
+            if ports.srcport in self.ports or ports.dstport in self.ports:
+                return 'ports'
+        if self.protocol_ports and ports is not None:
+            if ports.srcport in self.protocol_ports or ports.dstport in self.protocol_ports:
+                return 'protocols'
+        return None
+
+    def in_subnets(self, ip):
+        version, value = multicast.ip_int(ip)
+        if version is None:
+            return False
+        for network, mask in self.subnets[version]:
+            if value & mask == network:
+                return True
+        return False
+
+# (network, mask) pairs split by IP version, so a v4 mask is never tested
+# against a v6 address
+def subnet_ranges(subnets):
+    ranges = {4: [], 6: []}
+    for cidr, network, mask in multicast.cidr_array(subnets):
+        ranges[6 if ':' in cidr else 4].append((network, mask))
+    return ranges
+
+def normalize_mac(mac):
+    if mac is None:
+        return None
+    return mac.lower().replace('-', ':')
+
+def from_config(drop):
+    '''
+    Builds a RuleSet from the "drop" section of config.json.
+    '''
+    unknown = set(drop) - {'subnets', 'macs', 'protocols', 'ports', 'multicast', 'broadcast'}
+    if unknown:
+        raise ValueError(f'Unknown drop rules in config: {", ".join(sorted(unknown))}')
+    return RuleSet(subnets=drop.get('subnets', ()),
+                   macs=drop.get('macs', ()),
+                   protocols=drop.get('protocols', ()),
+                   ports=drop.get('ports', ()),
+                   multicast=drop.get('multicast', False),
+                   broadcast=drop.get('broadcast', False))
+
+def unmatched_protocols(rules, profile, fast):
+    '''
+    The protocols of rules that may not be matched with this tshark profile
+    or --fast: application protocols tshark won't always dissect, and
+    which have no ports in PROTOCOL_PORTS to match instead.
+    '''
+    if profile != 'minimal' and not fast:
+        return []
+    return sorted(protocol for protocol in rules.protocols
+                  if protocol in profiles.UPPER_PROTOCOLS and protocol not in PROTOCOL_PORTS)
+
+def enable(rules):
+    global active
+    active = rules
+    return active
+
+def disable():
+    global active
+    active = None
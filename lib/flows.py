@@ -0,0 +1,243 @@
+from . import aggregate
+
+'''
+Bidirectional flow table for TCP and UDP. Both directions of a 5-tuple
+share one Flow, which knows which side is the client, so the CONNECTED
+relationship goes from client to server on the server's port instead of
+getting a second edge to the client's ephemeral port for the replies.
+
+Per packet, the work is a dictionary lookup and an Accumulator update.
+Flows are written to the aggregate when it is flushed (drain()), so a
+flush still covers every packet before its checkpoint. Closed flows and
+flows idle for longer than timeout seconds of capture time are then
+forgotten. A long-lived flow is written once per flush.
+
+Service detection only runs until a flow has a service above TCP/UDP,
+see needs_service().
+
+When a capture is split into slices (--workers), each slice has its own
+table, and merge() joins them in file order, so a flow a slice picked up
+mid-stream keeps the orientation an earlier slice saw it open with.
+'''
+
+# Seconds without packets before a flow is forgotten
+DEFAULT_TIMEOUT = 120
+
+# States
+SYN_SENT = 'syn_sent'
+SYN_RECEIVED = 'syn_received'
+ESTABLISHED = 'established'
+CLOSING = 'closing'
+CLOSED = 'closed'
+UDP = 'udp'
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+ACK = 0x10
+
+# get_service() results that only name the transport
+TRANSPORTS = ('tcp', 'udp')
+
+class Flow:
+    __slots__ = ('client', 'client_port', 'server', 'server_port', 'proto', 'state', 'fins',
+                 'last_seen', 'service', 'service_layer', 'conn', 'guessed')
+
+    def __init__(self, proto, client, client_port, server, server_port, state):
+        self.proto = proto
+        self.client = client
+        self.client_port = client_port
+        self.server = server
+        self.server_port = server_port
+        self.state = state
+        # Sides that have sent a FIN, 1 for the client and 2 for the server
+        self.fins = 0
+        self.last_seen = None
+        self.service = None
+        self.service_layer = None
+        # Counters since the last drain
+        self.conn = aggregate.Accumulator()
+        # True while the client was picked by port, without seeing a SYN
+        self.guessed = False
+
+    def connection_key(self):
+        return ('IP', self.client, self.server, self.server_port, self.proto)
+
+    def join(self, other):
+        '''
+        Continues this flow with other, the same flow picked up mid-stream
+        by the table of the packets that came after.
+        '''
+        fins = other.fins
+        if (other.client, other.client_port) != (self.client, self.client_port):
+            fins = (fins & 1) << 1 | (fins & 2) >> 1
+        self.fins |= fins
+        if self.state != CLOSED:
+            self.state = other.state
+        if self.fins == 3:
+            self.state = CLOSED
+        elif self.fins and self.state != CLOSED:
+            self.state = CLOSING
+        if other.service is not None and (self.service_layer is None or other.service_layer > self.service_layer):
+            self.service = other.service
+            self.service_layer = other.service_layer
+        self.conn.merge(other.conn)
+        if other.last_seen is not None:
+            self.last_seen = other.last_seen
+
+class FlowTable:
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        # (proto, lower endpoint, higher endpoint) -> Flow
+        self.flows = {}
+        self.timeout = timeout
+        # Newest packet time seen, the clock for idle timeouts
+        self.now = None
+        # (connection key, Accumulator) of sessions a new SYN ended since the
+        # last drain, counted under their own client and server
+        self.finished = []
+        self.opened = 0
+        self.closed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def get(self, proto, ip_src, port_src, ip_dst, port_dst):
+        return self.flows.get(flow_key(proto, ip_src, port_src, ip_dst, port_dst))
+
+    # False once the flow has a service, so get_service() and the tshark
+    # dissection it needs can be skipped. Called outside the fold lock by
+    # the live capture workers, which only costs an extra lookup at worst
+    def needs_service(self, proto, ip_src, port_src, ip_dst, port_dst):
+        flow = self.get(proto, ip_src, port_src, ip_dst, port_dst)
+        return flow is None or flow.service is None or flow.service in TRANSPORTS
+
+    def update(self, proto, ip_src, port_src, ip_dst, port_dst, flags, time, length, service, service_layer, weight=1):
+        key = flow_key(proto, ip_src, port_src, ip_dst, port_dst)
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = new_flow(proto, ip_src, port_src, ip_dst, port_dst, flags)
+            self.flows[key] = flow
+            self.opened += 1
+        elif flags is not None:
+            self.track(flow, ip_src, port_src, flags)
+
+        if service is not None and (flow.service_layer is None or service_layer > flow.service_layer):
+            flow.service = service
+            flow.service_layer = service_layer
+        flow.conn.update(time, length, flow.service, flow.service_layer, weight)
+        if time is not None:
+            flow.last_seen = time
+            if self.now is None or time > self.now:
+                self.now = time
+        return flow
+
+    def track(self, flow, ip_src, port_src, flags):
+        from_client = (ip_src, port_src) == (flow.client, flow.client_port)
+        if flags & SYN and not flags & ACK:
+            if flow.state in (CLOSING, CLOSED):
+                # The 5-tuple is being reused for a new session
+                self.closed += 1
+            if flow.conn.count:
+                # Which may not have the same client
+                self.finished.append((flow.connection_key(), flow.conn))
+                flow.conn = aggregate.Accumulator()
+            if not from_client:
+                flow.client, flow.server = flow.server, flow.client
+                flow.client_port, flow.server_port = flow.server_port, flow.client_port
+            flow.guessed = False
+            flow.state = SYN_SENT
+            flow.fins = 0
+        elif flags & RST:
+            flow.state = CLOSED
+        elif flags & FIN:
+            flow.fins |= 1 if from_client else 2
+            flow.state = CLOSED if flow.fins == 3 else CLOSING
+        elif flow.state == SYN_SENT and flags & SYN:
+            flow.state = SYN_RECEIVED
+        elif flow.state == SYN_RECEIVED:
+            flow.state = ESTABLISHED
+
+    def drain(self, agg):
+        '''
+        Adds what every flow has seen since the last drain to agg, then
+        forgets closed and idle flows.
+        '''
+        for key, conn in self.finished:
+            agg.merge_connection(key, conn)
+        self.finished = []
+        for key, flow in list(self.flows.items()):
+            if flow.conn.count:
+                agg.merge_connection(flow.connection_key(), flow.conn)
+                flow.conn = aggregate.Accumulator()
+            if flow.state == CLOSED:
+                del self.flows[key]
+                self.closed += 1
+            elif self.now is not None and flow.last_seen is not None and self.now - flow.last_seen > self.timeout:
+                del self.flows[key]
+                self.expired += 1
+
+    def merge(self, other, agg):
+        '''
+        Continues this table with other, the table of the packets that came
+        after it. Flows other picked up mid-stream, within timeout of their
+        last packet here, are joined onto the flow here and keep its client
+        and server. Flows other saw open again replace the flow here, which
+        is drained into agg first.
+        '''
+        for key, conn in other.finished:
+            agg.merge_connection(key, conn)
+        for key, flow in other.flows.items():
+            mine = self.flows.get(key)
+            if mine is not None and flow.guessed and not self.idle(mine, flow.conn.first_seen):
+                mine.join(flow)
+                other.opened -= 1
+                continue
+            if mine is not None and mine.conn.count:
+                agg.merge_connection(mine.connection_key(), mine.conn)
+            self.flows[key] = flow
+        self.opened += other.opened
+        self.closed += other.closed
+        self.expired += other.expired
+        if other.now is not None and (self.now is None or other.now > self.now):
+            self.now = other.now
+
+    # True if flow would have expired by time
+    def idle(self, flow, time):
+        return time is not None and flow.last_seen is not None and time - flow.last_seen > self.timeout
+
+    def stats(self):
+        return {'flows': len(self.flows), 'opened': self.opened, 'closed': self.closed, 'expired': self.expired}
+
+def flow_key(proto, ip_src, port_src, ip_dst, port_dst):
+    a = (ip_src, port_src)
+    b = (ip_dst, port_dst)
+    if b < a:
+        a, b = b, a
+    return (proto, a, b)
+
+def new_flow(proto, ip_src, port_src, ip_dst, port_dst, flags):
+    if flags is not None:
+        if flags & SYN and not flags & ACK:
+            return Flow(proto, ip_src, port_src, ip_dst, port_dst, SYN_SENT)
+        if flags & SYN:
+            # The SYN was missed, this is the server answering
+            return Flow(proto, ip_dst, port_dst, ip_src, port_src, SYN_RECEIVED)
+        state = CLOSED if flags & RST else ESTABLISHED
+    else:
+        state = UDP
+    # Picked up mid-stream: the lower port is most likely the service
+    if server_side(port_src, port_dst):
+        flow = Flow(proto, ip_dst, port_dst, ip_src, port_src, state)
+    else:
+        flow = Flow(proto, ip_src, port_src, ip_dst, port_dst, state)
+    flow.guessed = True
+    return flow
+
+# True if the source port looks like the server's
+def server_side(port_src, port_dst):
+    try:
+        return int(port_src) < int(port_dst)
+    except (TypeError, ValueError):
+        return False
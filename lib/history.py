@@ -0,0 +1,145 @@
+from array import array
+
+'''
+Time-bucketed packet and byte counts for CONNECTED relationships. Each
+tier has a bucket width and keeps at most max_buckets buckets, dropping
+the oldest, so a fine tier covers recent traffic and a coarse one keeps a
+longer, downsampled view. The default keeps one minute buckets for a day
+and one hour buckets for 30 days.
+
+While a flush is buffered, each connection's Accumulator holds one Series
+per tier. The write merges them into the relationship's properties, for
+a 60 second tier:
+
+    history_60_start    time of the first bucket, in epoch seconds
+    history_60_packets  packets per bucket
+    history_60_bytes    bytes per bucket
+
+Merging happens in Neo4j, so the history stays right across flushes,
+parallel workers, --resume and repeated imports.
+'''
+
+DEFAULT_TIERS = '1m:1440,1h:720'
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# The History in use, None when off
+active = None
+
+class Series:
+    '''
+    Counts for consecutive buckets starting at bucket number start, where
+    bucket number = time // width.
+    '''
+    __slots__ = ('start', 'packets', 'bytes')
+
+    def __init__(self):
+        self.start = None
+        self.packets = array('L')
+        self.bytes = array('Q')
+
+    def __len__(self):
+        return len(self.packets)
+
+    def add(self, bucket, packets, nbytes, max_buckets):
+        if self.start is None:
+            self.start = bucket
+        end = self.start + len(self.packets)
+        if bucket < end - max_buckets:
+            # Older than everything the tier keeps
+            return
+        if bucket < self.start:
+            pad = self.start - bucket
+            self.packets[0:0] = array('L', [0]) * pad
+            self.bytes[0:0] = array('Q', [0]) * pad
+            self.start = bucket
+        elif bucket >= end:
+            self.drop_before(max(self.start, bucket - max_buckets + 1))
+            pad = bucket - (self.start + len(self.packets)) + 1
+            self.packets.extend(array('L', [0]) * pad)
+            self.bytes.extend(array('Q', [0]) * pad)
+        self.packets[bucket - self.start] += packets
+        self.bytes[bucket - self.start] += nbytes
+
+    def drop_before(self, bucket):
+        drop = bucket - self.start
+        del self.packets[:drop]
+        del self.bytes[:drop]
+        self.start = bucket
+
+    def merge(self, other, max_buckets):
+        for i, (packets, nbytes) in enumerate(zip(other.packets, other.bytes)):
+            if packets:
+                self.add(other.start + i, packets, nbytes, max_buckets)
+
+class History:
+    def __init__(self, tiers):
+        # [(width in seconds, max buckets)], finest first
+        self.tiers = sorted(tiers)
+
+    def record(self, conn, time, length, weight=1):
+        if conn.history is None:
+            conn.history = [Series() for _ in self.tiers]
+        for (width, max_buckets), series in zip(self.tiers, conn.history):
+            series.add(int(time // width), weight, (length or 0) * weight, max_buckets)
+
+    def merge(self, conn, other):
+        if other.history is None:
+            return
+        if conn.history is None:
+            conn.history = [Series() for _ in self.tiers]
+        for (width, max_buckets), series, other_series in zip(self.tiers, conn.history, other.history):
+            series.merge(other_series, max_buckets)
+
+    # items: [(connection row, series per tier)] for one label
+    def statements(self, neo4j, label, items):
+        statements = []
+        for i, (width, max_buckets) in enumerate(self.tiers):
+            rows = []
+            for row, history in items:
+                series = history[i]
+                if len(series) == 0:
+                    continue
+                rows.append({
+                    'src': row['src'],
+                    'dst': row['dst'],
+                    'name': row['name'],
+                    'port': row.get('port'),
+                    'protocol': row['protocol'],
+                    'start': series.start,
+                    'packets': series.packets.tolist(),
+                    'bytes': series.bytes.tolist(),
+                })
+            if rows:
+                statements += neo4j.merge_connection_history(label, width, max_buckets, rows)
+        return statements
+
+def parse_tiers(spec):
+    '''
+    Parses tiers like "1m:1440,1h:720" into [(60, 1440), (3600, 720)].
+    Widths without a unit are in seconds.
+    '''
+    tiers = []
+    for tier in spec.split(','):
+        width, sep, max_buckets = tier.strip().partition(':')
+        if not sep:
+            raise ValueError(f'History tier {tier!r} should look like 1m:1440')
+        multiplier = 1
+        if width and width[-1] in UNITS:
+            multiplier = UNITS[width[-1]]
+            width = width[:-1]
+        width = int(width) * multiplier
+        max_buckets = int(max_buckets)
+        if width <= 0 or max_buckets <= 0:
+            raise ValueError(f'History tier {tier!r} needs a positive width and bucket count')
+        tiers.append((width, max_buckets))
+    return tiers
+
+def enable(tiers):
+    global active
+    active = History(tiers)
+    return active
+
+def disable():
+    global active
+    active = None
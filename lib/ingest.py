@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from . import aggregate
+from . import analytics
+from . import metrics
+
+'''
+Asynchronous ingest for pcap files. Reading, dissecting and folding
+packets runs in an executor thread while up to concurrency write
+requests to Neo4j are in flight, so the import is no longer paced by
+one round trip per flush.
+
+Each flush is split by key into one part per partition. Nodes and
+relationships each have an ordered queue and a single writer per
+partition, so writes to the same key are applied in flush order and
+parts written at the same time never touch the same key. A flush's
+relationships are queued once its nodes are written, since they MATCH
+them, while the next flush's nodes can already be written. When the
+writes fall behind, flushes grow instead of queueing up, up to the
+aggregator's memory limit, so each request carries more rows.
+
+Unlike the single transaction of a synchronous flush, the parts commit
+separately, and after a crash some parts of the last flushes can be in
+Neo4j while others aren't. Resuming from any packet would count the
+committed ones twice, so no checkpoint is written and an import with
+async writes can't be resumed.
+'''
+
+# Attempts for each part, as concurrent writes can deadlock on the
+# nodes they share
+RETRIES = 3
+
+# Flushes being written before the packet loop makes its flush bigger
+MAX_PENDING = 2
+
+class AsyncIngest:
+    def __init__(self, pc, neo4j, concurrency=4, max_pending=MAX_PENDING):
+        self.pc = pc
+        self.neo4j = neo4j
+        self.aggregator = pc.aggregator
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix='neo4j')
+        # Checked by the packet loop, set to stop it early
+        self.stopping = threading.Event()
+        # Flushes taken but not yet written. Only changed on the event loop
+        self.in_flight = 0
+        # The first write error, raised by the packet loop
+        self.error = None
+        self.flushes = 0
+        self.retries = 0
+
+    def run(self, packets):
+        try:
+            asyncio.run(self.main(iter(packets)))
+        except BaseException:
+            # Writing whatever was folded after the last written flush
+            # could fail the same way, so it is dropped
+            self.stopping.set()
+            if self.pc.batch is not None:
+                self.pc.batch.clear()
+            self.aggregator.take()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+    async def main(self, packets):
+        loop = asyncio.get_running_loop()
+        self.node_queues = [asyncio.Queue() for _ in range(self.concurrency)]
+        self.relationship_queues = [asyncio.Queue() for _ in range(self.concurrency)]
+        writers = [asyncio.create_task(self.partition_writer(queue))
+                   for queue in self.node_queues + self.relationship_queues]
+        pending = asyncio.Queue(maxsize=self.max_pending)
+        flusher = asyncio.create_task(self.flusher(pending))
+        with concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='dissect') as dissect:
+            try:
+                done = False
+                while not done:
+                    agg, done = await loop.run_in_executor(dissect, self.fold_until_flush, packets)
+                    if self.error is not None:
+                        raise self.error
+                    if len(agg):
+                        self.in_flight += 1
+                        await pending.put(agg)
+                await pending.put(None)
+                await flusher
+                if self.error is not None:
+                    raise self.error
+            finally:
+                self.stopping.set()
+                for writer in writers:
+                    writer.cancel()
+
+    # Runs in the dissect thread
+    def fold_until_flush(self, packets):
+        for packet in packets:
+            if self.stopping.is_set():
+                break
+            self.pc.process(None, packet)
+            if self.ready():
+                self.pc.end_batch(None)
+                return self.aggregator.take(), False
+        self.pc.end_batch(None)
+        return self.aggregator.take(), True
+
+    def ready(self):
+        if not self.aggregator.should_flush():
+            return False
+        if self.in_flight < self.max_pending:
+            return True
+        # The writes are behind, keep folding into a bigger flush
+        limit = self.aggregator.max_memory
+        return limit is not None and self.aggregator.aggregate.size() >= limit
+
+    async def flusher(self, pending):
+        loop = asyncio.get_running_loop()
+        queued = None
+        written = None
+        while True:
+            agg = await pending.get()
+            if agg is None:
+                break
+            if self.error is not None:
+                # Keep taking flushes so the packet loop isn't stuck on a
+                # full queue before it sees the error
+                self.in_flight -= 1
+                continue
+            next_queued = loop.create_future()
+            written = asyncio.ensure_future(self.write(agg, queued, written, next_queued))
+            # The first error is kept in self.error
+            written.add_done_callback(lambda task: task.cancelled() or task.exception())
+            queued = next_queued
+        if written is not None:
+            await asyncio.wait([written])
+
+    # previous_queued and previous_written are the previous flush's, so
+    # relationships are queued and flushes finish in flush order
+    async def write(self, agg, previous_queued, previous_written, queued):
+        try:
+            start = metrics.clock()
+            parts = agg.partition(self.concurrency)
+            nodes = [aggregate.node_statements(self.neo4j, part) for part in parts]
+            relationships = [aggregate.relationship_statements(self.neo4j, part, reduce=self.aggregator.reduce) for part in parts]
+            # The rollup adds up keys from every part, so it is written by a
+            # single partition to keep it in flush order
+            relationships[0] += aggregate.rollup_statements(self.neo4j, agg)
+            if metrics.active is not None:
+                metrics.active.observe('query_build', metrics.clock() - start)
+
+            await wait_all(self.submit(self.node_queues, nodes))
+            if previous_queued is not None:
+                await previous_queued
+            self.check()
+            relationship_writes = self.submit(self.relationship_queues, relationships)
+            queued.set_result(None)
+            await wait_all(relationship_writes)
+            if previous_written is not None:
+                await asyncio.wait([previous_written])
+            self.check()
+            if analytics.active is not None:
+                analytics.active.add_aggregate(agg)
+            self.flushes += 1
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            raise
+        finally:
+            # On errors, the next flush sees self.error once it's queued
+            if not queued.done():
+                queued.set_result(None)
+            self.in_flight -= 1
+
+    # Raises the first write error, so nothing is written after a flush
+    # that failed
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # Queues each partition's statements, returns futures for the writes
+    def submit(self, queues, statements_by_partition):
+        futures = []
+        for queue, statements in zip(queues, statements_by_partition):
+            if statements:
+                future = asyncio.get_running_loop().create_future()
+                queue.put_nowait((statements, future))
+                futures.append(future)
+        return futures
+
+    async def partition_writer(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            statements, future = await queue.get()
+            for attempt in range(RETRIES):
+                try:
+                    await loop.run_in_executor(self.executor, self.neo4j.execute_batch, statements)
+                except Exception as e:
+                    if attempt == RETRIES - 1:
+                        future.set_exception(e)
+                    else:
+                        self.retries += 1
+                        await asyncio.sleep(0.1 * 2 ** attempt)
+                    continue
+                future.set_result(None)
+                break
+
+# Waits for every future, then raises the first error
+async def wait_all(futures):
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
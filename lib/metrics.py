@@ -0,0 +1,186 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+'''
+Per-stage timing for the ingest path. Instrumented code checks the
+module-level active registry first, so nothing is timed unless metrics
+are enabled:
+
+    if metrics.active is not None:
+        start = metrics.clock()
+        ...
+        metrics.active.observe('stage', metrics.clock() - start)
+
+Each stage keeps a count, a total and a latency histogram. Gauges hold
+the latest value of anything else worth watching, like the live capture
+sampling rate. The report can
+be written periodically as JSON or as a Prometheus textfile for
+node_exporter's textfile collector.
+'''
+
+# Histogram bucket upper bounds in seconds, 1us to 10s
+BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FORMATS = ('json', 'prometheus')
+
+clock = time.perf_counter
+
+# The registry in use, None when metrics are off
+active = None
+
+class Stage:
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        # One more than BUCKETS for everything above the last bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile. Past the
+        # last bound it is the last bound, as JSON has no infinity
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= target:
+                return bound
+        return BUCKETS[-1]
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.gauges = {}
+        self.packets = 0
+        self.start = time.time()
+        # Guards creating stages, observing is left unlocked
+        self.lock = threading.Lock()
+        self._writer = None
+        self._stop = threading.Event()
+
+    def observe(self, name, seconds):
+        stage = self.stages.get(name)
+        if stage is None:
+            with self.lock:
+                stage = self.stages.setdefault(name, Stage())
+        stage.observe(seconds)
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    # Wraps an iterable, timing how long each item takes to produce
+    def timed(self, name, iterable):
+        it = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.observe(name, clock() - start)
+            yield item
+
+    def report(self):
+        elapsed = time.time() - self.start
+        stages = {}
+        for name, stage in list(self.stages.items()):
+            stages[name] = {
+                'count': stage.count,
+                'total_seconds': stage.total,
+                'mean_seconds': stage.total / stage.count if stage.count else 0.0,
+                'p50_seconds': stage.percentile(50),
+                'p99_seconds': stage.percentile(99),
+                'buckets': {str(bound): n for bound, n in zip(BUCKETS + ('+Inf',), cumulative(stage.buckets))},
+            }
+        return {
+            'packets': self.packets,
+            'elapsed_seconds': elapsed,
+            'packets_per_second': self.packets / elapsed if elapsed else 0.0,
+            'stages': stages,
+            'gauges': dict(self.gauges),
+        }
+
+    def prometheus(self):
+        report = self.report()
+        lines = [
+            '# HELP netfrenzy_packets_total Packets processed',
+            '# TYPE netfrenzy_packets_total counter',
+            f'netfrenzy_packets_total {report["packets"]}',
+            '# HELP netfrenzy_stage_seconds Time spent in each ingest stage',
+            '# TYPE netfrenzy_stage_seconds histogram',
+        ]
+        for name, stage in sorted(report['stages'].items()):
+            for bound, n in stage['buckets'].items():
+                lines.append(f'netfrenzy_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {n}')
+            lines.append(f'netfrenzy_stage_seconds_sum{{stage="{name}"}} {stage["total_seconds"]}')
+            lines.append(f'netfrenzy_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        for name, value in sorted(report['gauges'].items()):
+            lines.append(f'# TYPE netfrenzy_{name} gauge')
+            lines.append(f'netfrenzy_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        if format == 'prometheus':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2)
+        # Replaced in one step so readers never see a partial file
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    # Writes the report every interval seconds until stop()
+    def start_writer(self, path, format='json', interval=10.0):
+        def run():
+            while not self._stop.wait(interval):
+                self.write(path, format)
+            self.write(path, format)
+        self._writer = threading.Thread(target=run, name='metrics', daemon=True)
+        self._writer.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+
+    def print_summary(self):
+        report = self.report()
+        print(f'{report["packets"]} packets in {report["elapsed_seconds"]:.2f}s ({report["packets_per_second"]:.1f} packets/s)')
+        print(f'{"stage":14} {"count":>10} {"total s":>10} {"mean us":>10} {"p50 us":>10} {"p99 us":>10}')
+        for name, stage in sorted(report['stages'].items(), key=lambda s: -s[1]['total_seconds']):
+            print(f'{name:14} {stage["count"]:10d} {stage["total_seconds"]:10.3f} {stage["mean_seconds"]*1e6:10.1f} '
+                  f'{stage["p50_seconds"]*1e6:10.1f} {stage["p99_seconds"]*1e6:10.1f}')
+        for name, value in sorted(report['gauges'].items()):
+            print(f'{name}: {value}')
+
+def cumulative(counts):
+    total = 0
+    out = []
+    for n in counts:
+        total += n
+        out.append(total)
+    return out
+
+def enable():
+    global active
+    active = Metrics()
+    return active
+
+def disable():
+    global active
+    if active is not None:
+        active.stop()
+    active = None
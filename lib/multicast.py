@@ -1,6 +1,8 @@
 import ipaddress
 import struct
 import socket
+import types
+from functools import lru_cache
 
 # https://www.iana.org/assignments/multicast-addresses/multicast-addresses.xhtml
 
@@ -22,6 +24,8 @@ multicast_cidrs = [
     '229.0.0.0/8',
     '230.0.0.0/8',
     '231.0.0.0/8',
+    '232.0.0.0/8', # Source-specific multicast
+    '233.0.0.0/8', # GLOP and AD-HOC block III
     '233.252.0.0/14',
     '234.0.0.0/8',
     '235.0.0.0/8',
@@ -38,11 +42,108 @@ for cidr in multicast_cidrs:
     mask = int(n.netmask)
     multicast_array.append([cidr, netw, mask])
 
+# Other address classes, as [cidr, network, mask] like multicast_array
+def cidr_array(cidrs):
+    array = []
+    for cidr in cidrs:
+        n = ipaddress.ip_network(cidr)
+        array.append([cidr, int(n.network_address), int(n.netmask)])
+    return array
+
+# IPv6 multicast is a single block, no need for the IANA breakdown
+multicast_array += cidr_array(['ff00::/8'])
+private_array = cidr_array(['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7'])
+link_local_array = cidr_array(['169.254.0.0/16', 'fe80::/10'])
+loopback_array = cidr_array(['127.0.0.0/8', '::1/128'])
+broadcast_array = cidr_array(['255.255.255.255/32'])
+
+# Ranges for each property, split by IP version so a v4 mask is never
+# tested against a v6 address
+class_ranges = {4: [], 6: []}
+for name, array in (('multicast', multicast_array),
+                    ('broadcast', broadcast_array),
+                    ('private', private_array),
+                    ('link_local', link_local_array),
+                    ('loopback', loopback_array)):
+    for version in (4, 6):
+        class_ranges[version].append((name, [e for e in array if (':' in e[0]) == (version == 6)]))
+
+# User-defined site subnets from the config, as
+# [name, network, mask, broadcast, version, prefixlen], most specific first
+site_array = []
+
+def set_sites(sites):
+    '''
+    sites maps a name to a CIDR or a list of CIDRs, like
+    {"hq": "10.1.0.0/16", "dc": ["10.2.0.0/16", "10.3.0.0/16"]}
+    '''
+    global site_array
+    array = []
+    for name, cidrs in sites.items():
+        if isinstance(cidrs, str):
+            cidrs = [cidrs]
+        for cidr in cidrs:
+            n = ipaddress.ip_network(cidr, strict=False)
+            array.append([name, int(n.network_address), int(n.netmask), int(n.broadcast_address), n.version, n.prefixlen])
+    array.sort(key=lambda x: x[5], reverse=True)
+    site_array = array
+    classify_ip.cache_clear()
+
+def ip_int(ip):
+    # Returns (version, integer value), or (None, None) if ip isn't an address
+    try:
+        if ':' in ip:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        return 4, struct.unpack('>I', socket.inet_aton(ip))[0]
+    except (OSError, TypeError):
+        return None, None
+
+def in_array(value, array):
+    for entry in array:
+        if value & entry[2] == entry[1]:
+            return True
+    return False
+
 def ip_multicast(ip):
-    ip = ipaddress.ip_address(ip)
-    return ip.is_multicast
+    return classify_ip(ip)['multicast']
 
 def mac_multicast(mac):
     if int(mac[1], 16) & 0x1 == 0x01:
         return True
     return False
+
+# The classify functions are cached, so every caller gets the same mapping
+# for an address. It is read-only, copy it with dict() to change it
+@lru_cache(maxsize=1 << 16)
+def classify_ip(ip):
+    version, value = ip_int(ip)
+    properties = {
+        'multicast': False,
+        'broadcast': False,
+        'private': False,
+        'link_local': False,
+        'loopback': False,
+    }
+    if version is None:
+        return types.MappingProxyType(properties)
+    for name, array in class_ranges[version]:
+        properties[name] = in_array(value, array)
+    for name, network, mask, broadcast, site_version, prefixlen in site_array:
+        if site_version == version and value & mask == network:
+            properties['site'] = name
+            if version == 4 and value == broadcast and prefixlen < 31:
+                properties['broadcast'] = True
+            break
+    return types.MappingProxyType(properties)
+
+@lru_cache(maxsize=1 << 16)
+def classify_mac(mac):
+    try:
+        first = int(mac[0:2], 16)
+    except (ValueError, TypeError):
+        first = 0
+    return types.MappingProxyType({
+        'multicast': first & 0x01 == 0x01,
+        'broadcast': mac.lower() == 'ff:ff:ff:ff:ff:ff',
+        'local': first & 0x02 == 0x02,
+    })
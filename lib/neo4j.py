@@ -1,12 +1,26 @@
+import collections
 import json
+import time
 import requests
 
+from . import metrics
+
+# Labels written by NetFrenzy, all looked up by name
+SCHEMA_LABELS = ('IP', 'MAC', 'SSID', 'Checkpoint', 'Subnet', 'Vendor')
+
 class Neo4j:
     def __init__(self):
         self.commit = 'http://localhost:7474/db/data/transaction/commit'
         self.auth = None
         self.headers = {'Accept': 'application/json;charset=UTF-8', 'Content-Type': 'application/json'}
         self.debug = False
+        # Keep-alive connection pool shared by every request
+        self.session = requests.Session()
+        # Max rows sent in a single UNWIND statement
+        self.batch_size = 500
+        # Seconds taken by each of the most recent requests
+        self.latencies = collections.deque(maxlen=100000)
+        self.report_latency = False
 
     def set_connection(self, connection):
         self.connection = connection
@@ -14,9 +28,17 @@ class Neo4j:
         self.commit = self.commit.replace('localhost', self.connection.ip)
         self.auth = connection.requests_auth()
 
-    def execute_query(self, query):
-        data = {'statements': [{'statement': query}]}
-        resp = requests.post(self.commit, json=data, auth=self.auth, headers=self.headers)
+    # Enough pooled connections for this many requests at once
+    def set_pool_size(self, size):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def execute_query(self, query, parameters=None):
+        data = {'statements': [{'statement': query, 'parameters': parameters or {}}]}
+        start = time.time()
+        resp = self.session.post(self.commit, json=data, auth=self.auth, headers=self.headers)
+        self.record_latency(time.time() - start)
         if self.debug:
             import pdb; pdb.set_trace()
         try:
@@ -27,36 +49,231 @@ class Neo4j:
             print(f'Response:\t{resp.json()}')
             raise
 
+    # Runs a list of (query, parameters) statements in a single transaction.
+    # quiet leaves reporting errors to the caller
+    def execute_batch(self, statements, quiet=False):
+        if not statements:
+            return []
+        data = {'statements': [{'statement': q, 'parameters': p} for q, p in statements]}
+        start = time.time()
+        resp = self.session.post(self.commit, json=data, auth=self.auth, headers=self.headers)
+        latency = time.time() - start
+        self.record_latency(latency)
+        if self.report_latency:
+            rows = sum(len(p.get('rows', [])) for q, p in statements)
+            print(f'Batch: {len(statements)} statements, {rows} rows in {latency*1000:.1f}ms')
+        if self.debug:
+            import pdb; pdb.set_trace()
+        body = resp.json()
+        if body.get('errors'):
+            if quiet:
+                raise Exception(body['errors'][0].get('message'))
+            print(f'Errors:\t{body["errors"]}')
+            print(f'Statements:\t{[q for q, p in statements]}')
+            raise Exception(body['errors'][0].get('message'))
+        return body['results']
+
+    # Every row of a read query's result, as lists
+    def query_rows(self, query, parameters=None):
+        results = self.execute_batch([(query, parameters or {})])
+        return [data['row'] for data in results[0]['data']]
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+        if metrics.active is not None:
+            metrics.active.observe('neo4j', seconds)
+
+    # Splits rows into UNWIND statements of at most batch_size rows each
+    def unwind(self, query, rows):
+        statements = []
+        for i in range(0, len(rows), self.batch_size):
+            statements.append((query, {'rows': rows[i:i+self.batch_size]}))
+        return statements
+
+    # rows: [{'name': ..., 'properties': {...}}]
+    def merge_nodes(self, label, rows):
+        query = f'UNWIND $rows AS row MERGE (n:{label} {{name: row.name}}) SET n += row.properties'
+        return self.unwind(query, rows)
+
+    # rows: [{'a': name_a, 'b': name_b}]
+    def merge_relationships(self, reltype, label_a, label_b, rows):
+        query = f'''UNWIND $rows AS row
+MATCH (a:{label_a} {{name: row.a}})
+MATCH (b:{label_b} {{name: row.b}})
+MERGE (a)-[r:{reltype}]->(b)'''
+        return self.unwind(query, rows)
+
+    # rows: [{'src', 'dst', 'name', 'port', 'protocol', 'first_seen', 'last_seen', 'data_size', 'count', 'service', 'service_layer'}]
+    # port is only used for IP connections. Every update is in the one SET
+    # of ON MATCH: a SET after it would run for new relationships too
+    def merge_connections(self, label, rows, reduce=False):
+        if label == 'IP':
+            rel = 'CONNECTED {name: row.name, port: row.port, protocol: row.protocol}'
+        else:
+            rel = 'CONNECTED {name: row.name, protocol: row.protocol}'
+        query = f'''UNWIND $rows AS row
+MATCH (n:{label} {{name: row.src}})
+MATCH (m:{label} {{name: row.dst}})
+MERGE (n)-[r:{rel}]->(m)'''
+        if not reduce:
+            query += '''
+    ON CREATE
+        SET r += {first_seen: row.first_seen, last_seen: row.last_seen, data_size: row.data_size, service: row.service, service_layer: row.service_layer, count: row.count}
+    ON MATCH
+        SET r.first_seen = (CASE WHEN row.first_seen > r.first_seen THEN r.first_seen ELSE row.first_seen END),
+            r.last_seen = (CASE WHEN row.last_seen < r.last_seen THEN r.last_seen ELSE row.last_seen END),
+            r.service = (CASE WHEN row.service_layer > r.service_layer THEN row.service ELSE r.service END),
+            r.service_layer = (CASE WHEN row.service_layer > r.service_layer THEN row.service_layer ELSE r.service_layer END),
+            r.data_size = r.data_size + row.data_size,
+            r.count = r.count + row.count'''
+        return self.unwind(query, rows)
+
+    # rows: [{'src', 'dst', 'name', 'port', 'protocol', 'start', 'packets', 'bytes'}]
+    # start is a bucket number (time // width). The buckets are added to
+    # the relationship's, keeping the newest max_buckets. Negative list
+    # indexes count from the end in Cypher, hence the i >= checks
+    def merge_connection_history(self, label, width, max_buckets, rows):
+        if label == 'IP':
+            rel = 'CONNECTED {name: row.name, port: row.port, protocol: row.protocol}'
+        else:
+            rel = 'CONNECTED {name: row.name, protocol: row.protocol}'
+        prop = f'history_{width}'
+        query = f'''UNWIND $rows AS row
+MATCH (n:{label} {{name: row.src}})-[r:{rel}]->(m:{label} {{name: row.dst}})
+WITH r, row, coalesce(r.{prop}_start / {width}, row.start) AS old,
+     coalesce(r.{prop}_packets, []) AS old_packets, coalesce(r.{prop}_bytes, []) AS old_bytes
+WITH r, row, old, old_packets, old_bytes,
+     CASE WHEN old < row.start THEN old ELSE row.start END AS lo,
+     CASE WHEN old + size(old_packets) > row.start + size(row.packets) THEN old + size(old_packets) ELSE row.start + size(row.packets) END AS hi
+WITH r, row, old, old_packets, old_bytes, hi,
+     CASE WHEN hi - {max_buckets} > lo THEN hi - {max_buckets} ELSE lo END AS first
+SET r.{prop}_start = first * {width},
+    r.{prop}_packets = [i IN range(first, hi - 1) |
+        (CASE WHEN i >= old THEN coalesce(old_packets[i - old], 0) ELSE 0 END) +
+        (CASE WHEN i >= row.start THEN coalesce(row.packets[i - row.start], 0) ELSE 0 END)],
+    r.{prop}_bytes = [i IN range(first, hi - 1) |
+        (CASE WHEN i >= old THEN coalesce(old_bytes[i - old], 0) ELSE 0 END) +
+        (CASE WHEN i >= row.start THEN coalesce(row.bytes[i - row.start], 0) ELSE 0 END)]'''
+        return self.unwind(query, rows)
+
+    # rows: [{'src', 'dst', 'first_seen', 'last_seen', 'count', 'data_size'}],
+    # from rollup.Rollup.statements(). One SUBNET_CONNECTED per pair of
+    # subnets, its own type so that CONNECTED queries only see IPs and MACs
+    def merge_subnet_connections(self, rows):
+        query = '''UNWIND $rows AS row
+MATCH (n:Subnet {name: row.src})
+MATCH (m:Subnet {name: row.dst})
+MERGE (n)-[r:SUBNET_CONNECTED]->(m)
+    ON CREATE
+        SET r += {first_seen: row.first_seen, last_seen: row.last_seen, data_size: row.data_size, count: row.count}
+    ON MATCH
+        SET r.first_seen = (CASE WHEN row.first_seen > r.first_seen THEN r.first_seen ELSE row.first_seen END),
+            r.last_seen = (CASE WHEN row.last_seen < r.last_seen THEN r.last_seen ELSE row.last_seen END),
+            r.data_size = r.data_size + row.data_size,
+            r.count = r.count + row.count'''
+        return self.unwind(query, rows)
+
+    # rows: [{'name', 'pagerank', 'community', 'weighted_degree'}], from analytics.Graph.scores()
+    def set_node_scores(self, label, rows):
+        query = f'''UNWIND $rows AS row
+MATCH (n:{label} {{name: row.name}})
+SET n.pagerank = row.pagerank, n.community = row.community, n.weighted_degree = row.weighted_degree'''
+        return self.unwind(query, rows)
+
+    # [src, dst, packets] for every pair of label nodes joined by CONNECTED
+    # relationships, summed over ports like COMMUNICATES. Relationships
+    # written with --reduce have no count and weigh 1
+    def read_connection_totals(self, label):
+        query = f'''MATCH (a:{label})-[r:CONNECTED]->(b:{label})
+RETURN a.name, b.name, sum(coalesce(r.count, 1))'''
+        return self.query_rows(query)
+
+    # The COMMUNICATES relationships the web UI builds before running GDS,
+    # one per pair of nodes with CONNECTED totals over every port
+    def merge_communicates(self):
+        statements = []
+        for label in ('IP', 'MAC'):
+            query = f'''MATCH (r1:{label})-[r3:CONNECTED]->(r2:{label})
+WITH r1, r2, COUNT(*) AS ports, sum(r3.count) AS total, sum(r3.data_size) AS data
+MERGE (r2)<-[r:COMMUNICATES]-(r1)
+SET r.ports = ports, r.total = total, r.data = data'''
+            statements.append((query, {}))
+        return statements
+
+    # row: {'name': file, 'size': bytes, 'packet': last packet written}
+    # Sent in the same transaction as the flush it describes, so the
+    # checkpoint and the data it covers are committed together or not at all
+    def merge_checkpoint(self, row):
+        query = 'MERGE (c:Checkpoint {name: $name}) SET c.packet = $packet, c.size = $size, c.updated = timestamp()'
+        return [(query, row)]
+
+    # Returns (packet, size) from the checkpoint for name, or (None, None)
+    def read_checkpoint(self, name):
+        query = 'OPTIONAL MATCH (c:Checkpoint {name: $name}) RETURN c.packet, c.size'
+        return tuple(self.execute_query(query, {'name': name}))
+
+    def create_schema(self):
+        for label in SCHEMA_LABELS:
+            self.create_name_constraint(label)
+
+    # Unique constraint on label.name, which also indexes it. Falls back to
+    # a plain index if the constraint can't be created, like when the graph
+    # already has duplicate names from older imports
+    def create_name_constraint(self, label):
+        name = f'{label.lower()}_name'
+        constraints = [
+            # Neo4j 4.4+
+            f'CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.name IS UNIQUE',
+            # Neo4j 4.1 - 4.4
+            f'CREATE CONSTRAINT {name} IF NOT EXISTS ON (n:{label}) ASSERT n.name IS UNIQUE',
+            # Neo4j 3.5 - 4.0
+            f'CREATE CONSTRAINT ON (n:{label}) ASSERT n.name IS UNIQUE',
+        ]
+        indexes = [
+            f'CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON (n.name)',
+            f'CREATE INDEX ON :{label}(name)',
+        ]
+        error = self.create_schema_item(constraints)
+        if error is None:
+            return True
+        print(f'Could not create a unique constraint on {label}.name, creating an index instead: {error}')
+        error = self.create_schema_item(indexes)
+        if error is not None:
+            print(f'Could not create an index on {label}.name: {error}')
+        return False
+
+    # Tries each variant of a schema statement until one works. Returns
+    # None on success, otherwise the error from the last one
+    def create_schema_item(self, queries):
+        error = None
+        for query in queries:
+            try:
+                self.execute_batch([(query, {})], quiet=True)
+                return None
+            except Exception as e:
+                if 'already exists' in str(e):
+                    return None
+                error = e
+        return error
+
+    def close(self):
+        self.session.close()
+
     def nuke_all_data(self):
         query = 'MATCH (n) DETACH DELETE n'
         return self.execute_query(query)
     
+    # Merges on the name only, so the name index/constraint is used and a
+    # node whose other properties changed isn't duplicated
     def create_node(self, label, name, properties=None):
         if properties is None:
             properties = {}
         if name is None:
             return
-        if 'name' not in properties:
-            properties['name'] = name
-        prop = '{'
-        for k in properties:
-            prop += f'{k}: '
-            if properties[k] is None or properties[k] == 'None':
-                # Cannot merge on null value, so do not include it at all
-                prop = prop.replace(f'{k}: ', '')
-            elif type(properties[k]) == str:
-                prop += f'"{properties[k]}", '
-            elif type(properties[k]) == int:
-                prop += f'{properties[k]}, '
-            elif type(properties[k]) == bool:
-                prop += f'{str(properties[k]).lower()}, '
-            else:
-                # Not sure what would fall into this else case
-                prop += f'"{properties[k]}", '
-        prop = prop[:-2] # cut off trailing ', '
-        prop += '}'
-        query = f'MERGE (n:{label} {prop}) RETURN id(n)'
-        return self.execute_query(query)
+        # Cannot set a null value, so do not include it at all
+        properties = {k: v for k, v in properties.items() if k != 'name' and v is not None and v != 'None'}
+        query = f'MERGE (n:{label} {{name: $name}}) SET n += $properties RETURN id(n)'
+        return self.execute_query(query, {'name': name, 'properties': properties})
 
     '''
     Deprecated. Use create_node
@@ -69,12 +286,13 @@ class Neo4j:
         query = f'CREATE (n:{label} {properties}) RETURN id(n)'
         return self.execute_query(query)
 
-    def new_relationship(self, name_a, name_b, reltype, relprops=''):
+    # Give the labels so the lookups use the name indexes
+    def new_relationship(self, name_a, name_b, reltype, relprops='', label_a=None, label_b=None):
         query = f'''MATCH
-    (a {{name: "{name_a}"}})
+    ({node('a', label_a)} {{name: "{name_a}"}})
 WITH a
 MATCH
-    (b {{name: "{name_b}"}})
+    ({node('b', label_b)} {{name: "{name_b}"}})
 MERGE (a)-[r:{reltype} {relprops}]->(b)
 RETURN type(r)'''.replace('\n', ' ').replace('    ', ' ').replace('  ', ' ')
         return self.execute_query(query)
@@ -88,16 +306,22 @@ MERGE (a)-[r:{reltype} {relprops}]->(b)
 RETURN type(r)'''.replace('\n', ' ').replace('    ', ' ').replace('  ', ' ')
         return self.execute_query(query)
         
-    def increment_node_property(self, name, _property):
-        query = f'MATCH (n {{name: "{name}"}}) SET n.{_property} = n.{_property} + 1 RETURN n.{_property}'
+    def increment_node_property(self, name, _property, label=None):
+        query = f'MATCH ({node("n", label)} {{name: "{name}"}}) SET n.{_property} = n.{_property} + 1 RETURN n.{_property}'
         return self.execute_query(query)
 
     # Finds a relationship between name_a and name_b with the properties rprop
     # then increments the relationship's _property value
-    def increment_relationship_property(self, name_a, name_b, rprop, _property):
-        query = f'MATCH (n {{name: "{name_a}"}})-[r {rprop}]->(m {{name: "{name_b}"}}) SET r.{_property} = r.{_property} + 1 RETURN r.{_property}'
+    def increment_relationship_property(self, name_a, name_b, rprop, _property, label_a=None, label_b=None):
+        query = f'MATCH ({node("n", label_a)} {{name: "{name_a}"}})-[r {rprop}]->({node("m", label_b)} {{name: "{name_b}"}}) SET r.{_property} = r.{_property} + 1 RETURN r.{_property}'
         return self.execute_query(query)
 
     def raw_query(self, query):
         query = query.replace('\n', ' ').replace('    ', ' ').replace('  ', ' ')
         return self.execute_query(query)
+
+# Node pattern variable, label qualified when the label is known
+def node(var, label=None):
+    if label is None:
+        return var
+    return f'{var}:{label}'
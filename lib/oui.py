@@ -0,0 +1,165 @@
+import csv
+import json
+import os
+import pickle
+import re
+from functools import lru_cache
+
+from ouilookup import OuiLookup
+
+'''
+Manufacturer lookup for MAC addresses. The vendor table is loaded once
+into dicts keyed by the integer value of the 24, 28 and 36-bit prefixes,
+so resolving a MAC is at most three dict lookups instead of the linear
+scan OuiLookup().query() does.
+
+Supported sources:
+ - OuiLookup's JSON data file (the default, bundled with the package)
+ - IEEE oui.txt and the MA-L/MA-M/MA-S CSV files
+ - Wireshark's manuf file
+'''
+
+PREFIX_BITS = (36, 28, 24)
+
+# Wireshark manuf: "00:1B:C5:00:00:00/36<tab>Short<tab>Long name"
+MANUF_LINE = re.compile(r'^([0-9A-Fa-f:.-]+?)(?:/(\d+))?\s+(\S+)(?:\s+(.+))?$')
+# IEEE oui.txt: "00-22-72   (hex)<tab><tab>Company"
+IEEE_LINE = re.compile(r'^([0-9A-Fa-f]{2}-[0-9A-Fa-f]{2}-[0-9A-Fa-f]{2})\s+\(hex\)\s+(.+)$')
+
+class OuiIndex:
+    def __init__(self):
+        self.prefixes = {bits: {} for bits in PREFIX_BITS}
+        self.source = None
+
+    def __len__(self):
+        return sum(len(v) for v in self.prefixes.values())
+
+    def add(self, prefix, bits, vendor):
+        # prefix is a hex string of at least bits/4 digits
+        digits = bits // 4
+        self.prefixes[bits][int(prefix[:digits], 16)] = vendor
+
+    def lookup(self, mac):
+        digits = mac.replace(':', '').replace('-', '').replace('.', '')
+        if len(digits) < 9:
+            return None
+        try:
+            value = int(digits[:9], 16)
+        except ValueError:
+            return None
+        for bits in PREFIX_BITS:
+            vendor = self.prefixes[bits].get(value >> (36 - bits))
+            if vendor is not None:
+                return vendor
+        return None
+
+    def load(self, path):
+        if path.endswith('.json'):
+            self.load_ouilookup(path)
+        elif path.endswith('.csv'):
+            self.load_ieee_csv(path)
+        else:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                head = f.read(4096)
+            if '(hex)' in head:
+                self.load_ieee_txt(path)
+            else:
+                self.load_manuf(path)
+        self.source = path
+
+    def load_ouilookup(self, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        for prefix, vendor in data['vendors'].items():
+            self.add(prefix, len(prefix) * 4, vendor)
+
+    def load_ieee_txt(self, path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                m = IEEE_LINE.match(line.strip())
+                if m:
+                    self.add(m.group(1).replace('-', ''), 24, m.group(2).strip())
+
+    def load_ieee_csv(self, path):
+        # Registry,Assignment,Organization Name,Organization Address
+        with open(path, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0] == 'Registry':
+                    continue
+                prefix = row[1].strip()
+                if len(prefix) * 4 in self.prefixes:
+                    self.add(prefix, len(prefix) * 4, row[2].strip())
+
+    def load_manuf(self, path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                m = MANUF_LINE.match(line)
+                if not m:
+                    continue
+                prefix = re.sub(r'[:.-]', '', m.group(1))
+                bits = int(m.group(2)) if m.group(2) else 24
+                if bits not in self.prefixes:
+                    continue
+                self.add(prefix, bits, (m.group(4) or m.group(3)).strip())
+
+    def save_snapshot(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'source': self.source, 'prefixes': self.prefixes}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_snapshot(self, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        self.source = data['source']
+        self.prefixes = data['prefixes']
+
+def default_source():
+    return OuiLookup().data_file
+
+def build_index(source=None, snapshot=None):
+    '''
+    Loads the vendor table from source (OuiLookup's data file if None).
+    If snapshot is given it is used instead when it is newer than the
+    source, and rewritten otherwise.
+    '''
+    if source is None:
+        source = default_source()
+    index = OuiIndex()
+    if snapshot and os.path.isfile(snapshot):
+        if source is None or not os.path.isfile(source) or os.path.getmtime(snapshot) >= os.path.getmtime(source):
+            index.load_snapshot(snapshot)
+            if source is None or index.source == source:
+                return index
+            index = OuiIndex()
+    if source is None or not os.path.isfile(source):
+        print(f'No OUI data file found, manufacturers will not be resolved')
+        return index
+    index.load(source)
+    if snapshot:
+        index.save_snapshot(snapshot)
+    return index
+
+_index = None
+_source = None
+_snapshot = None
+
+def configure(source=None, snapshot=None):
+    global _index, _source, _snapshot
+    if (source, snapshot) == (_source, _snapshot):
+        return
+    _source = source
+    _snapshot = snapshot
+    _index = None
+    lookup.cache_clear()
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = build_index(_source, _snapshot)
+    return _index
+
+@lru_cache(maxsize=65536)
+def lookup(mac):
+    if mac is None:
+        return None
+    return get_index().lookup(mac)
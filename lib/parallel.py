@@ -0,0 +1,141 @@
+import mmap
+import multiprocessing
+import os
+import tempfile
+import tqdm
+
+from . import aggregate
+from . import filters
+from . import flows
+from . import history
+from . import oui
+from . import pcapfile
+
+# Slices per worker. More than one keeps the workers busy when some
+# slices dissect slower than others, and gives the progress bar something
+# to move on.
+SLICES_PER_WORKER = 4
+
+# Statements per transaction in the final write, so a whole capture is not
+# sent as one request
+STATEMENTS_PER_TRANSACTION = 20
+
+def upload_parallel(pc, neo4j, workers):
+    '''
+    Splits pc.filename into slices, extracts and aggregates each slice in a
+    process pool, merges the results in file order and writes them once.
+    Merging in order keeps ties between services the same as a serial run,
+    and lets flows that cross slices keep the client and server their first
+    slice saw, see flows.FlowTable.merge().
+    '''
+    with open(pc.filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            slices = pcapfile.split(buf, workers * SLICES_PER_WORKER)
+        finally:
+            buf.close()
+    settings = worker_settings(pc)
+    jobs = [(pc.filename, piece, settings) for piece in slices]
+    total = sum(piece.packets for piece in slices)
+    print(f'Processing {total} packets in {len(slices)} slices with {workers} workers')
+
+    merged = aggregate.Aggregate()
+    merged.last_packet = total
+    with multiprocessing.Pool(workers) as pool:
+        with tqdm.tqdm(total=total) as progress:
+            for agg, table in pool.imap(process_slice, jobs):
+                merged.merge(agg)
+                if table is not None:
+                    pc.flows.merge(table, merged)
+                progress.update(agg.packets)
+    if pc.flows is not None:
+        pc.flows.drain(merged)
+
+    print(f'Writing {len(merged)} nodes and relationships')
+    pc.debug_time_start()
+    # The checkpoint goes in the last transaction, so only a completed
+    # write is recorded. An interrupted one has to be started over
+    aggregate.write_aggregate(neo4j, merged, reduce=pc.reduce,
+                              statements_per_transaction=STATEMENTS_PER_TRANSACTION,
+                              checkpoint=pc.checkpoint)
+    pc.debug_time_end()
+
+# What a worker process needs from pc to process packets the same way
+def worker_settings(pc):
+    return {
+        'reduce': pc.reduce,
+        'fast': pc.fast,
+        'ignore': pc.ignore,
+        'cache_max': pc.cache_max,
+        'cache_sizes': pc.cache_sizes,
+        'oui_source': oui._source,
+        'oui_snapshot': oui._snapshot,
+        'history': history.active.tiers if history.active is not None else None,
+        'flow_timeout': pc.flows.timeout if pc.flows is not None else None,
+        'drop': filters.active,
+        'display_filter': pc.display_filter,
+        'profile': pc.profile,
+        'batch_size': pc.batch_size,
+    }
+
+def process_slice(job):
+    # Runs in a worker process
+    filename, piece, settings = job
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+    try:
+        with os.fdopen(fd, 'wb') as out, open(filename, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pcapfile.write_slice(buf, piece, out)
+            finally:
+                buf.close()
+        return aggregate_file(path, settings, keep_flows=True)
+    finally:
+        os.remove(path)
+
+def aggregate_file(filename, settings, skip=0, keep_flows=False):
+    '''
+    Extracts and aggregates every packet of filename after the first skip,
+    without writing anything. Runs in a worker process. The aggregate's
+    last_packet is the number of the last packet read, including dropped
+    ones, or None if there were none after skip. With keep_flows,
+    returns (aggregate, flow table) with the flows left out of the
+    aggregate, or None for the table without --flows.
+    '''
+    # Imported here to avoid a circular import
+    from .pcap import Pcap
+    # A no-op when the index was inherited from the parent process
+    oui.configure(settings['oui_source'], settings['oui_snapshot'])
+    if settings['history'] is not None:
+        history.enable(settings['history'])
+    if settings['drop'] is not None:
+        filters.enable(settings['drop'])
+    pc = Pcap(filename, None, fast=settings['fast'], display_filter=settings['display_filter'], profile=settings['profile'])
+    pc.reduce = settings['reduce']
+    pc.ignore = settings['ignore']
+    pc.cache_max = settings['cache_max']
+    pc.cache_sizes = settings['cache_sizes']
+    pc.cache_init()
+    pc.batch_size = settings['batch_size']
+    if skip:
+        pc.skip_packets(skip)
+    # Never flushes, the caller writes everything at the end
+    pc.aggregator = aggregate.Aggregator(reduce=pc.reduce, max_packets=None, max_memory=None, max_seconds=None)
+    if settings['flow_timeout'] is not None:
+        pc.flows = flows.FlowTable(settings['flow_timeout'])
+        pc.aggregator.flows = pc.flows
+    pc.prepare_capture()
+    packet = None
+    for packet in pc.cap:
+        pc.process(None, packet)
+    pc.end_batch(None)
+    pc.cap.close()
+    if keep_flows:
+        pc.aggregator.flows = None
+    # Otherwise take() also drains the flow table
+    agg = pc.aggregator.take()
+    if packet is not None:
+        agg.last_packet = int(packet.number)
+    if keep_flows:
+        return agg, pc.flows
+    return agg
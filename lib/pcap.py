@@ -1,52 +1,194 @@
-from collections import deque
+import os
+import re
 import time
 import tqdm
 
 import pyshark
-from ouilookup import OuiLookup
 
+from . import cache
+from . import filters
+from . import history
+from . import ingest
+from . import metrics
 from . import multicast
+from . import oui
+from . import parallel
+from . import pipeline
+from . import pcapfile
+from . import profiles
+from . import records
+from . import rotation
+from . import sampling
+
+CACHE_TYPES = ('IP', 'MAC', 'ASSIGN', 'SSID', 'ADVERTISES', 'PROBES', 'PROBE_RESPONSE')
+
+# Works on pyshark's XML and JSON layers and on pcapfile's
+get_field = pcapfile.get_field
+
+HEX_BYTES = re.compile(r'^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2})+$')
 
 class Pcap:
-    def __init__(self, pcap_filename, interface, keep_packets=False):
+    # bpf_filter is a capture filter for live captures, display_filter a
+    # Wireshark display filter for either. Both are applied by tshark, with
+    # the dissection profile named by profile, see profiles.py
+    def __init__(self, pcap_filename, interface, keep_packets=False, fast=False, bpf_filter=None, display_filter=None,
+                 profile=profiles.DEFAULT):
         self.filename = pcap_filename
         self.interface = interface
-        if self.filename:
-            self.cap = pyshark.FileCapture(self.filename, keep_packets=keep_packets)
+        self.fast = fast
+        self.keep_packets = keep_packets
+        self.display_filter = display_filter
+        self.profile = profile
+        self.tshark_options = profiles.capture_options(profile)
+        if self.filename and fast and display_filter:
+            print('--display-filter needs tshark to read every packet, ignoring --fast')
+            self.fast = False
+        if self.filename and self.fast and pcapfile.is_supported(self.filename):
+            self.cap = pcapfile.FastCapture(self.filename, keep_packets=keep_packets)
+            self.cap.tshark_options = self.tshark_options
+        elif self.filename:
+            self.cap = pyshark.FileCapture(self.filename, keep_packets=keep_packets, display_filter=display_filter,
+                                           **self.tshark_options)
         elif self.interface:
-            self.cap = pyshark.LiveCapture(interface=self.interface)
+            self.cap = pyshark.LiveCapture(interface=self.interface, bpf_filter=bpf_filter, display_filter=display_filter,
+                                           **self.tshark_options)
         self.ignore = []
         self.count = None
         self.do_count = True
+        # packets or bytes
+        self.progress = 'packets'
         self.debug_at = -2
         self.debug_time = False
         self._time_start = 0
         self.debug_time_neo4j = 0
         self.total_time_start = time.time()
-        self.total_time_netfrenzy = 0
         self.debug_cache = False
         self.cache = {}
-        self.cache_max = 0
+        self.cache_max = 100000
+        # Per-type overrides of cache_max
+        self.cache_sizes = {}
         self.cache_init()
         self.reduce = False
+        self.aggregator = None
+        # Packets extracted before they are folded into the aggregator
+        # together, see records.py
+        self.batch_size = records.DEFAULT_BATCH_SIZE
+        self.batch = None
+        # flows.FlowTable, shared with the aggregator, which drains it on
+        # every flush
+        self.flows = None
+        self.workers = 1
+        # Neo4j writes in flight at once, more than 1 uses ingest.AsyncIngest
+        self.write_concurrency = 1
+        # Keyword arguments for pipeline.Pipeline in live captures
+        self.pipeline_options = {}
+        # Live captures: adaptive, full or reduce, see begin_capture()
+        self.live_detail = 'adaptive'
+        # Continue from the file's checkpoint in Neo4j
+        self.resume = False
+        # {'name': ..., 'size': ...} of the file being checkpointed
+        self.checkpoint = None
+        # Packets already written by an earlier run
+        self.skip = 0
+        # Directory or glob of captures to import instead of a single file
+        self.directory = None
+        # Seconds between polls of directory for new files, None to stop
+        # once the files already there are imported
+        self.watch = None
+        self.settle = rotation.SETTLE_SECONDS
 
     def start_process(self, neo4j):
-        if self.filename:
-            self.upload_to_neo4j(neo4j)
-        elif self.interface:
-            self.begin_capture(neo4j)
+        try:
+            if self.directory:
+                rotation.Rotation(self, neo4j, self.directory, workers=self.workers,
+                                  watch=self.watch, settle=self.settle).run()
+                self.print_debug_time()
+                return
+            if self.filename:
+                self.init_checkpoint(neo4j)
+            if self.filename and self.workers > 1 and self.skip:
+                print('Resuming a checkpoint runs in a single process')
+            if self.filename and self.workers > 1 and not self.skip and pcapfile.is_supported(self.filename):
+                parallel.upload_parallel(self, neo4j, self.workers)
+                self.print_debug_time()
+            elif self.filename:
+                self.upload_to_neo4j(neo4j)
+            elif self.interface:
+                self.begin_capture(neo4j)
+        except KeyboardInterrupt:
+            # Don't lose whatever is still buffered
+            self.flush(neo4j)
+            if self.checkpoint is not None:
+                print('Run again with --resume to continue from the last checkpoint')
+            raise
+
+    def init_checkpoint(self, neo4j):
+        # Checkpoints are written with the aggregator's flushes
+        if self.aggregator is None or not hasattr(neo4j, 'read_checkpoint'):
+            if self.resume:
+                print('--resume needs aggregated writes to Neo4j, starting from the first packet')
+            return
+        # The parts of an --async-writes flush commit separately, so there
+        # is no packet that everything before was written up to
+        if self.write_concurrency > 1:
+            if self.resume:
+                print('--resume needs synchronous writes, starting from the first packet')
+            return
+        name = os.path.abspath(self.filename)
+        size = os.path.getsize(self.filename)
+        self.checkpoint = {'name': name, 'size': size}
+        self.aggregator.checkpoint = self.checkpoint
+        packet, saved_size = neo4j.read_checkpoint(name)
+        if packet is None:
+            return
+        if not self.resume:
+            print(f'{self.filename} was imported up to packet {packet} before. Use --resume to continue from there')
+            return
+        if saved_size != size:
+            raise ValueError(f'{self.filename} is {size} bytes but was {saved_size} bytes at its checkpoint')
+        print(f'Resuming after packet {packet}')
+        self.skip_packets(packet)
+
+    def skip_packets(self, count):
+        self.skip = count
+        if isinstance(self.cap, pcapfile.FastCapture):
+            self.cap.skip = count
+        else:
+            # Frame numbers are kept under a display filter
+            display_filter = f'frame.number > {count}'
+            if self.display_filter:
+                display_filter = f'({self.display_filter}) && {display_filter}'
+            self.cap.close()
+            self.cap = pyshark.FileCapture(self.filename, keep_packets=self.keep_packets,
+                                           display_filter=display_filter, **self.tshark_options)
+
+    def prepare_capture(self):
+        if isinstance(self.cap, pcapfile.FastCapture):
+            # get_service() needs tshark's layers for anything with a payload
+            self.cap.dissect_payloads = not self.reduce
+            if self.flows is not None:
+                # but not once the flow's service is known
+                self.cap.payload_filter = self.needs_service
+            if filters.active is not None:
+                # Dropped before tshark is asked for anything
+                self.cap.packet_filter = filters.active.drop
 
     def upload_to_neo4j(self, neo4j):
-        if self.do_count and self.count is None:
-            print('Counting packets in pcap. Takes approx 1ms/packet')
-            self.count = 0
-            for c in self.cap:
-                self.count += 1
-        cap_iter = None
-        if self.do_count or self.count:
-            cap_iter = tqdm.tqdm(self.cap, total=self.count)
+        self.prepare_capture()
+        if self.progress == 'bytes' and pcapfile.is_supported(self.filename):
+            cap_iter = pcapfile.ByteProgress(self.cap, self.filename)
         else:
-            cap_iter = tqdm.tqdm(self.cap)
+            cap_iter = self.count_progress()
+
+        if metrics.active is not None:
+            # Time spent waiting on the capture for the next packet
+            cap_iter = metrics.active.timed('dissect', cap_iter)
+
+        if self.write_concurrency > 1 and self.aggregator is not None and not hasattr(neo4j, 'write_aggregate'):
+            ingest.AsyncIngest(self, neo4j, self.write_concurrency).run(cap_iter)
+            self.print_debug_time()
+            self.print_cache_stats()
+            return
 
         debug_count = 0
         for packet in cap_iter:
@@ -56,56 +198,257 @@ class Pcap:
                 neo4j.debug = False
             self.process(neo4j, packet)
             debug_count += 1
+        self.flush(neo4j)
 
         self.print_debug_time()
         self.print_cache_stats()
 
+    def count_progress(self):
+        if self.do_count and self.count is None:
+            if pcapfile.is_supported(self.filename):
+                self.count = pcapfile.count_packets(self.filename)
+            else:
+                print('Counting packets in pcap. Takes approx 1ms/packet')
+                # The capture already leaves out skipped packets
+                self.count = self.skip
+                for c in self.cap:
+                    self.count += 1
+        if self.do_count or self.count:
+            return tqdm.tqdm(self.cap, total=max(self.count - self.skip, 0))
+        return tqdm.tqdm(self.cap)
+
+    # adaptive records everything while ingest keeps up and samples repeat
+    # packets when it falls behind. It needs the aggregator, so without one
+    # it falls back to reduce
     def begin_capture(self, neo4j):
-        if not self.reduce:
+        detail = self.live_detail
+        if detail == 'adaptive' and self.aggregator is None:
+            detail = 'reduce'
+        if detail == 'reduce' and not self.reduce:
             self.reduce = True
             print('Enabling --reduce to ensure NetFrenzy keeps up with live capture')
+            if self.aggregator is not None:
+                self.aggregator.reduce = True
 
-        for packet in self.cap.sniff_continuously():
-            self.process(neo4j, packet)
+        if self.aggregator is None:
+            for packet in self.cap.sniff_continuously():
+                self.process(neo4j, packet)
+            return
+
+        sampler = None
+        if detail == 'adaptive':
+            sampler = sampling.Sampler(max_flows=self.cache_max)
+        live = pipeline.Pipeline(self, neo4j, sampler=sampler, **self.pipeline_options)
+        live.run(self.cap.sniff_continuously())
+
+    def flush(self, neo4j):
+        self.end_batch(neo4j)
+        if self.aggregator is not None:
+            self.debug_time_start()
+            self.aggregator.flush(neo4j)
+            self.debug_time_end()
 
     def process(self, neo4j, packet):
-        proto = get_protocol(packet)
-        macs = get_macs(packet, cached=self.is_cached)
+        if self.aggregator is None:
+            # Every packet is written as it is folded, so don't hold any back
+            if not self.filtered(packet):
+                self.fold(neo4j, self.extract(packet))
+            return
+        batch = self.batch
+        if batch is None:
+            batch = self.batch = records.RecordBatch(self.batch_size)
+        if self.checkpoint is not None:
+            batch.last_packet = int(packet.number)
+        if not self.filtered(packet):
+            batch.append(self.extract(packet, batch.record))
+            if batch.full():
+                self.end_batch(neo4j)
+
+    # Folds the packets process() is holding. Call before taking the
+    # aggregate, so it contains every packet read
+    def end_batch(self, neo4j):
+        batch = self.batch
+        if batch is None or (not len(batch) and batch.last_packet is None):
+            return
+        self.enrich(batch)
+        self.fold_batch(neo4j, batch)
+        batch.clear()
+
+    # True if the drop rules in filters.active match the packet. Packets
+    # FastCapture decoded natively have already been through them
+    def filtered(self, packet):
+        if filters.active is None or isinstance(packet, pcapfile.Packet):
+            return False
+        return filters.active.drop(packet)
+
+    def flow_key(self, packet):
+        return get_flow_key(packet)
+
+    # Whether get_service() could still tell something new about the
+    # packet's flow. Always true without the flow table
+    def needs_service(self, packet):
+        if self.flows is None:
+            return True
         ip_src, ip_dst = get_ips(packet)
         port_src, port_dst = get_ports(packet)
-        ssid, frame_type = get_ssid(packet)
-        time, length, service, service_layer = None, None, None, None
-        if not self.reduce:
-            time = get_time(packet)
-            length = get_length(packet)
-            service, service_layer = get_service(packet)
+        if None in (ip_src, port_src):
+            return True
+        return self.flows.needs_service(get_protocol(packet), ip_src, port_src, ip_dst, port_dst)
+
+    # Timestamps and lengths are needed even when reduced to keep history
+    # and to expire flows
+    def needs_time(self):
+        return not self.reduce or history.active is not None or self.flows is not None
+
+    # Everything process() needs from the packet, as a records.PacketRecord.
+    # Fills record if given, instead of a new one. Doesn't touch the caches,
+    # so it can run outside whatever serializes fold()
+    def extract(self, packet, record=None):
+        if record is None:
+            record = records.PacketRecord()
+        if metrics.active is not None:
+            return self.extract_timed(packet, record)
+        record.proto = proto = get_protocol(packet)
+        record.mac_src, record.mac_dst, record.mac_tra, record.mac_rec = get_mac_addresses(packet)
+        record.ip_src, record.ip_dst = ip_src, ip_dst = get_ips(packet)
+        record.port_src, record.port_dst = port_src, port_dst = get_ports(packet)
+        record.ssid, record.frame_type = get_ssid(packet)
+        record.time, record.length, record.service, record.service_layer = None, None, None, None
+        if self.needs_time():
+            record.time = get_time(packet)
+            record.length = get_length(packet)
+        if not self.reduce and (self.flows is None or self.flows.needs_service(proto, ip_src, port_src, ip_dst, port_dst)):
+            record.service, record.service_layer = get_service(packet)
+        record.tcp_flags = get_tcp_flags(packet) if self.flows is not None else None
+        record.weight = 1
+        return record
+
+    # extract() with every get_* timed separately
+    def extract_timed(self, packet, record):
+        observe = metrics.active.observe
+        clock = metrics.clock
+        t0 = clock()
+        record.proto = proto = get_protocol(packet)
+        t1 = clock()
+        observe('get_protocol', t1 - t0)
+        record.mac_src, record.mac_dst, record.mac_tra, record.mac_rec = get_mac_addresses(packet)
+        t0 = clock()
+        observe('get_macs', t0 - t1)
+        record.ip_src, record.ip_dst = ip_src, ip_dst = get_ips(packet)
+        t1 = clock()
+        observe('get_ips', t1 - t0)
+        record.port_src, record.port_dst = port_src, port_dst = get_ports(packet)
+        t0 = clock()
+        observe('get_ports', t0 - t1)
+        record.ssid, record.frame_type = get_ssid(packet)
+        t1 = clock()
+        observe('get_ssid', t1 - t0)
+        record.time, record.length, record.service, record.service_layer = None, None, None, None
+        if self.needs_time():
+            record.time = get_time(packet)
+            t0 = clock()
+            observe('get_time', t0 - t1)
+            record.length = get_length(packet)
+            t1 = clock()
+            observe('get_length', t1 - t0)
+        if not self.reduce and (self.flows is None or self.flows.needs_service(proto, ip_src, port_src, ip_dst, port_dst)):
+            record.service, record.service_layer = get_service(packet)
+            t0 = clock()
+            observe('get_service', t0 - t1)
+            t1 = t0
+        record.tcp_flags = None
+        if self.flows is not None:
+            record.tcp_flags = get_tcp_flags(packet)
+            observe('get_tcp_flags', clock() - t1)
+        record.weight = 1
+        return record
+
+    # Looks up the manufacturer of every MAC in batch that isn't cached yet,
+    # once each. Like extract(), it can run outside whatever serializes fold()
+    def enrich(self, batch):
+        for mac in batch.macs():
+            if mac not in batch.vendors and not self.in_cache(mac, 'MAC'):
+                batch.vendors[mac] = get_oui(mac)
+
+    def fold(self, neo4j, record):
+        if metrics.active is not None:
+            start = metrics.clock()
 
         # Create/merge nodes for the IP addresses
-        self.create_ip(neo4j, ip_src)
-        self.create_ip(neo4j, ip_dst)
+        self.create_ip(neo4j, record.ip_src)
+        self.create_ip(neo4j, record.ip_dst)
 
         # Create/merge nodes for the MAC addresses
-        self.create_macs(neo4j, macs)
+        self.create_macs(neo4j, record.macs())
 
         # Assign the IP addresses to the MAC addresses
-        self.create_mac_assignment(neo4j, ip_src, macs['src']['mac'])
-        self.create_mac_assignment(neo4j, ip_dst, macs['dst']['mac'])
+        self.create_mac_assignment(neo4j, record.ip_src, record.mac_src)
+        self.create_mac_assignment(neo4j, record.ip_dst, record.mac_dst)
+
+        self.fold_connections(neo4j, record)
+
+        if metrics.active is not None:
+            metrics.active.packets += 1
+            metrics.active.observe('fold', metrics.clock() - start)
+
+        if self.aggregator is not None:
+            self.debug_time_start()
+            self.aggregator.packet(neo4j)
+            self.debug_time_end()
+
+    # Folds a records.RecordBatch that enrich() has been through. Nodes and
+    # MAC assignments only go through the caches once per distinct value in
+    # the batch, and the aggregator's thresholds are checked once for the
+    # whole batch
+    def fold_batch(self, neo4j, batch):
+        if metrics.active is not None:
+            start = metrics.clock()
+
+        for ip in batch.ips():
+            self.create_ip(neo4j, ip)
+        self.create_macs(neo4j, batch.macs(), batch.vendors)
+        for ip, mac in batch.assignments():
+            self.create_mac_assignment(neo4j, ip, mac)
+
+        for record in batch:
+            self.fold_connections(neo4j, record)
+
+        if self.checkpoint is not None and batch.last_packet is not None:
+            self.aggregator.aggregate.last_packet = batch.last_packet
+        if metrics.active is not None:
+            metrics.active.packets += len(batch)
+            metrics.active.observe('fold', metrics.clock() - start)
+
+        if self.aggregator is not None:
+            self.debug_time_start()
+            self.aggregator.packet(neo4j, len(batch))
+            self.debug_time_end()
+
+    # The connections and SSID relationships of one packet
+    def fold_connections(self, neo4j, record):
+        ip_src, ip_dst = record.ip_src, record.ip_dst
+        mac_src, mac_dst = record.mac_src, record.mac_dst
+        proto, time, length = record.proto, record.time, record.length
+        service, service_layer, weight = record.service, record.service_layer, record.weight
 
         # Create or update the connection relationship for the packet
-        if None not in (ip_src, ip_dst):
+        if self.flows is not None and None not in (ip_src, ip_dst, record.port_src):
+            # Both directions of a TCP/UDP flow update one connection
+            self.flows.update(proto, ip_src, record.port_src, ip_dst, record.port_dst, record.tcp_flags, time, length, service, service_layer, weight)
+        elif None not in (ip_src, ip_dst):
             # Create a connection between IP addresses
-            self.create_connection_ip(neo4j, ip_src, ip_dst, port_dst, proto, time, length, service, service_layer)
-        elif None not in (macs['src']['mac'], macs['dst']['mac']):
+            self.create_connection_ip(neo4j, ip_src, ip_dst, record.port_dst, proto, time, length, service, service_layer, weight)
+        elif None not in (mac_src, mac_dst):
             # Create a connection between MAC addresses
-            self.create_connection_mac(neo4j, macs['src']['mac'], macs['dst']['mac'], proto, time, length, service, service_layer, frame_type)
-        if None not in (macs['src']['mac'], macs['dst']['mac'], macs['tra']['mac'], macs['rec']['mac']):
+            self.create_connection_mac(neo4j, mac_src, mac_dst, proto, time, length, service, service_layer, record.frame_type, weight)
+        if None not in (mac_src, mac_dst, record.mac_tra, record.mac_rec):
             # Create a connection between MAC addresses
             # This is for wlan frames that have ra and ta
             # We are connecting the sender to transmitter, receiver to destination
-            self.create_connection_mac(neo4j, macs['src']['mac'], macs['tra']['mac'], proto, time, length, service, service_layer, frame_type)
-            self.create_connection_mac(neo4j, macs['rec']['mac'], macs['dst']['mac'], proto, time, length, service, service_layer, frame_type)
+            self.create_connection_mac(neo4j, mac_src, record.mac_tra, proto, time, length, service, service_layer, record.frame_type, weight)
+            self.create_connection_mac(neo4j, record.mac_rec, mac_dst, proto, time, length, service, service_layer, record.frame_type, weight)
 
-        self.create_ssid(neo4j, ssid, frame_type, macs['src']['mac'])
+        self.create_ssid(neo4j, record.ssid, record.frame_type, mac_src)
 
     def debug_time_start(self):
         if self.debug_time:
@@ -117,123 +460,101 @@ class Pcap:
             self.debug_time_neo4j += _time_end - self._time_start
 
     def print_debug_time(self):
-        self.debug_time_neo4j = time.time()
-        if self.debug_time:
-            print(f'Time in Neo4j: {self.debug_time_neo4j}')
-            print(f'Total time: {self.total_time_start - self.total_time_netfrenzy}')
-            print(f'Difference: {self.total_time_start - self.total_time_netfrenzy - self.debug_time_neo4j}')
+        if not self.debug_time:
+            return
+        total = time.time() - self.total_time_start
+        print(f'Time in Neo4j: {self.debug_time_neo4j:.3f}s')
+        print(f'Total time: {total:.3f}s')
+        print(f'Difference: {total - self.debug_time_neo4j:.3f}s')
+        if metrics.active is not None:
+            metrics.active.print_summary()
 
     def cache_init(self):
-        self.cache = {
-            'IP': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'MAC': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'ASSIGN': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'SSID': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'ADVERTISES': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'PROBES': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-            'PROBE_RESPONSE': {
-                'cache': deque([]),
-                'hits': 0,
-                'misses': 0,
-            },
-        }
-        self.cache_max = 50
+        self.cache = {}
+        for _type in CACHE_TYPES:
+            size = self.cache_sizes.get(_type, self.cache_max)
+            self.cache[_type] = cache.LRUCache(size)
 
     def print_cache_stats(self):
         if not self.debug_cache:
             return
-        keys = ['IP', 'MAC', 'ASSIGN', 'SSID', 'ADVERTISES', 'PROBES']
         print(f'cache_max: {self.cache_max}')
-        for k in keys:
+        for k in CACHE_TYPES:
+            c = self.cache[k]
             print(f'cache[{k}]:')
-            print(f'\tHits:\t{self.cache[k]["hits"]}')
-            print(f'\tMiss:\t{self.cache[k]["misses"]}')
-            print(f'\tUse:\t{len(self.cache[k]["cache"])}/{self.cache_max}')
+            print(f'\tHits:\t{c.hits}')
+            print(f'\tMiss:\t{c.misses}')
+            print(f'\tEvict:\t{c.evictions}')
+            print(f'\tUse:\t{len(c)}/{c.maxsize}')
 
     def cached(self, value, _type):
-        is_cached = False
-        if value in self.cache[_type]['cache']:
-            is_cached = True
-            self.cache[_type]['hits'] += 1
-        else:
-            self.cache[_type]['misses'] += 1
-            self.cache[_type]['cache'].append(value)
-            if len(self.cache[_type]['cache']) > self.cache_max:
-                self.cache[_type]['cache'].popleft()
-        return is_cached
+        if metrics.active is None:
+            return self.cache[_type].check(value)
+        start = metrics.clock()
+        hit = self.cache[_type].check(value)
+        metrics.active.observe('cache', metrics.clock() - start)
+        return hit
 
     # Like cached(), but doesn't update cache
     def is_cached(self, value, _type):
-        cached = False
-        if value in self.cache[_type]['cache']:
-            cached = True
-            self.cache[_type]['hits'] += 1
-        else:
-            self.cache[_type]['misses'] += 1
-        return cached
+        return self.cache[_type].lookup(value)
+
+    # Like is_cached(), but doesn't count towards the stats either
+    def in_cache(self, value, _type):
+        return value in self.cache[_type]
 
     def create_ip(self, neo4j, ip):
         if ip is None:
             return
         if self.cached(ip, 'IP'):
             return
-        properties = {}
-        properties['multicast'] = multicast.ip_multicast(ip)
+        if self.aggregator is not None:
+            # Classified when the aggregate is written
+            self.aggregator.aggregate.add_node('IP', ip)
+            return
+        properties = dict(multicast.classify_ip(ip))
         self.debug_time_start()
         neo4j.create_node('IP', ip, properties=properties)
         self.debug_time_end()
     
-    def create_macs(self, neo4j, macs):
+    # vendors is {mac: manufacturer} from enrich(), anything missing is
+    # looked up here
+    def create_macs(self, neo4j, macs, vendors=None):
         if macs is None:
             return
-        for k in macs:
-            mac = macs[k]['mac']
+        for mac in macs:
             if mac is None:
                 continue
             if self.cached(mac, 'MAC'):
                 continue
-            oui = macs[k]['oui']
             properties = {}
-            properties['manufacturer'] = oui
-            properties['multicast'] = multicast.mac_multicast(mac)
+            if vendors is not None and mac in vendors:
+                properties['manufacturer'] = vendors[mac]
+            else:
+                properties['manufacturer'] = get_oui(mac)
+            if self.aggregator is not None:
+                self.aggregator.aggregate.add_node('MAC', mac, properties)
+                continue
+            properties.update(multicast.classify_mac(mac))
             self.debug_time_start()
             neo4j.create_node('MAC', mac, properties=properties)
             self.debug_time_end()
     
     def create_mac_assignment(self, neo4j, ip, mac):
         if mac not in self.ignore and ip is not None:
-            if self.cached([ip, mac], 'ASSIGN'):
+            if self.cached((ip, mac), 'ASSIGN'):
+                return
+            if self.aggregator is not None:
+                self.aggregator.aggregate.add_relationship('ASSIGNED', ip, mac)
                 return
             self.debug_time_start()
-            neo4j.new_relationship(ip, mac, 'ASSIGNED')
+            neo4j.new_relationship(ip, mac, 'ASSIGNED', label_a='IP', label_b='MAC')
             self.debug_time_end()
     
-    def create_connection_ip(self, neo4j, ip_src, ip_dst, port_dst, proto, time, length, service, service_layer):
-        if self.reduce:
+    def create_connection_ip(self, neo4j, ip_src, ip_dst, port_dst, proto, time, length, service, service_layer, weight=1):
+        if self.aggregator is not None:
+            self.aggregator.aggregate.add_connection('IP', ip_src, ip_dst, port_dst, proto, time, length, service, service_layer, weight)
+        elif self.reduce:
             self.create_connection_ip_reduced(neo4j, ip_src, ip_dst, port_dst, proto)
         else:
             self.create_connection_ip_full(neo4j, ip_src, ip_dst, port_dst, proto, time, length, service, service_layer)
@@ -249,9 +570,10 @@ class Pcap:
         ON CREATE
             SET r += {{first_seen: {time}, last_seen: {time}, data_size: {length}, service: "{service}", service_layer: {service_layer}, count: 1}}
         ON MATCH
-            SET r.first_seen = (CASE WHEN {time} > r.first_seen THEN r.first_seen ELSE {time} END)
-            SET r.last_seen = (CASE WHEN {time} < r.last_seen THEN r.last_seen ELSE {time} END)
-            SET r += {{data_size: r.data_size+{length}, count: r.count+1}}
+            SET r.first_seen = (CASE WHEN {time} > r.first_seen THEN r.first_seen ELSE {time} END),
+                r.last_seen = (CASE WHEN {time} < r.last_seen THEN r.last_seen ELSE {time} END),
+                r.data_size = r.data_size + {length},
+                r.count = r.count + 1
     return r'''
         self.debug_time_start()
         neo4j.raw_query(query)
@@ -280,10 +602,12 @@ class Pcap:
         neo4j.raw_query(query)
         self.debug_time_end()
     
-    def create_connection_mac(self, neo4j, mac_src, mac_dst, proto, time, length, service, service_layer, frame_type):
+    def create_connection_mac(self, neo4j, mac_src, mac_dst, proto, time, length, service, service_layer, frame_type, weight=1):
         if frame_type == 'probe_response':
             return self.create_probe_response_mac(neo4j, mac_src, mac_dst)
-        if self.reduce:
+        if self.aggregator is not None:
+            self.aggregator.aggregate.add_connection('MAC', mac_src, mac_dst, None, proto, time, length, service, service_layer, weight)
+        elif self.reduce:
             self.create_connection_mac_reduced(neo4j, mac_src, mac_dst, proto)
         else:
             self.create_connection_mac_full(neo4j, mac_src, mac_dst, proto, time, length, service, service_layer)
@@ -296,9 +620,10 @@ class Pcap:
         ON CREATE
             SET r += {{first_seen: {time}, last_seen: {time}, data_size: {length}, service: "{service}", service_layer: {service_layer}, count: 1}}
         ON MATCH
-            SET r.first_seen = (CASE WHEN {time} > r.first_seen THEN r.first_seen ELSE {time} END)
-            SET r.last_seen = (CASE WHEN {time} < r.last_seen THEN r.last_seen ELSE {time} END)
-            SET r += {{data_size: r.data_size+{length}, count: r.count+1}}
+            SET r.first_seen = (CASE WHEN {time} > r.first_seen THEN r.first_seen ELSE {time} END),
+                r.last_seen = (CASE WHEN {time} < r.last_seen THEN r.last_seen ELSE {time} END),
+                r.data_size = r.data_size + {length},
+                r.count = r.count + 1
     return r'''
         self.debug_time_start()
         neo4j.raw_query(query)
@@ -325,6 +650,11 @@ class Pcap:
         self.debug_time_end()
 
     def create_probe_response_mac(self, neo4j, mac_src, mac_dst):
+        if self.cached((mac_src, mac_dst), 'PROBE_RESPONSE'):
+            return
+        if self.aggregator is not None:
+            self.aggregator.aggregate.add_relationship('PROBE_RESPONSE', mac_src, mac_dst)
+            return
         # Create CONNECTED relationship between MACs
         query = f'''MATCH (n:MAC {{name: "{mac_src}"}})
     MATCH (m:MAC {{name: "{mac_dst}"}})
@@ -338,9 +668,12 @@ class Pcap:
         if ssid is None:
             return
         if not self.cached(ssid, 'SSID'):
-            self.debug_time_start()
-            neo4j.create_node('SSID', ssid)
-            self.debug_time_end()
+            if self.aggregator is not None:
+                self.aggregator.aggregate.add_node('SSID', ssid)
+            else:
+                self.debug_time_start()
+                neo4j.create_node('SSID', ssid)
+                self.debug_time_end()
         if mac_src is None:
             return
         relationship = 'ADVERTISES'
@@ -348,9 +681,12 @@ class Pcap:
             relationship = 'PROBES'
         elif frame_type == 'probe_response':
             return
-        if not self.cached([mac_src, ssid], relationship):
+        if not self.cached((mac_src, ssid), relationship):
+            if self.aggregator is not None:
+                self.aggregator.aggregate.add_relationship(relationship, mac_src, ssid)
+                return
             self.debug_time_start()
-            neo4j.new_relationship(mac_src, ssid, relationship)
+            neo4j.new_relationship(mac_src, ssid, relationship, label_a='MAC', label_b='SSID')
             self.debug_time_end()
 
 def get_protocol(packet):
@@ -366,26 +702,43 @@ def get_protocol(packet):
         # eth -> ???
         return packet.layers[1].layer_name
 
-def get_macs(packet, cached=None):
-    macs = {}
-    macs['src'] = {'mac': None, 'oui': None}
-    macs['dst'] = {'mac': None, 'oui': None}
-    macs['tra'] = {'mac': None, 'oui': None}
-    macs['rec'] = {'mac': None, 'oui': None}
+# Identifies the connection a packet belongs to without the rest of
+# extract(), so the sampler can tell new flows from repeats cheaply
+def get_flow_key(packet):
+    ip_src, ip_dst = get_ips(packet)
+    if ip_src is not None:
+        return (get_protocol(packet), ip_src, ip_dst, get_ports(packet)[1])
+    if 'wlan' in packet:
+        wlan = packet.wlan
+        return (get_protocol(packet), get_field(wlan, 'sa'), get_field(wlan, 'da'), get_field(wlan, 'ta'), get_field(wlan, 'ra'))
+    if 'eth' in packet:
+        return (get_protocol(packet), get_field(packet.eth, 'src'), get_field(packet.eth, 'dst'))
+    return None
 
+# Source, destination, transmitter and receiver MAC addresses. The
+# transmitter and receiver are None unless they differ from the others
+def get_mac_addresses(packet):
+    mac_src, mac_dst, mac_tra, mac_rec = None, None, None, None
     if 'eth' in packet:
-        macs['src']['mac'] = packet.eth.get_field('src')
-        macs['dst']['mac'] = packet.eth.get_field('dst')
+        mac_src = get_field(packet.eth, 'src')
+        mac_dst = get_field(packet.eth, 'dst')
     if 'wlan' in packet:
-        macs['src']['mac'] = packet.wlan.get_field('sa')
-        macs['dst']['mac'] = packet.wlan.get_field('da')
-        macs['tra']['mac'] = packet.wlan.get_field('ta')
-        macs['rec']['mac'] = packet.wlan.get_field('ra')
-        if macs['src']['mac'] == macs['tra']['mac']:
-            macs['tra']['mac'] = None
-        if macs['dst']['mac'] == macs['rec']['mac']:
-            macs['rec']['mac'] = None
-    
+        wlan = packet.wlan
+        mac_src = get_field(wlan, 'sa')
+        mac_dst = get_field(wlan, 'da')
+        mac_tra = get_field(wlan, 'ta')
+        mac_rec = get_field(wlan, 'ra')
+        if mac_src == mac_tra:
+            mac_tra = None
+        if mac_dst == mac_rec:
+            mac_rec = None
+    return mac_src, mac_dst, mac_tra, mac_rec
+
+def get_macs(packet, cached=None):
+    macs = {}
+    for k, mac in zip(('src', 'dst', 'tra', 'rec'), get_mac_addresses(packet)):
+        macs[k] = {'mac': mac, 'oui': None}
+
     for k in macs:
         if macs[k]['mac'] is not None:
             if cached is not None and cached(macs[k]['mac'], 'MAC'):
@@ -427,19 +780,29 @@ def get_ports(packet):
             return layer.srcport, layer.dstport
     return None, None
 
+# TCP flags as an int, None for anything else
+def get_tcp_flags(packet):
+    for layer in packet.layers:
+        if layer.layer_name == 'tcp':
+            return int(layer.flags, 16)
+    return None
+
 def get_time(packet):
     return float(packet.sniff_timestamp)
 
 def get_length(packet):
+    # pyshark's JSON packets only have the frame length
+    if packet.captured_length is None:
+        return int(packet.length)
     return int(packet.captured_length)
 
 def get_oui(mac):
-    try:
-        for k, v in OuiLookup().query(mac)[0].items():
-            return v
-    except:
-        pass
-    return None
+    if metrics.active is None:
+        return oui.lookup(mac)
+    start = metrics.clock()
+    vendor = oui.lookup(mac)
+    metrics.active.observe('oui', metrics.clock() - start)
+    return vendor
 
 '''
 Deprecated. Use get_oui()
@@ -477,16 +840,39 @@ def get_ssid(packet):
     ssid = None
     frame_type = 'beacon'
     if 'wlan.mgt' in packet:
+        mgt = packet['wlan.mgt']
         # Format: Tag: SSID parameter set: "TMobileWiFi-2.4GHz"
-        length = packet['wlan.mgt'].get_field('wlan_tag_length')
-        tag = packet['wlan.mgt'].get_field('wlan_tag')
+        length = get_field(mgt, 'wlan_tag_length')
+        tag = get_field(mgt, 'wlan_tag')
         if length and int(length) > 0 and tag:
             ssid = tag[len(tag)-int(length)-1:-1]
+        elif length is None and tag is None:
+            ssid = get_json_ssid(mgt)
     if 'wlan' in packet:
-        if packet.wlan.fc_type_subtype == '0x0004':
+        subtype = get_field(packet.wlan, 'fc_type_subtype') or get_field(packet.wlan, 'fc.type_subtype')
+        if subtype is not None:
+            subtype = int(subtype, 0)
+        if subtype == 4:
             frame_type = 'probe'
-        if packet.wlan.fc_type_subtype == '0x0005':
+        if subtype == 5:
             frame_type = 'probe_response'
     if ssid is not None and ssid in ignore:
         ssid = None
     return ssid, frame_type
+
+# The SSID tag of a wlan.mgt layer in tshark's JSON, where each tag is an
+# object under wlan.tagged.all instead of a PDML showname
+def get_json_ssid(mgt):
+    tags = get_field(get_field(mgt, 'tagged.all'), 'tag')
+    if tags is None:
+        return None
+    if not isinstance(tags, list):
+        tags = [tags]
+    for tag in tags:
+        if get_field(tag, 'tag.number') == '0':
+            ssid = get_field(tag, 'ssid')
+            if ssid and HEX_BYTES.match(ssid):
+                # Older versions show the bytes as hex
+                ssid = bytes.fromhex(ssid.replace(':', '')).decode('utf-8', errors='replace')
+            return ssid or None
+    return None
@@ -0,0 +1,670 @@
+import bisect
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+import pyshark
+import tqdm
+
+'''
+Native pcap/pcapng reader for the header fields NetFrenzy's extractors use.
+Decoded packets look enough like pyshark packets (layers, layer_name,
+get_field, 'eth' in packet, packet.eth.src, sniff_timestamp,
+captured_length) that get_ips(), get_ports(), get_protocol(), get_macs()
+and get_ssid() work on them unchanged. Anything else is handed to pyshark.
+'''
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_IEEE802_11_RADIOTAP = 127
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 6),
+    b'\xa1\xb2\xc3\xd4': ('>', 6),
+    b'\x4d\x3c\xb2\xa1': ('<', 9),
+    b'\xa1\xb2\x3c\x4d': ('>', 9),
+}
+PCAPNG_SHB = b'\x0a\x0d\x0d\x0a'
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+# Most frames handed to tshark at once, and most frames read ahead while
+# waiting for that many
+DISSECT_BATCH = 1000
+DISSECT_WINDOW = 20000
+
+# 802.11 management subtypes we decode, and the size of their fixed parameters
+WLAN_MGT_FIXED = {
+    4: 0,   # probe request
+    5: 12,  # probe response
+    8: 12,  # beacon
+}
+
+class Layer:
+    __slots__ = ('layer_name', 'fields')
+
+    def __init__(self, layer_name, fields):
+        self.layer_name = layer_name
+        self.fields = fields
+
+    @property
+    def field_names(self):
+        return list(self.fields)
+
+    def get_field(self, name):
+        return self.fields.get(name)
+
+    def __getattr__(self, name):
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise AttributeError(name)
+
+# A field of a native, pyshark XML or pyshark JSON layer, or None if the
+# layer doesn't have it. JSON layers raise instead of returning None
+def get_field(layer, name):
+    try:
+        return layer.get_field(name)
+    except AttributeError:
+        return None
+
+class Packet:
+    __slots__ = ('layers', 'number', 'sniff_timestamp', 'captured_length', 'length', 'payload_length')
+
+    def __init__(self, layers, number, sniff_timestamp, captured_length, length, payload_length=0):
+        self.layers = layers
+        self.number = number
+        self.sniff_timestamp = sniff_timestamp
+        self.captured_length = captured_length
+        self.length = length
+        # Bytes above the last decoded layer. Anything non-zero means tshark
+        # would have dissected more layers than we did
+        self.payload_length = payload_length
+
+    def __contains__(self, name):
+        for layer in self.layers:
+            if layer.layer_name == name:
+                return True
+        return False
+
+    def __getitem__(self, name):
+        for layer in self.layers:
+            if layer.layer_name == name:
+                return layer
+        raise KeyError(name)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class Record:
+    __slots__ = ('number', 'offset', 'end', 'timestamp', 'linktype', 'data_offset', 'caplen', 'length')
+
+    def __init__(self, number, offset, end, timestamp, linktype, data_offset, caplen, length):
+        self.number = number
+        # Byte range of the whole record in the file
+        self.offset = offset
+        self.end = end
+        self.timestamp = timestamp
+        self.linktype = linktype
+        self.data_offset = data_offset
+        self.caplen = caplen
+        self.length = length
+
+def is_supported(filename):
+    try:
+        with open(filename, 'rb') as f:
+            magic = f.read(4)
+    except OSError:
+        return False
+    return magic in PCAP_MAGIC or magic == PCAPNG_SHB
+
+def open_buffer(filename):
+    # mmap can't map an empty file
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def count_packets(filename):
+    # Only reads the record headers, so this runs at close to disk speed
+    buf = open_buffer(filename)
+    if len(buf) == 0:
+        return 0
+    try:
+        count = 0
+        for record in records(buf):
+            count += 1
+        return count
+    finally:
+        buf.close()
+
+def first_timestamp(filename):
+    # Time of the first packet as a float, None if there isn't one
+    buf = open_buffer(filename)
+    if len(buf) == 0:
+        return None
+    try:
+        for record in records(buf):
+            return float(record.timestamp)
+        return None
+    finally:
+        buf.close()
+
+def records(buf, start=None, number=1):
+    '''
+    Walks the record headers of a pcap or pcapng file held in buf, yielding
+    a Record per packet. start is a byte offset returned by a previous
+    Record.offset, and number is the packet number it had.
+    '''
+    magic = bytes(buf[0:4])
+    if magic in PCAP_MAGIC:
+        return pcap_records(buf, start, number)
+    if magic == PCAPNG_SHB:
+        return pcapng_records(buf, start, number)
+    raise ValueError('Not a pcap or pcapng file')
+
+def pcap_records(buf, start=None, number=1):
+    endian, digits = PCAP_MAGIC[bytes(buf[0:4])]
+    linktype = struct.unpack_from(endian + 'I', buf, 20)[0] & 0x0fffffff
+    header = struct.Struct(endian + 'IIII')
+    offset = 24 if start is None else start
+    size = len(buf)
+    while offset + 16 <= size:
+        sec, frac, caplen, length = header.unpack_from(buf, offset)
+        end = offset + 16 + caplen
+        if end > size:
+            # Truncated final record
+            break
+        timestamp = f'{sec}.{frac:0{digits}d}'
+        yield Record(number, offset, end, timestamp, linktype, offset + 16, caplen, length)
+        number += 1
+        offset = end
+
+def pcapng_blocks(buf):
+    # Yields (offset, block_type, block_len, endian) for every block
+    size = len(buf)
+    offset = 0
+    endian = '<'
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(endian + 'I', buf, offset)[0]
+        if block_type == 0x0a0d0d0a:
+            endian = '<' if bytes(buf[offset+8:offset+12]) == b'\x4d\x3c\x2b\x1a' else '>'
+        block_len = struct.unpack_from(endian + 'I', buf, offset + 4)[0]
+        if block_len < 12 or offset + block_len > size:
+            break
+        yield offset, block_type, block_len, endian
+        offset += block_len
+
+def pcapng_records(buf, start=None, number=1):
+    interfaces = []
+    # Resuming part way through a file still needs the section and
+    # interface blocks that came before it
+    for offset, block_type, block_len, endian in pcapng_blocks(buf):
+        if block_type == 0x0a0d0d0a:
+            interfaces = []
+        elif block_type == 1:
+            interfaces.append(pcapng_interface(buf, offset, block_len, endian))
+        elif start is None or offset >= start:
+            record = pcapng_record(buf, offset, block_type, block_len, endian, interfaces, number)
+            if record is not None:
+                yield record
+                number += 1
+
+def split(buf, parts):
+    '''
+    Splits a capture into at most parts runs of whole records of roughly
+    equal size. Returns a list of Slice, each of which can be written out
+    as a standalone capture with write_slice().
+    '''
+    size = len(buf)
+    magic = bytes(buf[0:4])
+    if magic in PCAP_MAGIC:
+        headers = [(0, 24)]
+        blocks = ((r.offset, r.end, True) for r in pcap_records(buf))
+    elif magic == PCAPNG_SHB:
+        headers = []
+        blocks = pcapng_split_blocks(buf, headers)
+    else:
+        raise ValueError('Not a pcap or pcapng file')
+    slices = []
+    current = None
+    number = 1
+    for offset, end, is_packet in blocks:
+        if not is_packet:
+            if current is not None:
+                # Section or interface block in the middle of a run,
+                # close the run so later ones get the new headers
+                slices.append(current)
+                current = None
+            continue
+        if current is None:
+            current = Slice(list(headers), offset, end, number, 0)
+        current.end = end
+        current.packets += 1
+        number += 1
+        if end >= size * (len(slices) + 1) / parts:
+            slices.append(current)
+            current = None
+    if current is not None:
+        slices.append(current)
+    return slices
+
+def pcapng_split_blocks(buf, headers):
+    # Yields (offset, end, is_packet) and keeps headers as the section and
+    # interface blocks any slice starting at the next packet needs
+    for offset, block_type, block_len, endian in pcapng_blocks(buf):
+        if block_type == 0x0a0d0d0a:
+            headers[:] = [(offset, offset + block_len)]
+            yield offset, offset + block_len, False
+        elif block_type == 1:
+            headers.append((offset, offset + block_len))
+            yield offset, offset + block_len, False
+        elif block_type in (2, 3, 6):
+            yield offset, offset + block_len, True
+
+def header_blocks(buf):
+    '''
+    (start, end, is section) of the file's header blocks: the pcap header,
+    or the pcapng section and interface blocks.
+    '''
+    if bytes(buf[0:4]) in PCAP_MAGIC:
+        return [(0, 24, True)]
+    return [(offset, offset + block_len, block_type == 0x0a0d0d0a)
+            for offset, block_type, block_len, endian in pcapng_blocks(buf) if block_type in (0x0a0d0d0a, 1)]
+
+# Byte ranges of the header blocks from blocks that a record at offset
+# needs to be read on its own: its section's, up to the record
+def headers_before(blocks, offset):
+    needed = []
+    for start, end, section in blocks:
+        if start >= offset:
+            break
+        if section:
+            needed = []
+        needed.append((start, end))
+    return needed
+
+class Slice:
+    __slots__ = ('headers', 'start', 'end', 'first', 'packets')
+
+    def __init__(self, headers, start, end, first, packets):
+        # Byte ranges of the file header blocks this slice depends on
+        self.headers = headers
+        self.start = start
+        self.end = end
+        # Number of the first packet in the original file
+        self.first = first
+        self.packets = packets
+
+def write_slice(buf, piece, f):
+    for start, end in piece.headers:
+        f.write(buf[start:end])
+    f.write(buf[piece.start:piece.end])
+
+def pcapng_interface(buf, offset, block_len, endian):
+    linktype, _, snaplen = struct.unpack_from(endian + 'HHI', buf, offset + 8)
+    # if_tsresol defaults to microseconds
+    resolution = (False, 6)
+    opt = offset + 16
+    end = offset + block_len - 4
+    while opt + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, opt)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = buf[opt + 4]
+            resolution = (bool(value & 0x80), value & 0x7f)
+        opt += 4 + ((length + 3) & ~3)
+    return (linktype, snaplen, resolution)
+
+def pcapng_record(buf, offset, block_type, block_len, endian, interfaces, number):
+    if block_type == 6:
+        # Enhanced Packet Block
+        iface, ts_high, ts_low, caplen, length = struct.unpack_from(endian + 'IIIII', buf, offset + 8)
+        data_offset = offset + 28
+    elif block_type == 2:
+        # Obsolete Packet Block
+        iface, _, ts_high, ts_low, caplen, length = struct.unpack_from(endian + 'HHIIII', buf, offset + 8)
+        data_offset = offset + 28
+    elif block_type == 3:
+        # Simple Packet Block, no timestamp and always interface 0
+        length = struct.unpack_from(endian + 'I', buf, offset + 8)[0]
+        iface, ts_high, ts_low = 0, 0, 0
+        caplen = min(length, block_len - 16)
+        if interfaces and interfaces[0][1]:
+            caplen = min(caplen, interfaces[0][1])
+        data_offset = offset + 12
+    else:
+        return None
+    if iface >= len(interfaces):
+        return None
+    linktype, _, (binary, exponent) = interfaces[iface]
+    ts = (ts_high << 32) | ts_low
+    if binary:
+        timestamp = repr(ts / (1 << exponent))
+    else:
+        scale = 10 ** exponent
+        timestamp = f'{ts // scale}.{ts % scale:0{exponent}d}'
+    return Record(number, offset, offset + block_len, timestamp, linktype, data_offset, caplen, length)
+
+def decode(buf, record):
+    '''
+    Builds a Packet from a Record, or returns None if the frame uses a
+    link type or protocol this module does not understand.
+    '''
+    start = record.data_offset
+    end = start + record.caplen
+    if record.linktype == LINKTYPE_ETHERNET:
+        layers = []
+        payload = decode_ethernet(buf, start, end, layers)
+    elif record.linktype == LINKTYPE_IEEE802_11:
+        layers = []
+        payload = decode_wlan(buf, start, end, layers)
+    elif record.linktype == LINKTYPE_IEEE802_11_RADIOTAP:
+        layers = []
+        payload = decode_radiotap(buf, start, end, layers)
+    else:
+        return None
+    if payload is None:
+        return None
+    return Packet(layers, str(record.number), record.timestamp, str(record.caplen), str(record.length), payload)
+
+def mac_str(buf, offset):
+    return ':'.join(f'{b:02x}' for b in buf[offset:offset+6])
+
+def decode_ethernet(buf, offset, end, layers):
+    if offset + 14 > end:
+        return None
+    dst = mac_str(buf, offset)
+    src = mac_str(buf, offset + 6)
+    ethertype = struct.unpack_from('>H', buf, offset + 12)[0]
+    layers.append(Layer('eth', {'dst': dst, 'src': src, 'type': f'0x{ethertype:04x}'}))
+    offset += 14
+    while ethertype in ETHERTYPE_VLAN:
+        if offset + 4 > end:
+            return None
+        tci, ethertype = struct.unpack_from('>HH', buf, offset)
+        layers.append(Layer('vlan', {'id': str(tci & 0x0fff), 'etype': f'0x{ethertype:04x}'}))
+        offset += 4
+    if ethertype == ETHERTYPE_IPV4:
+        return decode_ipv4(buf, offset, end, layers)
+    if ethertype == ETHERTYPE_IPV6:
+        return decode_ipv6(buf, offset, end, layers)
+    return None
+
+def decode_ipv4(buf, offset, end, layers):
+    if offset + 20 > end:
+        return None
+    ver_ihl, _, total_length, _, frag, _, proto = struct.unpack_from('>BBHHHBB', buf, offset)
+    ihl = (ver_ihl & 0x0f) * 4
+    if ver_ihl >> 4 != 4 or ihl < 20 or offset + ihl > end:
+        return None
+    if frag & 0x3fff:
+        # Fragments get reassembled by tshark, leave them to it
+        return None
+    src = socket.inet_ntoa(buf[offset+12:offset+16])
+    dst = socket.inet_ntoa(buf[offset+16:offset+20])
+    layers.append(Layer('ip', {'src': src, 'dst': dst, 'proto': str(proto), 'len': str(total_length)}))
+    # Trust the IP length over the capture length so Ethernet padding is ignored
+    payload_end = min(end, offset + total_length) if total_length >= ihl else end
+    return decode_transport(buf, offset + ihl, payload_end, proto, layers)
+
+def decode_ipv6(buf, offset, end, layers):
+    if offset + 40 > end:
+        return None
+    payload_length, nxt = struct.unpack_from('>HB', buf, offset + 4)
+    src = socket.inet_ntop(socket.AF_INET6, bytes(buf[offset+8:offset+24]))
+    dst = socket.inet_ntop(socket.AF_INET6, bytes(buf[offset+24:offset+40]))
+    layers.append(Layer('ipv6', {'src': src, 'dst': dst, 'nxt': str(nxt), 'plen': str(payload_length)}))
+    payload_end = min(end, offset + 40 + payload_length) if payload_length else end
+    # Extension headers are rare enough to leave to tshark
+    return decode_transport(buf, offset + 40, payload_end, nxt, layers)
+
+def decode_transport(buf, offset, end, proto, layers):
+    if proto == IPPROTO_TCP:
+        if offset + 20 > end:
+            return None
+        srcport, dstport, seq, ack, off_flags = struct.unpack_from('>HHIIH', buf, offset)
+        header = (off_flags >> 12) * 4
+        if header < 20:
+            return None
+        payload = max(0, end - offset - header)
+        layers.append(Layer('tcp', {
+            'srcport': str(srcport),
+            'dstport': str(dstport),
+            'flags': f'0x{off_flags & 0x0fff:04x}',
+            'len': str(payload),
+        }))
+        return payload
+    if proto == IPPROTO_UDP:
+        if offset + 8 > end:
+            return None
+        srcport, dstport, length = struct.unpack_from('>HHH', buf, offset)
+        payload = max(0, min(length, end - offset) - 8)
+        layers.append(Layer('udp', {
+            'srcport': str(srcport),
+            'dstport': str(dstport),
+            'length': str(length),
+        }))
+        return payload
+    return None
+
+def decode_radiotap(buf, offset, end, layers):
+    if offset + 8 > end:
+        return None
+    length, present = struct.unpack_from('<HI', buf, offset + 2)
+    if offset + length > end:
+        return None
+    # Skip any extended presence bitmaps to find where the fields start
+    field = offset + 8
+    word = present
+    while word & 0x80000000 and field + 4 <= offset + length:
+        word = struct.unpack_from('<I', buf, field)[0]
+        field += 4
+    flags = 0
+    if present & 0x1:
+        # TSFT, 8 bytes aligned to 8
+        field = offset + ((field - offset + 7) & ~7) + 8
+    if present & 0x2 and field < offset + length:
+        flags = buf[field]
+    if flags & 0x10:
+        # Frame includes the FCS
+        end -= 4
+    layers.append(Layer('radiotap', {'length': str(length)}))
+    layers.append(Layer('wlan_radio', {}))
+    return decode_wlan(buf, offset + length, end, layers)
+
+def decode_wlan(buf, offset, end, layers):
+    if offset + 24 > end:
+        return None
+    fc0 = buf[offset]
+    frame_type = (fc0 >> 2) & 0x3
+    subtype = fc0 >> 4
+    if frame_type != 0 or subtype not in WLAN_MGT_FIXED:
+        # Control and data frames carry encapsulated layers and
+        # differing address layouts, let tshark handle them
+        return None
+    addr1 = mac_str(buf, offset + 4)
+    addr2 = mac_str(buf, offset + 10)
+    addr3 = mac_str(buf, offset + 16)
+    layers.append(Layer('wlan', {
+        'fc_type_subtype': f'0x{(frame_type << 4) | subtype:04x}',
+        'ra': addr1,
+        'da': addr1,
+        'ta': addr2,
+        'sa': addr2,
+        'bssid': addr3,
+    }))
+    fields = {}
+    tags = offset + 24 + WLAN_MGT_FIXED[subtype]
+    if tags + 2 <= end and buf[tags] == 0:
+        tag_length = buf[tags + 1]
+        if tags + 2 + tag_length <= end:
+            if tag_length == 0:
+                fields['wlan_tag'] = 'Tag: SSID parameter set: Wildcard SSID'
+            else:
+                ssid = bytes(buf[tags+2:tags+2+tag_length]).decode('utf-8', errors='replace')
+                fields['wlan_tag'] = f'Tag: SSID parameter set: "{ssid}"'
+                tag_length = len(ssid)
+            fields['wlan_tag_length'] = str(tag_length)
+    layers.append(Layer('wlan.mgt', fields))
+    return 0
+
+class FastCapture:
+    '''
+    Iterates a pcap/pcapng file like pyshark.FileCapture, decoding headers
+    natively. Frames this module cannot decode are handed to pyshark, as
+    are frames with a payload when dissect_payloads is set (get_service()
+    needs tshark's full layer stack for those) and payload_filter, if set,
+    returns True for the natively decoded packet. Natively decoded packets
+    for which packet_filter, if set, returns True are left out.
+
+    Once a frame needs tshark, the frames after it are read ahead until
+    DISSECT_BATCH of them do, and just those are copied to a temporary
+    capture for one tshark run. tshark then never reads the rest of the
+    file, but it also doesn't see the frames between them, so PDUs split
+    over several TCP segments aren't reassembled. payload_filter is asked
+    about frames before the ones read ahead of them are processed, so it
+    can pick a few more frames than it would one at a time.
+    '''
+    def __init__(self, filename, keep_packets=False):
+        self.filename = filename
+        self.keep_packets = keep_packets
+        self.dissect_payloads = False
+        self.payload_filter = None
+        self.packet_filter = None
+        # Keyword arguments for the pyshark capture, see profiles.py
+        self.tshark_options = {}
+        # Packets to leave out from the start of the file
+        self.skip = 0
+        self.decoded = 0
+        self.dissected = 0
+        # tshark runs, one per batch
+        self.batches = 0
+
+    def __iter__(self):
+        buf = open_buffer(self.filename)
+        if len(buf) == 0:
+            return
+        try:
+            # The file's header blocks, which a batch can't span
+            blocks = None
+            # (record, packet) read ahead, packet None until dissected
+            window = []
+            pending = []
+            for record in records(buf):
+                if record.number <= self.skip:
+                    continue
+                packet = decode(buf, record)
+                if packet is not None and self.packet_filter is not None and self.packet_filter(packet):
+                    continue
+                if packet is None or (self.dissect_payloads and packet.payload_length and
+                                      (self.payload_filter is None or self.payload_filter(packet))):
+                    if blocks is None:
+                        blocks = header_blocks(buf)
+                        boundaries = [start for start, end, section in blocks]
+                    if pending and bisect.bisect(boundaries, pending[0].offset) != bisect.bisect(boundaries, record.offset):
+                        yield from self.flush_window(buf, window, pending, blocks)
+                    window.append((record, None))
+                    pending.append(record)
+                elif pending:
+                    window.append((record, packet))
+                else:
+                    self.decoded += 1
+                    yield packet
+                    continue
+                if len(pending) >= DISSECT_BATCH or len(window) >= DISSECT_WINDOW:
+                    yield from self.flush_window(buf, window, pending, blocks)
+            if pending:
+                yield from self.flush_window(buf, window, pending, blocks)
+        finally:
+            buf.close()
+
+    def flush_window(self, buf, window, pending, blocks):
+        dissected = self.dissect(buf, pending, blocks)
+        for record, packet in window:
+            if packet is None:
+                packet = dissected[record.number]
+                self.dissected += 1
+            else:
+                self.decoded += 1
+            yield packet
+        window.clear()
+        pending.clear()
+
+    # {number: pyshark packet} for batch, which no header block of
+    # blocks comes between
+    def dissect(self, buf, batch, blocks):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(self.filename)[1])
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for start, end in headers_before(blocks, batch[0].offset):
+                    out.write(buf[start:end])
+                for record in batch:
+                    out.write(buf[record.offset:record.end])
+            self.batches += 1
+            cap = pyshark.FileCapture(path, keep_packets=self.keep_packets, **self.tshark_options)
+            try:
+                packets = {}
+                for packet in cap:
+                    # Numbered from 1 in the temporary capture
+                    number = batch[int(packet.number) - 1].number
+                    packet.number = str(number)
+                    packets[number] = packet
+            finally:
+                cap.close()
+        finally:
+            os.remove(path)
+        for record in batch:
+            if record.number not in packets:
+                raise ValueError(f'tshark did not return packet {record.number}')
+        return packets
+
+    def close(self):
+        # Each batch's tshark run is closed once it's read
+        pass
+
+class ByteProgress:
+    '''
+    Wraps an iterable of packets from filename (pyshark or FastCapture) and
+    drives a tqdm bar by file offset. The record headers are walked
+    alongside the packets, matched up by packet number, so packets skipped
+    by a filter don't throw it off.
+    '''
+    def __init__(self, cap, filename):
+        self.cap = cap
+        self.filename = filename
+
+    def __iter__(self):
+        buf = open_buffer(self.filename)
+        if len(buf) == 0:
+            return
+        try:
+            position = 0
+            headers = records(buf)
+            # None until the walk finds a record, which it doesn't for a
+            # truncated first record that tshark still returns
+            record = None
+            with tqdm.tqdm(total=len(buf), unit='B', unit_scale=True, unit_divisor=1024) as progress:
+                for packet in self.cap:
+                    number = int(packet.number)
+                    for record in headers:
+                        if record.number >= number:
+                            break
+                    if record is not None and record.end > position:
+                        progress.update(record.end - position)
+                        position = record.end
+                    yield packet
+                progress.update(len(buf) - position)
+        finally:
+            buf.close()
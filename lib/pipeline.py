@@ -0,0 +1,256 @@
+import collections
+import random
+import threading
+import time
+
+from . import aggregate
+from . import metrics
+from . import records
+
+POLICIES = ('block', 'drop-oldest', 'sample')
+
+# Seconds between sampler adjustments
+ADJUST_SECONDS = 1.0
+
+# Attempts at the last flush once capture has ended, so stop() doesn't
+# wait forever on a Neo4j that is down
+FINAL_ATTEMPTS = 3
+
+class Pipeline:
+    '''
+    Staged ingest for live captures:
+
+        capture (caller's thread) -> bounded queue -> workers -> aggregator -> writer
+
+    Workers take whatever is queued, up to pc.batch_size packets, dissect
+    them into a records.RecordBatch and fold the batch into pc.aggregator
+    under one lock acquisition. The writer
+    thread swaps the aggregate out and writes it to Neo4j on the
+    aggregator's thresholds, including its time threshold when no packets
+    are arriving. If Neo4j stalls, the aggregate being filled grows to
+    max_memory and the workers wait for the writer. The queue then fills
+    up and policy decides what happens to new packets:
+
+     - block:       the capture waits for room in the queue
+     - drop-oldest: the oldest queued packet is dropped to make room
+     - sample:      past half full, packets are kept with a probability
+                    falling linearly to 0 when the queue is full
+
+    With a sampler (see sampling.Sampler), workers skip repeat packets of
+    known flows once ingest falls behind arrivals, before the queue is
+    full and the policy has to step in.
+
+    Failed writes are retried with the next flush. Once capture has ended,
+    the last flush is given FINAL_ATTEMPTS tries before it is dropped.
+    '''
+    def __init__(self, pc, neo4j, queue_size=10000, policy='block', workers=1, stats_interval=None, sampler=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy}')
+        self.pc = pc
+        self.neo4j = neo4j
+        self.aggregator = pc.aggregator
+        self.queue_size = queue_size
+        self.policy = policy
+        self.workers = workers
+        self.stats_interval = stats_interval
+        self.sampler = sampler
+
+        self.queue = collections.deque()
+        # Guards the queue
+        self.queue_lock = threading.Lock()
+        self.not_empty = threading.Condition(self.queue_lock)
+        self.not_full = threading.Condition(self.queue_lock)
+        # Guards pc (caches) and the aggregator
+        self.fold_lock = threading.Lock()
+        self.written = threading.Condition(self.fold_lock)
+        # Set when capture ends, workers exit once the queue is empty
+        self.stopping = False
+        # Set once the workers are done, the writer flushes what's left and exits
+        self.finished = False
+        self.writing = False
+        # Set while the last write failed
+        self.stalled = False
+
+        self.captured = 0
+        self.queued = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.processed = 0
+        self.written_packets = 0
+        self.flushes = 0
+        self.write_errors = 0
+
+    def run(self, packets):
+        threads = [threading.Thread(target=self.work, name=f'worker-{i}', daemon=True) for i in range(self.workers)]
+        writer = threading.Thread(target=self.write, name='writer', daemon=True)
+        for t in threads:
+            t.start()
+        writer.start()
+        last_stats = time.time()
+        self.last_adjust = (last_stats, 0, 0)
+        try:
+            for packet in packets:
+                self.offer(packet)
+                if self.sampler is not None and time.time() - self.last_adjust[0] >= ADJUST_SECONDS:
+                    self.adjust_sampling()
+                if self.stats_interval and time.time() - last_stats >= self.stats_interval:
+                    self.print_stats()
+                    last_stats = time.time()
+        finally:
+            self.stop(threads, writer)
+            self.print_stats()
+
+    def offer(self, packet):
+        with self.queue_lock:
+            self.captured += 1
+            if len(self.queue) >= self.queue_size:
+                if self.policy == 'block':
+                    while len(self.queue) >= self.queue_size:
+                        self.not_full.wait()
+                elif self.policy == 'drop-oldest':
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.sampled += 1
+                    return
+            elif self.policy == 'sample' and len(self.queue) > self.queue_size // 2:
+                keep = (self.queue_size - len(self.queue)) / (self.queue_size - self.queue_size // 2)
+                if random.random() >= keep:
+                    self.sampled += 1
+                    return
+            self.queue.append(packet)
+            self.queued += 1
+            self.not_empty.notify()
+
+    def work(self):
+        batch = records.RecordBatch(self.pc.batch_size)
+        while True:
+            with self.queue_lock:
+                while not self.queue and not self.stopping:
+                    self.not_empty.wait()
+                if not self.queue:
+                    return
+                # Never waits for a batch to fill up, so a quiet link isn't
+                # held back
+                packets = [self.queue.popleft() for _ in range(min(len(self.queue), batch.size))]
+                self.not_full.notify()
+            for packet in packets:
+                if self.pc.filtered(packet):
+                    continue
+                weight = 1
+                if self.sampler is not None:
+                    weight = self.sampler.weigh(self.pc.flow_key(packet))
+                    if weight == 0:
+                        continue
+                record = self.pc.extract(packet, batch.record)
+                record.weight = weight
+                batch.append(record)
+            if not len(batch):
+                continue
+            self.pc.enrich(batch)
+            with self.fold_lock:
+                # Don't outgrow the memory limit while the writer is stuck
+                while (self.writing or self.stalled) and self.over_memory():
+                    self.written.wait()
+                # neo4j=None leaves flushing to the writer
+                self.pc.fold_batch(None, batch)
+                self.processed += len(batch)
+            batch.clear()
+
+    # Compares the arrival and ingest rates since the last adjustment
+    def adjust_sampling(self):
+        now = time.time()
+        then, captured, taken = self.last_adjust
+        elapsed = now - then
+        if elapsed <= 0:
+            return
+        taken_now = self.processed + self.sampler.skipped
+        arrival_rate = (self.captured - captured) / elapsed
+        ingest_rate = (taken_now - taken) / elapsed
+        self.sampler.adjust(arrival_rate, ingest_rate, len(self.queue), self.queue_size)
+        self.last_adjust = (now, self.captured, taken_now)
+        if metrics.active is not None:
+            metrics.active.set_gauge('arrival_rate', arrival_rate)
+            metrics.active.set_gauge('ingest_rate', ingest_rate)
+            for k, v in self.sampler.stats().items():
+                metrics.active.set_gauge(f'sampling_{k}', v)
+
+    def over_memory(self):
+        limit = self.aggregator.max_memory
+        return limit is not None and self.aggregator.aggregate.size() >= limit
+
+    def write(self):
+        final_failures = 0
+        while True:
+            with self.fold_lock:
+                stopping = self.finished
+                if not stopping and not self.aggregator.should_flush():
+                    agg = None
+                else:
+                    agg = self.aggregator.take()
+                    self.writing = True
+            if agg is None:
+                time.sleep(0.05)
+                continue
+            failed = False
+            try:
+                if len(agg):
+                    aggregate.write_aggregate(self.neo4j, agg, reduce=self.aggregator.reduce)
+                    self.flushes += 1
+                self.written_packets += agg.packets
+            except Exception as e:
+                failed = True
+                self.write_errors += 1
+                print(f'Write failed, retrying with the next flush: {type(e)}: {e}')
+            with self.fold_lock:
+                if failed:
+                    # The flush is a single transaction, so nothing from it
+                    # was committed. Put it back rather than lose it
+                    agg.merge(self.aggregator.aggregate)
+                    self.aggregator.aggregate = agg
+                self.writing = False
+                self.stalled = failed
+                self.written.notify_all()
+            if stopping and not failed:
+                return
+            if stopping:
+                final_failures += 1
+                if final_failures >= FINAL_ATTEMPTS:
+                    # Only what was committed is kept, as with any
+                    # checkpoint, the rest is dropped
+                    with self.fold_lock:
+                        lost = self.aggregator.take()
+                    print(f'Giving up on the last {lost.packets} packets after {FINAL_ATTEMPTS} failed writes')
+                    return
+            if failed:
+                time.sleep(1)
+
+    def stop(self, threads, writer):
+        with self.queue_lock:
+            self.stopping = True
+            self.not_empty.notify_all()
+        # Workers drain the queue before exiting
+        for t in threads:
+            t.join()
+        with self.fold_lock:
+            self.finished = True
+        writer.join()
+
+    def stats(self):
+        stats = {
+            'captured': self.captured,
+            'queued': self.queued,
+            'queue_depth': len(self.queue),
+            'dropped': self.dropped,
+            'sampled': self.sampled,
+            'processed': self.processed,
+            'written': self.written_packets,
+            'flushes': self.flushes,
+            'write_errors': self.write_errors,
+        }
+        if self.sampler is not None:
+            stats.update(self.sampler.stats())
+        return stats
+
+    def print_stats(self):
+        print(' '.join(f'{k}={v}' for k, v in self.stats().items()))
@@ -0,0 +1,56 @@
+'''
+tshark dissection profiles, the options pyshark captures are created with.
+
+full is tshark's default: every protocol is dissected and handed over as
+PDML, which get_service() needs to find the highest layer of a packet.
+
+minimal is for when the service isn't needed, as with --reduce. The
+extractors only read frame info, eth/wlan addresses, ip/ipv6, tcp/udp
+ports and flags, and wlan.mgt SSID tags, so tshark:
+
+ - turns off the application layer dissectors, which are most of its CPU
+   time. Their bytes show up as a data layer, so get_protocol() still sees
+   the same link, network and transport layers
+ - skips TCP reassembly and sequence analysis, which only feed them
+ - writes JSON, which is much smaller than PDML and quicker for pyshark
+   to parse
+
+With minimal, get_service() can only name the transport.
+'''
+
+DEFAULT = 'full'
+
+# Application layer dissectors turned off by minimal. Names tshark doesn't
+# know are ignored, so older and newer names can both be listed
+UPPER_PROTOCOLS = (
+    'http', 'http2', 'http3', 'tls', 'ssl', 'quic', 'dtls',
+    'dns', 'mdns', 'llmnr', 'nbns', 'nbdgm', 'nbss', 'browser',
+    'smb', 'smb2', 'dcerpc', 'ntlmssp', 'kerberos', 'ldap', 'cldap',
+    'dhcp', 'bootp', 'dhcpv6', 'ssdp', 'ntp', 'snmp', 'syslog',
+    'ssh', 'ftp', 'ftp-data', 'smtp', 'imap', 'pop', 'rdp', 'vnc',
+    'sip', 'sdp', 'rtp', 'rtcp', 'stun', 'mqtt', 'xml', 'json',
+    'data-text-lines', 'media', 'mime_multipart',
+)
+
+MINIMAL_PREFS = {
+    'tcp.desegment_tcp_streams': 'FALSE',
+    'tcp.analyze_sequence_numbers': 'FALSE',
+    'tcp.calculate_timestamps': 'FALSE',
+    'ip.defragment': 'FALSE',
+    'ipv6.defragment': 'FALSE',
+}
+
+PROFILES = ('full', 'minimal')
+
+def capture_options(profile):
+    '''
+    Keyword arguments for pyshark.FileCapture and LiveCapture.
+    '''
+    if profile == 'full':
+        return {}
+    if profile == 'minimal':
+        parameters = []
+        for protocol in UPPER_PROTOCOLS:
+            parameters += ['--disable-protocol', protocol]
+        return {'use_json': True, 'custom_parameters': parameters, 'override_prefs': dict(MINIMAL_PREFS)}
+    raise ValueError(f'Unknown tshark profile {profile!r}, expected one of {", ".join(PROFILES)}')
@@ -0,0 +1,125 @@
+import array
+import math
+import sys
+
+'''
+Packet records passed from extraction to the fold.
+
+Pcap.extract() fills a PacketRecord with the fields the rest of the
+ingest path needs, and Pcap.process() copies it into a RecordBatch
+instead of folding every packet as it arrives. Each batch of packets is
+then enriched (OUI lookups, once per MAC not already cached), folded into
+the aggregator and counted towards its flush thresholds as a whole.
+
+A RecordBatch is columnar: timestamps, lengths and the other numbers are
+kept in arrays of machine values, and addresses, ports and names are
+interned, so the same IP or MAC in thousands of packets is one string,
+shared with the aggregate keys built from it. Iterating over a batch
+loads each row into the same PacketRecord rather than creating one per
+packet, so don't keep the records it yields.
+'''
+
+DEFAULT_BATCH_SIZE = 256
+
+# Stands for None in the int columns
+MISSING = -(1 << 62)
+
+# Stands for None in the time column
+MISSING_TIME = math.nan
+
+STRING_FIELDS = ('proto', 'mac_src', 'mac_dst', 'mac_tra', 'mac_rec', 'ip_src', 'ip_dst',
+                 'port_src', 'port_dst', 'ssid', 'frame_type', 'service')
+
+class PacketRecord:
+    __slots__ = STRING_FIELDS + ('time', 'length', 'service_layer', 'tcp_flags', 'weight')
+
+    def __init__(self):
+        for name in STRING_FIELDS:
+            setattr(self, name, None)
+        self.time = None
+        self.length = None
+        self.service_layer = None
+        self.tcp_flags = None
+        # How many packets this one stands for, see sampling.Sampler
+        self.weight = 1
+
+    def macs(self):
+        return self.mac_src, self.mac_dst, self.mac_tra, self.mac_rec
+
+class RecordBatch:
+    def __init__(self, size=DEFAULT_BATCH_SIZE):
+        if size < 1:
+            raise ValueError(f'Batch size must be at least 1, not {size}')
+        self.size = size
+        # Filled by extract() and loaded by iteration
+        self.record = PacketRecord()
+        self.clear()
+
+    def clear(self):
+        self.strings = {name: [] for name in STRING_FIELDS}
+        self.string_columns = [(name, self.strings[name]) for name in STRING_FIELDS]
+        self.time = array.array('d')
+        self.length = array.array('q')
+        self.service_layer = array.array('q')
+        self.tcp_flags = array.array('q')
+        self.weight = array.array('q')
+        # {mac: manufacturer} of the MACs in the batch that weren't cached
+        self.vendors = {}
+        # Number of the last packet read, including dropped ones
+        self.last_packet = None
+
+    def __len__(self):
+        return len(self.weight)
+
+    def full(self):
+        return len(self.weight) >= self.size
+
+    def append(self, record):
+        for name, column in self.string_columns:
+            s = getattr(record, name)
+            # pyshark's fields are str subclasses, which can't be interned
+            # themselves
+            column.append(None if s is None else sys.intern(str(s)))
+        self.time.append(MISSING_TIME if record.time is None else record.time)
+        self.length.append(MISSING if record.length is None else record.length)
+        self.service_layer.append(MISSING if record.service_layer is None else record.service_layer)
+        self.tcp_flags.append(MISSING if record.tcp_flags is None else record.tcp_flags)
+        self.weight.append(record.weight)
+
+    # The distinct values of the batch's IP, MAC and (IP, MAC) columns, in
+    # the order they first appear in
+    def ips(self):
+        ips = dict.fromkeys(self.strings['ip_src'])
+        ips.update(dict.fromkeys(self.strings['ip_dst']))
+        ips.pop(None, None)
+        return list(ips)
+
+    def macs(self):
+        macs = {}
+        for name in ('mac_src', 'mac_dst', 'mac_tra', 'mac_rec'):
+            macs.update(dict.fromkeys(self.strings[name]))
+        macs.pop(None, None)
+        return list(macs)
+
+    def assignments(self):
+        strings = self.strings
+        pairs = dict.fromkeys(zip(strings['ip_src'], strings['mac_src']))
+        pairs.update(dict.fromkeys(zip(strings['ip_dst'], strings['mac_dst'])))
+        return list(pairs)
+
+    def __iter__(self):
+        record = self.record
+        strings = self.strings
+        rows = zip(*[strings[name] for name in STRING_FIELDS],
+                   self.time, self.length, self.service_layer, self.tcp_flags, self.weight)
+        for (record.proto, record.mac_src, record.mac_dst, record.mac_tra, record.mac_rec, record.ip_src,
+             record.ip_dst, record.port_src, record.port_dst, record.ssid, record.frame_type, record.service,
+             time, length, service_layer, tcp_flags, record.weight) in rows:
+            record.time = None if math.isnan(time) else time
+            record.length = value(length)
+            record.service_layer = value(service_layer)
+            record.tcp_flags = value(tcp_flags)
+            yield record
+
+def value(n):
+    return None if n == MISSING else n
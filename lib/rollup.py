@@ -0,0 +1,119 @@
+import ipaddress
+from functools import lru_cache
+
+from . import multicast
+
+'''
+Summary layer for viewing large graphs. Every flush also writes:
+
+ - a Subnet node per /24 (IPv4) or /64 (IPv6) it saw, with an IN_SUBNET
+   relationship from each IP
+ - SUBNET_CONNECTED relationships between Subnet nodes, one per pair,
+   with the count, data_size, first_seen and last_seen of the IP
+   connections between them summed up
+ - a Vendor node per MAC manufacturer, with a MADE_BY relationship from
+   each MAC
+
+The totals are added to what is stored, like the IP connections, so the
+rollup stays right across flushes, --workers and repeated imports. The
+web client opens on it and drills down into a subnet from there.
+'''
+
+DEFAULT_PREFIX_V4 = 24
+DEFAULT_PREFIX_V6 = 64
+
+# The Rollup in use, None when off
+active = None
+
+class Rollup:
+    def __init__(self, prefix_v4=DEFAULT_PREFIX_V4, prefix_v6=DEFAULT_PREFIX_V6):
+        if not 0 < prefix_v4 <= 32 or not 0 < prefix_v6 <= 128:
+            raise ValueError(f'Subnet prefixes must be 1-32 for IPv4 and 1-128 for IPv6, not /{prefix_v4} and /{prefix_v6}')
+        self.prefixes = {4: prefix_v4, 6: prefix_v6}
+        self.masks = {4: mask(32, prefix_v4), 6: mask(128, prefix_v6)}
+        self.subnet = lru_cache(maxsize=1 << 16)(self.subnet)
+
+    def subnet(self, ip):
+        '''
+        Returns the name of the subnet ip is in, like 10.1.2.0/24, or None
+        if ip isn't an address.
+        '''
+        version, value = multicast.ip_int(ip)
+        if version is None:
+            return None
+        network = ipaddress.ip_address(value & self.masks[version])
+        return f'{network}/{self.prefixes[version]}'
+
+    def statements(self, neo4j, agg):
+        # IN_SUBNET and the subnet connections MATCH the IP nodes, so these
+        # go after the flush's own statements
+        subnets = {}
+        members = []
+        for ip in agg.nodes['IP']:
+            subnet = self.subnet(ip)
+            if subnet is None:
+                continue
+            subnets[subnet] = subnet_properties(subnet)
+            members.append({'a': ip, 'b': subnet})
+
+        connections = {}
+        for key, conn in agg.connections.items():
+            label, src, dst, port, proto = key
+            if label != 'IP':
+                continue
+            subnet_src = self.subnet(src)
+            subnet_dst = self.subnet(dst)
+            if subnet_src is None or subnet_dst is None:
+                continue
+            row = connections.get((subnet_src, subnet_dst))
+            if row is None:
+                row = {'src': subnet_src, 'dst': subnet_dst, 'first_seen': None, 'last_seen': None, 'count': 0, 'data_size': 0}
+                connections[(subnet_src, subnet_dst)] = row
+            if conn.first_seen is not None and (row['first_seen'] is None or conn.first_seen < row['first_seen']):
+                row['first_seen'] = conn.first_seen
+            if conn.last_seen is not None and (row['last_seen'] is None or conn.last_seen > row['last_seen']):
+                row['last_seen'] = conn.last_seen
+            row['count'] += conn.count
+            row['data_size'] += conn.data_size
+            # Written for the endpoints of connections too, as an IP node
+            # may have been written by an earlier flush
+            subnets.setdefault(subnet_src, subnet_properties(subnet_src))
+            subnets.setdefault(subnet_dst, subnet_properties(subnet_dst))
+
+        vendors = {}
+        made_by = []
+        for mac, properties in agg.nodes['MAC'].items():
+            vendor = properties.get('manufacturer')
+            if not vendor:
+                continue
+            vendors[vendor] = {}
+            made_by.append({'a': mac, 'b': vendor})
+
+        statements = []
+        statements += neo4j.merge_nodes('Subnet', [{'name': name, 'properties': properties} for name, properties in subnets.items()])
+        statements += neo4j.merge_nodes('Vendor', [{'name': name, 'properties': properties} for name, properties in vendors.items()])
+        statements += neo4j.merge_relationships('IN_SUBNET', 'IP', 'Subnet', members)
+        statements += neo4j.merge_relationships('MADE_BY', 'MAC', 'Vendor', made_by)
+        statements += neo4j.merge_subnet_connections(list(connections.values()))
+        return statements
+
+@lru_cache(maxsize=1 << 12)
+def subnet_properties(subnet):
+    network = ipaddress.ip_network(subnet)
+    properties = {'prefix': network.prefixlen, 'version': network.version}
+    site = multicast.classify_ip(str(network.network_address)).get('site')
+    if site is not None:
+        properties['site'] = site
+    return properties
+
+def mask(bits, prefix):
+    return ((1 << prefix) - 1) << (bits - prefix)
+
+def enable(prefix_v4=DEFAULT_PREFIX_V4, prefix_v6=DEFAULT_PREFIX_V6):
+    global active
+    active = Rollup(prefix_v4, prefix_v6)
+    return active
+
+def disable():
+    global active
+    active = None
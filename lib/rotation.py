@@ -0,0 +1,134 @@
+import glob
+import multiprocessing
+import os
+import time
+import tqdm
+
+from . import aggregate
+from . import parallel
+from . import pcapfile
+
+'''
+Imports a directory or glob of captures, such as the files written by
+tcpdump -G/-C, with one process per file up to the worker count. Files are
+written to Neo4j one at a time in the order of their first packet, each in
+a single transaction together with its checkpoint. The checkpoints are the
+ledger of completed files: a file whose checkpoint covers all of its
+packets is not processed again, and one that was partly imported with
+--pcap is resumed after its last checkpointed packet.
+
+In watch mode the source is polled for new files, and a file is treated as
+closed once it has gone unmodified for settle seconds.
+'''
+
+SETTLE_SECONDS = 10
+
+class Rotation:
+    def __init__(self, pc, neo4j, source, workers=1, watch=None, settle=SETTLE_SECONDS):
+        self.pc = pc
+        self.neo4j = neo4j
+        self.source = source
+        self.workers = workers
+        # Seconds between polls, None to import what is there and stop
+        self.watch = watch
+        self.settle = settle
+        self.settings = parallel.worker_settings(pc)
+        # Files completed or given up on in this run, so the ledger is only
+        # read once per file
+        self.done = set()
+        self.imported = 0
+
+    def run(self):
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        try:
+            while True:
+                jobs = self.pending()
+                if jobs:
+                    self.process(jobs, pool)
+                if self.watch is None:
+                    break
+                time.sleep(self.watch)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            print(f'Imported {self.imported} files')
+
+    def matching(self):
+        if os.path.isdir(self.source):
+            paths = [os.path.join(self.source, name) for name in os.listdir(self.source)]
+        else:
+            paths = glob.glob(self.source)
+        return sorted(os.path.abspath(path) for path in paths if os.path.isfile(path))
+
+    # (first packet time, path, size, packets to skip) for each closed file
+    # not yet imported, in capture order
+    def pending(self):
+        now = time.time()
+        jobs = []
+        for path in self.matching():
+            if path in self.done:
+                continue
+            if self.watch is not None and now - os.path.getmtime(path) < self.settle:
+                continue
+            size = os.path.getsize(path)
+            skip = self.ledger_skip(path, size)
+            if skip is None:
+                self.done.add(path)
+                continue
+            jobs.append((start_time(path), path, size, skip))
+        jobs.sort()
+        return jobs
+
+    # Packets of path already imported, or None if there is nothing left to do
+    def ledger_skip(self, path, size):
+        if not hasattr(self.neo4j, 'read_checkpoint'):
+            return 0
+        packet, saved_size = self.neo4j.read_checkpoint(path)
+        if packet is None:
+            return 0
+        if saved_size != size:
+            print(f'{path} changed size since it was imported, skipping it')
+            return None
+        if not pcapfile.is_supported(path) or packet >= pcapfile.count_packets(path):
+            return None
+        return packet
+
+    def process(self, jobs, pool):
+        args = [(path, self.settings, skip) for _, path, _, skip in jobs]
+        if pool is None:
+            results = map(aggregate_job, args)
+        else:
+            # imap keeps the results in capture order
+            results = pool.imap(aggregate_job, args)
+        for (_, path, size, _), agg in zip(jobs, tqdm.tqdm(results, total=len(jobs), unit='file')):
+            self.done.add(path)
+            if agg is None:
+                continue
+            self.pc.debug_time_start()
+            aggregate.write_aggregate(self.neo4j, agg, reduce=self.pc.reduce,
+                                      checkpoint={'name': path, 'size': size})
+            self.pc.debug_time_end()
+            self.imported += 1
+
+def start_time(path):
+    if pcapfile.is_supported(path):
+        timestamp = pcapfile.first_timestamp(path)
+        if timestamp is not None:
+            return timestamp
+    return os.path.getmtime(path)
+
+def aggregate_job(job):
+    # Runs in a worker process
+    path, settings, skip = job
+    try:
+        agg = parallel.aggregate_file(path, settings, skip)
+    except Exception as e:
+        print(f'Could not read {path}: {type(e)}: {e}')
+        return None
+    # agg.packets leaves out what the drop rules and display filter did, but
+    # the ledger compares the checkpoint with every packet in the file
+    if pcapfile.is_supported(path):
+        agg.last_packet = pcapfile.count_packets(path)
+    elif agg.last_packet is None:
+        agg.last_packet = skip
+    return agg
@@ -0,0 +1,85 @@
+import math
+import random
+import threading
+
+from . import cache
+
+'''
+Flow-aware sampling for live captures that fall behind. The first packet
+of every flow is always recorded, so no host or connection is missed.
+Repeat packets of known flows are kept one in every interval, and each
+kept packet is counted interval times, so counts and data sizes stay
+unbiased estimates of the real totals.
+
+The pipeline calls adjust() about once a second with the arrival and
+ingest rates. While the queue is filling up faster than it drains, the
+interval doubles, and once the backlog is gone it halves again, back to
+recording everything.
+'''
+
+# Longest interval between kept repeat packets
+MAX_INTERVAL = 256
+
+# Backlog, as a fraction of the queue, past which the pipeline is behind
+BEHIND = 0.25
+# and under which it has caught up
+CAUGHT_UP = 0.05
+
+class Sampler:
+    def __init__(self, max_flows=100000, max_interval=MAX_INTERVAL):
+        # Flows already recorded. One that is evicted counts as new again
+        self.flows = cache.LRUCache(max_flows)
+        self.max_interval = max_interval
+        # Keep one in every interval repeat packets
+        self.interval = 1
+        self.lock = threading.Lock()
+
+        self.new = 0
+        self.kept = 0
+        self.skipped = 0
+        self.estimated = 0
+        # Variance of estimated, summed over the kept repeat packets
+        self.variance = 0
+
+    # Returns how many packets this one stands for, or 0 to skip it.
+    # A key of None is never sampled
+    def weigh(self, key):
+        with self.lock:
+            if key is None or not self.flows.check(key):
+                self.new += 1
+                self.estimated += 1
+                return 1
+            interval = self.interval
+            if interval > 1 and random.randrange(interval) != 0:
+                self.skipped += 1
+                return 0
+            self.kept += 1
+            self.estimated += interval
+            # Each kept packet stands for a Bernoulli(1/interval) draw
+            # scaled by interval
+            self.variance += interval * (interval - 1)
+            return interval
+
+    def adjust(self, arrival_rate, ingest_rate, backlog, queue_size):
+        with self.lock:
+            if backlog > queue_size * BEHIND and ingest_rate < arrival_rate:
+                self.interval = min(self.interval * 2, self.max_interval)
+            elif backlog < queue_size * CAUGHT_UP:
+                self.interval = max(self.interval // 2, 1)
+
+    def sample_rate(self):
+        return 1 / self.interval
+
+    # Standard error of the estimated packet count, relative to it
+    def relative_error(self):
+        if self.estimated == 0:
+            return 0.0
+        return math.sqrt(self.variance) / self.estimated
+
+    def stats(self):
+        return {
+            'sample_rate': self.sample_rate(),
+            'skipped': self.skipped,
+            'estimated': self.estimated,
+            'estimate_error': round(self.relative_error(), 6),
+        }
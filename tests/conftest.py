@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'bench'))
+
+import stub
+
+# The HTTP stub, keeping every statement it receives
+@pytest.fixture
+def server():
+    server = stub.serve(keep=True)
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,69 @@
+import struct
+
+import synth
+from lib import aggregate
+from lib import neo4j
+from lib import pcap
+
+'''
+Captures built packet by packet, and imports run against bench/stub.py
+that return the CONNECTED totals written.
+'''
+
+CLIENT, SERVER = '10.0.0.1', '10.0.0.2'
+
+SYN = 0x02
+ACK = 0x10
+
+MAC_A = synth.host_mac(1)
+MAC_B = synth.host_mac(2)
+
+def tcp_packet(src, sport, dst, dport, flags, payload=b''):
+    tcp = struct.pack('>HHIIHHHH', sport, dport, 0, 0, (5 << 12) | flags, 65535, 0, 0) + payload
+    return synth.ethernet(MAC_A, MAC_B, 0x0800, synth.ipv4(src, dst, 6, tcp))
+
+def udp_packet(src, sport, dst, dport, payload=b''):
+    return synth.ethernet(MAC_A, MAC_B, 0x0800, synth.ipv4(src, dst, 17, synth.udp(sport, dport, payload)))
+
+def write_pcap(path, packets):
+    # One packet per millisecond, like synth.write_pcap()
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, synth.LINKTYPE_ETHERNET))
+        for i, data in enumerate(packets):
+            sec, usec = divmod(i * 1000, 1000000)
+            f.write(struct.pack('<IIII', 1600000000 + sec, usec, len(data), len(data)))
+            f.write(data)
+
+def stub_neo4j(server):
+    n4j = neo4j.Neo4j()
+    n4j.commit = f'http://127.0.0.1:{server.server_port}/db/data/transaction/commit'
+    return n4j
+
+def new_pcap(path, **kwargs):
+    pc = pcap.Pcap(path, None, fast=True, **kwargs)
+    pc.do_count = False
+    pc.aggregator = aggregate.Aggregator()
+    return pc
+
+# {(src, dst, port): [count, data_size]} summed over every CONNECTED row
+# the stub received
+def connections(server):
+    totals = {}
+    for statement in server.RequestHandlerClass.stats.received:
+        query = statement['statement']
+        rows = statement['parameters'].get('rows')
+        if 'CONNECTED' not in query or 'MERGE' not in query or 'history' in query or rows is None:
+            continue
+        for row in rows:
+            total = totals.setdefault((row['src'], row['dst'], row.get('port')), [0, 0])
+            total[0] += row.get('count') or 0
+            total[1] += row.get('data_size') or 0
+    return totals
+
+# The checkpoints written, {name: packet}
+def checkpoints(server):
+    written = {}
+    for statement in server.RequestHandlerClass.stats.received:
+        if 'MERGE (c:Checkpoint' in statement['statement']:
+            written[statement['parameters']['name']] = statement['parameters']['packet']
+    return written
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip('scipy')
+
+from lib import aggregate
+from lib import analytics
+from lib import neo4j
+
+class Stored(neo4j.Neo4j):
+    '''
+    Holds CONNECTED totals written by earlier imports and records the
+    scores written.
+    '''
+    def __init__(self, totals):
+        super().__init__()
+        self.totals = totals
+        self.scores = {}
+
+    def read_connection_totals(self, label):
+        return [row[1:] for row in self.totals if row[0] == label]
+
+    def execute_batch(self, statements, quiet=False):
+        for query, parameters in statements:
+            if 'SET n.pagerank' in query:
+                for row in parameters['rows']:
+                    self.scores[row['name']] = row
+        return []
+
+def test_scores_cover_the_stored_graph():
+    # An earlier import connected a and b to hub, this one only c
+    stored = Stored([('IP', 'a', 'hub', 10), ('IP', 'b', 'hub', 10), ('IP', 'c', 'hub', 5)])
+    written = analytics.Written()
+    agg = aggregate.Aggregate()
+    agg.add_connection('IP', 'c', 'hub', '80', 'tcp', 1.0, 60, None, 0, weight=5)
+    written.add_aggregate(agg)
+    analytics.write_scores(stored, written)
+    assert set(stored.scores) == {'a', 'b', 'c', 'hub'}
+    # Every packet into hub, not just this import's
+    assert stored.scores['hub']['weighted_degree'] == 25
+    assert stored.scores['hub']['pagerank'] > stored.scores['a']['pagerank']
+
+def test_nothing_written_nothing_scored():
+    stored = Stored([('IP', 'a', 'hub', 10)])
+    analytics.write_scores(stored, analytics.Written())
+    assert stored.scores == {}
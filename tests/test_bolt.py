@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+pytest.importorskip('neo4j')
+
+import stub
+from lib import aggregate
+from lib import bolt
+from lib import connection
+
+@pytest.fixture
+def server():
+    server = stub.serve_bolt()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def connect(server, pool_size=10):
+    conn = connection.Connection('neo4j', 'neo4j')
+    conn.bolt_uri = f'bolt://127.0.0.1:{server.server_address[1]}'
+    conn.pool_size = pool_size
+    n4j = bolt.Bolt()
+    n4j.set_connection(conn)
+    return n4j
+
+def test_bolt_writes_an_aggregate(server):
+    n4j = connect(server)
+    try:
+        agg = aggregate.Aggregate()
+        agg.add_node('IP', '10.0.0.1')
+        agg.add_node('IP', '10.0.0.2')
+        agg.add_connection('IP', '10.0.0.1', '10.0.0.2', '80', 'tcp', 1.0, 60, 'http', 999)
+        agg.last_packet = 1
+        aggregate.write_aggregate(n4j, agg, checkpoint={'name': 'test.pcap', 'size': 100})
+        assert n4j.read_checkpoint('test.pcap') == (1, 100)
+        assert n4j.read_checkpoint('other.pcap') == (None, None)
+        assert n4j.read_connection_totals('IP') == []
+    finally:
+        n4j.close()
+    stats = server.RequestHandlerClass.stats.to_dict()
+    # The flush in one transaction, then the checkpoint read
+    assert stats['requests'] >= 3
+    assert stats['rows'] >= 4
+
+def test_bolt_set_pool_size_resizes_the_driver(server):
+    n4j = connect(server, pool_size=2)
+    try:
+        driver = n4j.driver
+        n4j.set_pool_size(8)
+        assert n4j.pool_size == 8
+        assert n4j.driver is not driver
+        # Never shrinks below the configured size
+        driver = n4j.driver
+        n4j.set_pool_size(4)
+        assert (n4j.pool_size, n4j.driver) == (8, driver)
+
+        # Eight transactions open at once, which a pool of two would
+        # keep waiting for a connection
+        started = threading.Barrier(8, timeout=10)
+        errors = []
+        def hold():
+            try:
+                with n4j.transaction() as tx:
+                    tx.run('RETURN 1').consume()
+                    started.wait()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=hold) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+    finally:
+        n4j.close()
+    assert server.RequestHandlerClass.stats.to_dict()['peak_connections'] == 8
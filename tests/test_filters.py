@@ -0,0 +1,30 @@
+import pytest
+
+import helpers
+from helpers import CLIENT, SERVER
+from lib import filters
+
+# mDNS announcements between web requests
+def write_capture(path):
+    packets = []
+    for i in range(20):
+        packets.append(helpers.tcp_packet(CLIENT, 40000, SERVER, 80, helpers.ACK))
+        packets.append(helpers.udp_packet(CLIENT, 5353, '224.0.0.251', 5353))
+    helpers.write_pcap(path, packets)
+
+@pytest.mark.parametrize('profile', ['full', 'minimal'])
+def test_protocol_rule_drops_packets_never_dissected(server, tmp_path, monkeypatch, profile):
+    rules = filters.RuleSet(protocols=['mdns'])
+    monkeypatch.setattr(filters, 'active', rules)
+    path = str(tmp_path / 'mdns.pcap')
+    write_capture(path)
+    pc = helpers.new_pcap(path, profile=profile)
+    pc.start_process(helpers.stub_neo4j(server))
+    assert rules.dropped == {'protocols': 20}
+    assert list(helpers.connections(server)) == [(CLIENT, SERVER, 80)]
+
+def test_unmatched_protocols():
+    rules = filters.RuleSet(protocols=['arp', 'mdns', 'http'])
+    assert filters.unmatched_protocols(rules, 'full', False) == []
+    assert filters.unmatched_protocols(rules, 'minimal', False) == ['http']
+    assert filters.unmatched_protocols(rules, 'full', True) == ['http']
@@ -0,0 +1,79 @@
+import helpers
+from helpers import CLIENT, SERVER
+from lib import flows
+
+# A client on port 1000 talking to a server on 5000: the lower port is the
+# client, so only the handshake tells them apart
+def write_capture(path, packets=2000):
+    data = [
+        helpers.tcp_packet(CLIENT, 1000, SERVER, 5000, helpers.SYN),
+        helpers.tcp_packet(SERVER, 5000, CLIENT, 1000, helpers.SYN | helpers.ACK),
+        helpers.tcp_packet(CLIENT, 1000, SERVER, 5000, helpers.ACK),
+    ]
+    for i in range(packets):
+        if i % 2:
+            data.append(helpers.tcp_packet(SERVER, 5000, CLIENT, 1000, helpers.ACK))
+        else:
+            data.append(helpers.tcp_packet(CLIENT, 1000, SERVER, 5000, helpers.ACK))
+    helpers.write_pcap(path, data)
+    return len(data)
+
+def import_flows(server, path, workers):
+    pc = helpers.new_pcap(path)
+    pc.workers = workers
+    pc.flows = flows.FlowTable()
+    pc.aggregator.flows = pc.flows
+    pc.start_process(helpers.stub_neo4j(server))
+    return helpers.connections(server)
+
+def test_serial_flow_is_one_connection(server, tmp_path):
+    path = str(tmp_path / 'flow.pcap')
+    total = write_capture(path)
+    assert {k: v[0] for k, v in import_flows(server, path, 1).items()} == {(CLIENT, SERVER, 5000): total}
+
+def test_parallel_flows_keep_the_handshake_orientation(server, tmp_path):
+    path = str(tmp_path / 'flow.pcap')
+    total = write_capture(path)
+    assert {k: v[0] for k, v in import_flows(server, path, 3).items()} == {(CLIENT, SERVER, 5000): total}
+
+def test_parallel_matches_serial_on_synthetic_flows(server, tmp_path):
+    import synth
+    path = str(tmp_path / 'flows.pcap')
+    synth.write_pcap(path, 'flows', 3000, hosts=8, flows=50, payloads=False)
+    serial = import_flows(server, path, 1)
+    server.RequestHandlerClass.stats.reset()
+    assert import_flows(server, path, 3) == serial
+
+def test_merge_joins_flows_picked_up_mid_stream():
+    first, second = flows.FlowTable(), flows.FlowTable()
+    first.update('tcp', CLIENT, '1000', SERVER, '5000', helpers.SYN, 1.0, 60, None, None)
+    second.update('tcp', SERVER, '5000', CLIENT, '1000', helpers.ACK, 2.0, 60, None, None)
+    # Without the handshake, the lower port looks like the server
+    assert second.get('tcp', CLIENT, '1000', SERVER, '5000').client == SERVER
+    agg = helpers.aggregate.Aggregate()
+    first.merge(second, agg)
+    first.drain(agg)
+    assert {key: conn.count for key, conn in agg.connections.items()} == {('IP', CLIENT, SERVER, '5000', 'tcp'): 2}
+    assert first.stats()['opened'] == 1
+
+def test_reused_tuple_keeps_each_sessions_direction():
+    table = flows.FlowTable()
+    packets = [
+        # CLIENT opens to SERVER:5000 and both sides close
+        (CLIENT, '1000', SERVER, '5000', helpers.SYN),
+        (SERVER, '5000', CLIENT, '1000', helpers.SYN | helpers.ACK),
+        (CLIENT, '1000', SERVER, '5000', helpers.ACK | flows.FIN),
+        (SERVER, '5000', CLIENT, '1000', helpers.ACK | flows.FIN),
+        # Then SERVER opens to CLIENT:1000 on the same 5-tuple
+        (SERVER, '5000', CLIENT, '1000', helpers.SYN),
+        (CLIENT, '1000', SERVER, '5000', helpers.SYN | helpers.ACK),
+        (SERVER, '5000', CLIENT, '1000', helpers.ACK),
+    ]
+    for i, (src, sport, dst, dport, flags) in enumerate(packets):
+        table.update('tcp', src, sport, dst, dport, flags, float(i), 60, None, None)
+    agg = helpers.aggregate.Aggregate()
+    table.drain(agg)
+    assert {key: conn.count for key, conn in agg.connections.items()} == {
+        ('IP', CLIENT, SERVER, '5000', 'tcp'): 4,
+        ('IP', SERVER, CLIENT, '1000', 'tcp'): 3,
+    }
@@ -0,0 +1,47 @@
+import sys
+
+import pytest
+
+import helpers
+import synth
+
+import NetFrenzy
+
+def import_file(server, path, concurrency):
+    pc = helpers.new_pcap(path)
+    pc.aggregator.max_packets = 200
+    pc.write_concurrency = concurrency
+    pc.start_process(helpers.stub_neo4j(server))
+
+def test_async_writes_leave_no_checkpoint(server, tmp_path):
+    path = str(tmp_path / 'hosts.pcap')
+    synth.write_pcap(path, 'hosts', 1000, hosts=20, payloads=False)
+    import_file(server, path, 4)
+    assert helpers.connections(server)
+    # Its parts commit separately, so it has no packet to resume from
+    assert helpers.checkpoints(server) == {}
+
+def test_synchronous_writes_checkpoint(server, tmp_path):
+    path = str(tmp_path / 'hosts.pcap')
+    synth.write_pcap(path, 'hosts', 1000, hosts=20, payloads=False)
+    import_file(server, path, 1)
+    assert list(helpers.checkpoints(server).values())[-1] == 1000
+
+def test_resume_is_rejected_with_async_writes(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['NetFrenzy.py', '--pcap', 'x.pcap', '--resume', '--async-writes', '4'])
+    with pytest.raises(SystemExit):
+        NetFrenzy.parse_args()
+
+def interrupt(neo4j):
+    raise KeyboardInterrupt
+
+@pytest.mark.parametrize('concurrency, hint', [(1, True), (4, False)])
+def test_resume_hint_only_with_a_checkpoint(server, tmp_path, monkeypatch, capsys, concurrency, hint):
+    path = str(tmp_path / 'hosts.pcap')
+    synth.write_pcap(path, 'hosts', 10, hosts=2, payloads=False)
+    pc = helpers.new_pcap(path)
+    pc.write_concurrency = concurrency
+    monkeypatch.setattr(pc, 'upload_to_neo4j', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        pc.start_process(helpers.stub_neo4j(server))
+    assert ('--resume' in capsys.readouterr().out) == hint
@@ -0,0 +1,23 @@
+import json
+
+from lib import metrics
+
+def reject(constant):
+    raise ValueError(f'{constant} is not valid JSON')
+
+def test_report_is_valid_json_past_the_last_bucket(tmp_path):
+    registry = metrics.Metrics()
+    registry.observe('neo4j', 30.0)
+    registry.observe('neo4j', 0.001)
+    path = str(tmp_path / 'metrics.json')
+    registry.write(path)
+    with open(path) as f:
+        report = json.loads(f.read(), parse_constant=reject)
+    stage = report['stages']['neo4j']
+    assert stage['p99_seconds'] == metrics.BUCKETS[-1]
+    assert stage['buckets']['+Inf'] == 2
+
+def test_prometheus_keeps_the_inf_bucket():
+    registry = metrics.Metrics()
+    registry.observe('neo4j', 30.0)
+    assert 'netfrenzy_stage_seconds_bucket{stage="neo4j",le="+Inf"} 1' in registry.prometheus()
@@ -0,0 +1,18 @@
+import pytest
+
+from lib import aggregate
+from lib import multicast
+
+def test_cached_classes_cant_be_changed():
+    classes = multicast.classify_ip('224.0.0.251')
+    with pytest.raises(TypeError):
+        classes['multicast'] = False
+    with pytest.raises(TypeError):
+        multicast.classify_mac('01:00:5e:00:00:fb')['local'] = True
+    assert multicast.classify_ip('224.0.0.251')['multicast']
+
+def test_node_rows_copy_the_classes():
+    [row] = aggregate.node_rows('IP', {'10.0.0.1': {'site': 'hq'}})
+    row['properties']['private'] = False
+    assert multicast.classify_ip('10.0.0.1')['private']
+    assert row['properties']['site'] == 'hq'
@@ -0,0 +1,62 @@
+import re
+
+from lib import neo4j
+from lib import pcap
+
+ROW = {'src': '10.0.0.1', 'dst': '10.0.0.2', 'name': '80/tcp', 'port': '80', 'protocol': 'tcp',
+       'first_seen': 1.0, 'last_seen': 2.0, 'data_size': 60, 'count': 1, 'service': 'tcp', 'service_layer': 2}
+
+# The ON CREATE and ON MATCH actions of a MERGE query. Anything after the
+# MERGE that isn't one of them would run on both paths
+def merge_actions(query):
+    tail = query[query.index('MERGE'):].split('\n', 1)[1]
+    parts = re.split(r'^\s*(ON CREATE|ON MATCH)\s*$', tail, flags=re.M)
+    assert parts[0].strip() == ''
+    return dict(zip(parts[1::2], parts[2::2]))
+
+def test_merge_connections_adds_totals_once():
+    for label in ('IP', 'MAC'):
+        [(query, parameters)] = neo4j.Neo4j().merge_connections(label, [ROW])
+        actions = merge_actions(query)
+        assert set(actions) == {'ON CREATE', 'ON MATCH'}
+        for action in actions.values():
+            assert len(re.findall(r'\bSET\b', action)) == 1
+        assert 'count: row.count' in actions['ON CREATE']
+        assert 'r.count = r.count + row.count' in actions['ON MATCH']
+        assert 'r.data_size = r.data_size + row.data_size' in actions['ON MATCH']
+
+def test_merge_connections_reduced_sets_nothing():
+    [(query, parameters)] = neo4j.Neo4j().merge_connections('IP', [ROW], reduce=True)
+    assert 'SET' not in query
+
+def test_merge_subnet_connections_adds_totals_once():
+    row = {'src': '10.0.0.0/24', 'dst': '10.0.1.0/24', 'first_seen': 1.0, 'last_seen': 2.0, 'data_size': 60, 'count': 1}
+    [(query, parameters)] = neo4j.Neo4j().merge_subnet_connections([row])
+    assert '[r:SUBNET_CONNECTED]' in query
+    actions = merge_actions(query)
+    assert set(actions) == {'ON CREATE', 'ON MATCH'}
+    for action in actions.values():
+        assert len(re.findall(r'\bSET\b', action)) == 1
+    assert 'r.count = r.count + row.count' in actions['ON MATCH']
+    assert 'r.data_size = r.data_size + row.data_size' in actions['ON MATCH']
+
+class Recorder:
+    def __init__(self):
+        self.queries = []
+
+    def raw_query(self, query):
+        self.queries.append(query)
+
+def test_unaggregated_connections_add_totals_once():
+    pc = pcap.Pcap(None, None)
+    recorder = Recorder()
+    pc.create_connection_ip_full(recorder, '10.0.0.1', '10.0.0.2', '80', 'tcp', 1.0, 60, 'http', 5)
+    pc.create_connection_mac_full(recorder, '00:00:00:00:00:01', '00:00:00:00:00:02', 'eth', 1.0, 60, 'http', 5)
+    # The first query of each merges the relationship, the second its service
+    for query in recorder.queries[::2]:
+        actions = merge_actions(query)
+        assert set(actions) == {'ON CREATE', 'ON MATCH'}
+        for action in actions.values():
+            assert len(re.findall(r'\bSET\b', action)) == 1
+        assert 'r.count = r.count + 1' in actions['ON MATCH']
+        assert 'r.data_size = r.data_size + 60' in actions['ON MATCH']
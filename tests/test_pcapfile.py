@@ -0,0 +1,74 @@
+import struct
+
+import pytest
+
+import helpers
+import synth
+from lib import pcapfile
+
+class Packet:
+    def __init__(self, number):
+        self.number = number
+
+def write_truncated(path):
+    # A global header and a record header claiming more bytes than follow
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, synth.LINKTYPE_ETHERNET))
+        f.write(struct.pack('<IIII', 1600000000, 0, 60, 60))
+        f.write(b'\x00' * 10)
+
+def test_byte_progress_without_records(tmp_path):
+    path = str(tmp_path / 'truncated.pcap')
+    write_truncated(path)
+    assert pcapfile.count_packets(path) == 0
+    packets = [Packet(1)]
+    assert list(pcapfile.ByteProgress(packets, path)) == packets
+
+def test_byte_progress_header_only(tmp_path):
+    path = str(tmp_path / 'empty.pcap')
+    synth.write_pcap(path, 'hosts', 0)
+    assert list(pcapfile.ByteProgress([], path)) == []
+
+def test_byte_progress_yields_every_packet(tmp_path):
+    path = str(tmp_path / 'hosts.pcap')
+    synth.write_pcap(path, 'hosts', 20, hosts=10, payloads=False)
+    packets = list(pcapfile.FastCapture(path))
+    assert [int(p.number) for p in pcapfile.ByteProgress(packets, path)] == list(range(1, 21))
+
+class FakeTshark:
+    '''
+    Stands in for pyshark.FileCapture, decoding the file natively and
+    recording which frames it was given.
+    '''
+    given = []
+
+    def __init__(self, path, **kwargs):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+    def __iter__(self):
+        for record in pcapfile.records(self.data):
+            FakeTshark.given.append(pcapfile.decode(self.data, record).udp.srcport)
+            yield Packet(str(record.number))
+
+    def close(self):
+        pass
+
+@pytest.mark.parametrize('batch', [1000, 2])
+def test_only_payload_frames_are_dissected(tmp_path, monkeypatch, batch):
+    monkeypatch.setattr(pcapfile.pyshark, 'FileCapture', FakeTshark)
+    monkeypatch.setattr(pcapfile, 'DISSECT_BATCH', batch)
+    FakeTshark.given = []
+    path = str(tmp_path / 'payloads.pcap')
+    # Every third packet has a payload
+    helpers.write_pcap(path, [helpers.udp_packet(helpers.CLIENT, 1000 + i, helpers.SERVER, 53, b'x' if i % 3 == 0 else b'')
+                              for i in range(10)])
+    cap = pcapfile.FastCapture(path)
+    cap.dissect_payloads = True
+    packets = list(cap)
+    assert [int(packet.number) for packet in packets] == list(range(1, 11))
+    assert [isinstance(packet, Packet) for packet in packets] == [i % 3 == 0 for i in range(10)]
+    # tshark only got the frames with a payload
+    assert FakeTshark.given == ['1000', '1003', '1006', '1009']
+    assert cap.batches == (1 if batch == 1000 else 2)
+    assert (cap.decoded, cap.dissected) == (6, 4)
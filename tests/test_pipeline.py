@@ -0,0 +1,26 @@
+import threading
+
+import synth
+from lib import aggregate
+from lib import neo4j
+from lib import pcap
+from lib import pipeline
+
+def test_stop_gives_up_on_an_unreachable_neo4j(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'FINAL_ATTEMPTS', 2)
+    path = str(tmp_path / 'hosts.pcap')
+    synth.write_pcap(path, 'hosts', 50, hosts=10, payloads=False)
+    pc = pcap.Pcap(path, None, fast=True)
+    pc.aggregator = aggregate.Aggregator(max_packets=None, max_memory=None, max_seconds=None)
+    n4j = neo4j.Neo4j()
+    # Nothing listens on port 1
+    n4j.commit = 'http://127.0.0.1:1/db/data/transaction/commit'
+    live = pipeline.Pipeline(pc, n4j)
+    run = threading.Thread(target=live.run, args=(iter(pc.cap),), daemon=True)
+    run.start()
+    run.join(timeout=30)
+    assert not run.is_alive()
+    assert live.write_errors == 2
+    assert live.written_packets == 0
+    # Dropped rather than written again by Pcap.flush()
+    assert len(pc.aggregator.aggregate) == 0
@@ -0,0 +1,33 @@
+import helpers
+from helpers import CLIENT, SERVER
+from lib import filters
+from lib import rotation
+
+# Web requests with DNS lookups between them, ending on lookups
+def write_capture(path):
+    packets = []
+    for i in range(30):
+        packets.append(helpers.tcp_packet(CLIENT, 40000, SERVER, 80, helpers.ACK))
+        packets.append(helpers.udp_packet(CLIENT, 50000 + i, SERVER, 53, b'query'))
+        packets.append(helpers.udp_packet(SERVER, 53, CLIENT, 50000 + i, b'answer'))
+    helpers.write_pcap(path, packets)
+    return len(packets)
+
+def import_directory(server, directory):
+    pc = helpers.new_pcap(None)
+    rotation_run = rotation.Rotation(pc, helpers.stub_neo4j(server), directory)
+    rotation_run.run()
+    return rotation_run.imported
+
+def test_checkpoint_counts_dropped_packets(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(filters, 'active', filters.RuleSet(ports=[53]))
+    path = tmp_path / 'capture-0.pcap'
+    total = write_capture(str(path))
+    assert import_directory(server, str(tmp_path)) == 1
+    assert helpers.checkpoints(server) == {str(path): total}
+    assert helpers.connections(server) == {(CLIENT, SERVER, 80): [30, 30 * 54]}
+
+    # The ledger has the whole file, so nothing is read or written again
+    written = len(server.RequestHandlerClass.stats.received)
+    assert import_directory(server, str(tmp_path)) == 0
+    assert len(server.RequestHandlerClass.stats.received) == written + 1
@@ -9,6 +9,11 @@ var helpfulqueries = {
 	"Top 10 IPs with most outbound connections": "MATCH (n:IP), (m:IP), (n)-[r:CONNECTED]->(m) WITH n, count(r) AS rel_count ORDER BY rel_count DESC LIMIT 10 MATCH p=(m)<-[r:CONNECTED]-(n) RETURN p",
 	"Top 10 connections by data transferred": "MATCH ()-[r:CONNECTED]->(:IP) WITH r, r.data_size AS data ORDER BY data DESC LIMIT 10 MATCH (n)-[r]-(m) RETURN n,r,m",
 	"General wireless query": "MATCH (o:MAC)-[r:CONNECTED|ADVERTISES|PROBES]->(m) WHERE NOT m:IP AND (m.multicast IS NULL OR m.multicast = false) RETURN *",
+	"Subnet overview": "MATCH (n:Subnet) OPTIONAL MATCH (n)-[r:SUBNET_CONNECTED]->(m:Subnet) RETURN n, r, m",
+	"Drill down into a subnet": "MATCH (s:Subnet {name: \"192.168.119.0/24\"})<-[i:IN_SUBNET]-(n:IP) OPTIONAL MATCH (n)-[r:CONNECTED]-(m:IP) RETURN *",
+	"Connections between two subnets": "MATCH (:Subnet {name: \"192.168.119.0/24\"})<-[:IN_SUBNET]-(n:IP)-[r:CONNECTED]->(m:IP)-[:IN_SUBNET]->(:Subnet {name: \"10.0.0.0/24\"}) RETURN n, r, m",
+	"Top 10 subnet pairs by data transferred": "MATCH (n:Subnet)-[r:SUBNET_CONNECTED]->(m:Subnet) WITH n, r, m ORDER BY r.data_size DESC LIMIT 10 RETURN n, r, m",
+	"MAC addresses by vendor": "MATCH (v:Vendor)<-[r:MADE_BY]-(m:MAC) RETURN *",
 }
 
 // vim: ts=2 sts=2
@@ -24,6 +24,16 @@ function draw() {
 				"size": "1",
 			"font": {"size": 12, "color": "#BB00BB"}
 			},
+			"Subnet": {
+				"caption": "name",
+				"size": "1",
+			"font": {"size": 14, "color": "#007700"}
+			},
+			"Vendor": {
+				"caption": "name",
+				"size": "1",
+			"font": {"size": 12, "color": "#BB5500"}
+			},
 			"ASSIGNED": {
 				"caption": "name",
 				"size": "0.1",
@@ -39,6 +49,10 @@ function draw() {
 				"thickness": "data_size",
 				"caption": "service"
 			},
+			"SUBNET_CONNECTED": {
+				"thickness": "data_size",
+				"caption": false,
+			},
 			"COMMUNICATES": {
 				"thickness": "0.1",
 				"caption": false,
@@ -58,9 +72,22 @@ function draw() {
 			"PROBE_RESPONSE": {
 				"thickness": "0.1",
 				"caption": true,
+			},
+			"IN_SUBNET": {
+				"thickness": "0.1",
+				"caption": false,
+			},
+			"MADE_BY": {
+				"thickness": "0.1",
+				"caption": false,
 			}
 		},
-		initial_cypher: "MATCH (n) RETURN *"
+		// Open on the subnet rollup, which stays small however big the
+		// capture. Without one, as with --no-rollup or an older import, open
+		// on a bounded part of the IP graph instead
+		initial_cypher: "MATCH (n:Subnet) OPTIONAL MATCH (n)-[r:SUBNET_CONNECTED]->(m:Subnet) RETURN n, r, m " +
+			"UNION OPTIONAL MATCH (s:Subnet) WITH count(s) AS subnets MATCH (n:IP) WHERE subnets = 0 " +
+			"WITH n LIMIT 300 OPTIONAL MATCH (n)-[r:CONNECTED]->(m:IP) RETURN n, r, m LIMIT 1000"
 	};
 
 	window.viz = new NeoVis.default(window.config);